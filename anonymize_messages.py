@@ -5,15 +5,17 @@ Created on Sun May 31 12:27:01 2020
 @author: jhr
 """
 import json
-import hashlib
+import os
 import pickle
 import random
 import string
-import shutil
 import subprocess
 import sys
-from zipfile import ZipFile
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from fnmatch import fnmatch
+from zipfile import ZipFile, ZIP_DEFLATED
+from pathlib import Path, PurePosixPath
+from identity import hash_name, as_hash_set, is_cog_convo, create_hash_dict
 try:
     from flashtext import KeywordProcessor
 except ModuleNotFoundError:
@@ -21,6 +23,17 @@ except ModuleNotFoundError:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "flashtext"])
     print("done!")
     from flashtext import KeywordProcessor
+
+
+# "fields" hashes the name fields directly, "text" is the old replace-in-the-whole-text
+ANON_MODE = "fields"
+# check every anonymized conversation for plaintext names (slower)
+VERIFY_NAMES = False
+# filled in from cogsci19.pkl when run
+COG_HASHES = set()
+N_WORKERS = os.cpu_count()
+# conversations read but not yet anonymized are kept under this
+MAX_IN_FLIGHT_BYTES = 512 * 2**20
     
 
 def flatten(l):
@@ -44,28 +57,10 @@ def find_all_messages(main_dir):
     return main_dir.rglob("message_*.json")
 
 
-def hash_name(name):
-    """ simplified version (no salt) """
-    return hashlib.sha1(name.encode()).hexdigest()
-
-
-def check_name(hashed_name, new_name):
-    return hashed_name == hash_name(new_name)
-
-
-def is_a_cogsci(cogsci_hashes, new_name):
-    return any(check_name(hsh, new_name) for hsh in cogsci_hashes)
-
-
 def extract_participants(convo):
     return [participant["name"] for participant in convo["participants"]]
 
 
-def is_cog_convo(participants, cog_hashes):
-    """ Checks whether all participants in convo are cogsci19 """
-    return any(check_name(hsh, name) for hsh in cog_hashes for name in participants)
-
-
 def get_other_participant(lst, part):
     return next(filter(lambda x: x != part,  lst))
 
@@ -91,6 +86,8 @@ def format_call(call, participants):
     assert call["type"] == "Call"
     new_call = call.copy()
     new_call.pop("content", None)
+    if "reactions" in new_call:
+        new_call["reactions"] = format_reaction(new_call["reactions"])
     if len(participants) == 2:
         new_call["receiver_name"] = get_other_participant(participants, call["sender_name"])
     return new_call
@@ -127,10 +124,6 @@ def process_message(msg, participants):
         raise AssertionError
 
         
-def create_hash_dict(participants):
-    return {hash_name(name): [name] for name in participants}
-        
-
 def init_hashifier(participants):
     hash_dict = create_hash_dict(participants)
     hashifier = KeywordProcessor()
@@ -147,6 +140,40 @@ def anonymize_stuff(processed_msgs, participants):
     convo_string = stringify_dict(processed_msgs)
     anon_string = hashifier.replace_keywords(convo_string)
     return anon_string
+
+
+def hash_names(names):
+    return [hash_name(name) for name in names]
+
+
+def anonymize_fields(convo):
+    """ 
+    Hashes the names directly in the fields that hold them 
+    (senders, receivers, reactions, participants and subscription users) 
+    """
+    for msg in convo["messages"]:
+        if "sender_name" in msg:
+            msg["sender_name"] = hash_name(msg["sender_name"])
+        if "receiver_name" in msg:
+            msg["receiver_name"] = hash_name(msg["receiver_name"])
+        if "reactions" in msg:
+            msg["reactions"] = hash_names(msg["reactions"])
+    for sub in convo["subscriptions"]:
+        sub["users"] = [{**user, "name": hash_name(user["name"])} for user in sub["users"]]
+    convo["participants"] = hash_names(convo["participants"])
+    return convo
+
+
+def find_plaintext(anon_convo, participants):
+    """ Verification: plaintext names left anywhere in an anonymized convo """
+    finder = KeywordProcessor()
+    finder.add_keywords_from_list(list(participants))
+    return set(finder.extract_keywords(stringify_dict(anon_convo)))
+
+
+def scrub_text(anon_convo, participants):
+    """ Falls back on replacing names in the whole text """
+    return json.loads(anonymize_stuff(anon_convo, participants))
     
 def get_sub_users(sub_list):
     nested_list = [[user["name"] for user in subs["users"]] for subs in sub_list]
@@ -170,15 +197,26 @@ def process_convo(convo):
             processed_subscriptions.append(format_subscribe(msg))
         else:
             processed_msgs.append(process_message(msg, participants))
-    convo["messages"] = processed_msgs
-    convo["participants"] = participants
-    convo["subscriptions"] = processed_subscriptions
     convo.pop("title", None)
     convo.pop("is_still_participant", None)
     convo.pop("thread_path", None)
+    # participants and thread_type first, so readers can stream the messages
+    convo = {"participants": participants,
+             "thread_type": convo.pop("thread_type", None),
+             "subscriptions": processed_subscriptions,
+             **{k: v for k, v in convo.items() 
+                if k not in ("participants", "messages", "subscriptions")},
+             "messages": processed_msgs}
     # Use all participants for this stuff
     all_participants = get_all_participants(participants, processed_subscriptions)
-    anon_convo = anonymize_stuff(convo, all_participants)
+    if ANON_MODE == "text":
+        return anonymize_stuff(convo, all_participants)
+    anon_convo = anonymize_fields(convo)
+    if VERIFY_NAMES:
+        leftovers = find_plaintext(anon_convo, all_participants)
+        if leftovers:
+            print(f"{len(leftovers)} names left in unexpected fields, replacing them in the text")
+            anon_convo = scrub_text(anon_convo, all_participants)
     return anon_convo
 
 
@@ -186,81 +224,101 @@ def random_long_id(N=32):
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=N))
 
 
-def write_json_data(data):
-    file_name = random_long_id() + ".json"
-    file_path = Path("./data") / file_name
-    with open(file_path, "w") as f:
-        json.dump(data, f)
+def is_message_file(file_name):
+    """ Conversations in the facebook export are called message_1.json, message_2.json, ... """
+    return fnmatch(PurePosixPath(file_name).name, "message_*.json")
+
 
+def iter_zip_messages(zip_paths):
+    """ Yields the bytes of every message_*.json straight from the export zip(s) """
+    for zip_path in zip_paths:
+        with ZipFile(zip_path, 'r') as zipObj:
+            for file in zipObj.namelist():
+                if is_message_file(file):
+                    yield zipObj.read(file)
 
-def anon_pipeline(convo_file):
-    convo = read_json(convo_file)
-    anon_convo = process_convo(convo)
-    if anon_convo is not None:
-        write_json_data(anon_convo)
 
-        
-def create_dir(path):
-    TEMP_DATA = Path(path)
-    try:
-        TEMP_DATA.mkdir()
-    except FileExistsError:
-        pass
-    return TEMP_DATA
+def iter_dir_messages(main_dir):
+    """ Same, but for an export that has already been unzipped (Mac) """
+    for convo_file in find_all_messages(main_dir):
+        yield convo_file.read_bytes()
+
 
+def init_worker(cog_hashes, anon_mode, verify_names):
+    """ Workers need the settings from the main process (they aren't forked on Windows) """
+    global COG_HASHES, ANON_MODE, VERIFY_NAMES
+    COG_HASHES, ANON_MODE, VERIFY_NAMES = cog_hashes, anon_mode, verify_names
 
-def unzip_msg_files(zip_path, target_dir):
-    with ZipFile(zip_path, 'r') as zipObj:
-        # Get a list of all archived file names from the zip
-        all_files = zipObj.namelist()
-        for file in all_files:
-            if file.endswith(".json"):
-                zipObj.extract(file, target_dir)
 
-is_dropout = input("""
+def anon_bytes(data):
+    """ Anonymizes one conversation, returning json bytes (None if it isn't a cogsci convo) """
+    anon_convo = process_convo(json.loads(data))
+    if anon_convo is None:
+        return None
+    # dicts are written as plain json, strings (ANON_MODE = "text") as before
+    return json.dumps(anon_convo).encode()
+
+
+def write_anon(out_zip, anon_data):
+    """ Writes an anonymized conversation to the output zip (only the main process writes) """
+    if anon_data is None:
+        return 0
+    out_zip.writestr(random_long_id() + ".json", anon_data)
+    return 1
+
+
+def anonymize_all(messages, out_zip, n_workers=N_WORKERS, max_in_flight=MAX_IN_FLIGHT_BYTES):
+    """
+    Anonymizes conversations (bytes) across n_workers processes while they are read,
+    writing the results to out_zip. At most max_in_flight bytes of conversations
+    are waiting at a time, so memory stays bounded
+    """
+    if n_workers <= 1:
+        return sum(write_anon(out_zip, anon_bytes(data)) for data in messages)
+    n_written = 0
+    in_flight = {}
+    in_flight_bytes = 0
+    with ProcessPoolExecutor(n_workers, initializer=init_worker, 
+                             initargs=(COG_HASHES, ANON_MODE, VERIFY_NAMES)) as pool:
+        for data in messages:
+            while in_flight and (len(in_flight) >= 2 * n_workers 
+                                 or in_flight_bytes + len(data) > max_in_flight):
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight_bytes -= in_flight.pop(future)
+                    n_written += write_anon(out_zip, future.result())
+            in_flight[pool.submit(anon_bytes, data)] = len(data)
+            in_flight_bytes += len(data)
+        for future in as_completed(in_flight):
+            n_written += write_anon(out_zip, future.result())
+    return n_written
+
+
+if __name__ == "__main__":
+    is_dropout = input("""
 Hello there! Thanks for helping us gather this awesome data :)) 
 We'll do everything we can to ensure that your privacy is conserved.
 All the processing is done automagically (you can check out the .zip-file afterwards)
 We only have one question: Are you still attending the Cognitive Science Program? (If yes enter "1", if no enter "0")
 """)
 
+    print("that's all! Now the program will do some magic :))")
+    hash_path = Path("cogsci19.pkl")
+    COG_HASHES = as_hash_set(read_pickle(hash_path))
+    zip_paths = list(Path(".").glob("facebook*.zip"))
+    out_path = Path(f"all_the_data_{random_long_id(N=8)}.zip")
 
+    print("finding messages in zip-file...")
+    if len(zip_paths) > 0:
+        messages = iter_zip_messages(zip_paths)
+    else:
+        print("Mac has done the job for us!")
+        messages = iter_dir_messages(Path("./messages"))
 
-print("that's all! Now the program will do some magic :))")
-print("setting up directories...")
-create_dir("./data")    
-hash_path = Path("cogsci19.pkl")
-COG_HASHES = read_pickle(hash_path)
-zip_paths = list(Path(".").glob("facebook*.zip"))
-temp_data = create_dir("./temp")
-
-print("writing activity-status...")
-with open(Path("./data/dropout.json"), "w") as f:	
-	json.dump({"is_dropout": is_dropout}, f)
-
-print("finding messages in zip-file...")
-if len(zip_paths) > 0:
-    for zip_path in zip_paths:
-        unzip_msg_files(zip_path, temp_data)
-    print("done!")
-    print("anonymizing the data....")
-    for convo_file in find_all_messages(temp_data):
-        anon_pipeline(convo_file)
-    print("done!")
-
-else:
-    print("Mac has done the job for us!")
     print("anonymizing the data....")
-    for convo_file in find_all_messages(Path("./messages")):
-        anon_pipeline(convo_file)
-    print("done!")
-
-
-
-# Writing data to zip
-print("write data to zip!")
-shutil.make_archive(f"all_the_data_{random_long_id(N=8)}", 'zip', "data")
-print("cleaning up directories...")
-shutil.rmtree("data")
-shutil.rmtree(temp_data)   
-print("all done!")
\ No newline at end of file
+    with ZipFile(out_path, "w", ZIP_DEFLATED) as out_zip:
+        print("writing activity-status...")
+        out_zip.writestr("dropout.json", json.dumps({"is_dropout": is_dropout}))
+        n_written = anonymize_all(messages, out_zip, N_WORKERS)
+    print(f"done! wrote {n_written} conversations to {out_path}")
+    print("all done!")
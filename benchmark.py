@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the pipeline stages on synthetic exports (synthetic_data.py).
+
+Each stage runs in a fresh python process at each scale, so its peak memory
+is its own. The stage's inputs are read (untimed) before the clock starts,
+and its output is saved for the next stage afterwards:
+
+    anonymize        raw exports -> all_the_data_*.zip   (anonymize_messages.anonymize_all)
+    read             conversations in the zips           (yield_msg_files)
+    process_person   zips -> edges, deduplicated         (process_people, no edge cache or manifests)
+    double_encoded   the same on zips written the way the old anonymizer did (JSON in a JSON string)
+    filter_consent   edges -> raw_consensual             (filter_consent)
+    tidy_pipeline    raw_consensual -> tidy_data         (tidy_pipeline)
+
+Wall time, messages/s and peak RSS (of the stage's process and its workers)
+are appended to a JSON-lines results file together with the git revision,
+so runs of different versions can be compared:
+
+    python benchmark.py --scales small medium --repeat 3
+    python benchmark.py --compare 1a2b3c4 5d6e7f8
+"""
+import argparse
+import json
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import types
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+
+import synthetic_data
+
+SCALES = {"small": {"n_people": 5, "n_outsiders": 20, "n_groups": 3, "messages": 100},
+          "medium": {"n_people": 15, "n_outsiders": 80, "n_groups": 10, "messages": 300},
+          "large": {"n_people": 30, "n_outsiders": 200, "n_groups": 25, "messages": 1000}}
+STAGES = ["anonymize", "read", "process_person", "double_encoded", "filter_consent", "tidy_pipeline"]
+DATA_DIR = Path("../synthetic")
+RESULTS_PATH = Path("benchmark_results.jsonl")
+SEED = 0
+
+
+def load_pipeline(path=Path(__file__).with_name("data_load.py"), first_cell="\nDATA_DIR = Path("):
+    """ data_load.py runs its cells when imported, so only the definitions before them are run """
+    source = path.read_text(encoding="utf-8")
+    module = types.ModuleType("data_load")
+    module.__file__ = str(path)
+    sys.modules["data_load"] = module
+    exec(compile(source[:source.index(first_cell)], str(path), "exec"), module.__dict__)
+    return module
+
+
+def prepare(scale, data_dir=DATA_DIR, seed=SEED):
+    """ Synthetic exports and anonymized zips of a scale (made once, kept in data_dir/<scale>) """
+    scale_dir = (Path(data_dir) / scale).resolve()
+    params = {**synthetic_data.DEFAULTS, **SCALES[scale], "seed": seed}
+    try:
+        with open(scale_dir / "synthetic.json", encoding="utf-8") as f:
+            if json.load(f)["params"] == params and any((scale_dir / "data").glob("*.zip")):
+                return scale_dir
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(scale_dir, ignore_errors=True)
+    synthetic_data.write_exports(scale_dir, **params)
+    synthetic_data.anonymize_exports(scale_dir)
+    return scale_dir
+
+
+def zip_paths(scale_dir):
+    return sorted((scale_dir / "data").glob("*.zip"))
+
+
+def raw_messages(scale_dir):
+    with open(scale_dir / "synthetic.json", encoding="utf-8") as f:
+        return sum(json.load(f)["raw_messages"])
+
+
+def anon_messages(scale_dir):
+    """ Messages in the anonymized zips (from their manifests, built if missing) """
+    from convo_reader import get_manifest
+    return sum(member["n_messages"] for path in zip_paths(scale_dir) for member in get_manifest(path)["members"])
+
+
+# Every stage returns (run, number of messages, save). Only run is timed.
+
+def stage_anonymize(scale_dir, n_workers):
+    out_dir = scale_dir / "anonymize_out"
+    shutil.rmtree(out_dir, ignore_errors=True)
+    return (lambda: synthetic_data.anonymize_exports(scale_dir, n_workers, zip_dir=out_dir),
+            raw_messages(scale_dir),
+            lambda paths: shutil.rmtree(out_dir))
+
+
+def stage_read(scale_dir, n_workers):
+    pipeline = load_pipeline()
+
+    def run():
+        return sum(len(convo["messages"]) for path in zip_paths(scale_dir)
+                   for convo in pipeline.yield_msg_files(path) if isinstance(convo, dict))
+    return run, anon_messages(scale_dir), None
+
+
+def stage_process_person(scale_dir, n_workers):
+    from convo_reader import manifest_path
+    from table_store import typed_edges, write_table
+    pipeline = load_pipeline()
+    paths = zip_paths(scale_dir)
+    n_messages = anon_messages(scale_dir)
+    # a cold run: no manifests and an empty edge cache (../edge_cache of the working directory)
+    for path in paths:
+        manifest_path(path).unlink(missing_ok=True)
+    shutil.rmtree(scale_dir / "edge_cache", ignore_errors=True)
+
+    def run():
+        data_list = pipeline.process_people(paths, [None] * len(paths), n_workers)
+        return pd.concat(data_list).drop_duplicates()
+    return run, n_messages, lambda edges: write_table(typed_edges(edges), scale_dir / "full_mess.cols")
+
+
+def stage_double_encoded(scale_dir, n_workers):
+    from convo_reader import get_manifest, manifest_path
+    pipeline = load_pipeline()
+    zip_dir = scale_dir / "double_encoded"
+    if not any(zip_dir.glob("*.zip")):
+        synthetic_data.anonymize_exports(scale_dir, double_encode=True, zip_dir=zip_dir)
+    paths = sorted(zip_dir.glob("*.zip"))
+    n_messages = sum(member["n_messages"] for path in paths for member in get_manifest(path)["members"])
+    for path in paths:
+        manifest_path(path).unlink(missing_ok=True)
+    shutil.rmtree(scale_dir / "edge_cache", ignore_errors=True)
+
+    def run():
+        data_list = pipeline.process_people(paths, [None] * len(paths), n_workers)
+        return pd.concat(data_list).drop_duplicates()
+    return run, n_messages, None
+
+
+def stage_filter_consent(scale_dir, n_workers):
+    from table_store import read_table, typed_edges, write_table
+    pipeline = load_pipeline()
+    if not (scale_dir / "full_mess.cols").exists():
+        run, _, save = stage_process_person(scale_dir, n_workers)
+        save(run())
+    full_df = read_table(scale_dir / "full_mess.cols", categorical=False)
+    names = pipeline.create_dropout_df(zip_paths(scale_dir), n_workers)["name"]
+    return (lambda: pipeline.filter_consent(full_df, names),
+            len(full_df),
+            lambda consent_df: write_table(typed_edges(consent_df), scale_dir / "raw_consensual.cols"))
+
+
+def stage_tidy_pipeline(scale_dir, n_workers):
+    from table_store import read_table
+    pipeline = load_pipeline()
+    if not (scale_dir / "raw_consensual.cols").exists():
+        run, _, save = stage_filter_consent(scale_dir, n_workers)
+        save(run())
+    consent_df = read_table(scale_dir / "raw_consensual.cols")
+    return lambda: pipeline.tidy_pipeline(consent_df), len(consent_df), None
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process and its (finished) workers, in MB """
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on linux, bytes on mac
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_stage(stage, scale_dir, n_workers):
+    """ Sets up and times one stage in this process """
+    run, n_messages, save = globals()[f"stage_{stage}"](Path(scale_dir), n_workers)
+    input_rss = peak_rss_mb()
+    start = time.perf_counter()
+    output = run()
+    wall = time.perf_counter() - start
+    peak_rss = peak_rss_mb()
+    if save is not None:
+        save(output)
+    return {"n_messages": n_messages,
+            "wall_s": wall,
+            "messages_per_s": n_messages / wall if wall > 0 else None,
+            "peak_rss_mb": peak_rss,
+            "input_rss_mb": input_rss}
+
+
+def measure(stage, scale_dir, n_workers):
+    """ Runs a stage in a fresh process (working in scale_dir/work, so ../edge_cache is the scale's) """
+    work_dir = scale_dir / "work"
+    work_dir.mkdir(exist_ok=True)
+    done = subprocess.run([sys.executable, str(Path(__file__).resolve()), "--run-stage", stage,
+                           "--scale-dir", str(scale_dir), "--workers", str(n_workers)],
+                          cwd=work_dir, capture_output=True, text=True)
+    if done.returncode != 0:
+        raise RuntimeError(f"{stage} failed:\n{done.stderr}")
+    return json.loads(done.stdout.strip().splitlines()[-1])
+
+
+def git_version():
+    """ Short git revision, with -dirty if tracked files have changed ('unknown' outside git) """
+    here = Path(__file__).resolve().parent
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=here).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision + "-dirty" if dirty else revision
+
+
+def run_benchmarks(scales, stages=STAGES, repeat=1, n_workers=1, data_dir=DATA_DIR,
+                   results_path=RESULTS_PATH, version=None):
+    """ Runs the stages at each scale repeat times, appending a result per run to results_path """
+    version = version or git_version()
+    records = []
+    for scale in scales:
+        scale_dir = prepare(scale, data_dir)
+        for i in range(repeat):
+            for stage in stages:
+                record = {"version": version,
+                          "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                          "python": platform.python_version(),
+                          "machine": platform.machine(),
+                          "scale": scale,
+                          "stage": stage,
+                          "repeat": i,
+                          "n_workers": n_workers,
+                          **measure(stage, scale_dir, n_workers)}
+                with open(results_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+                records.append(record)
+                print(f"{scale:>7} {stage:>15}: {record['wall_s']:8.3f} s "
+                      f"{record['messages_per_s'] or 0:12.0f} messages/s {record['peak_rss_mb']:8.1f} MB")
+    return pd.DataFrame(records)
+
+
+def compare(results_path, base, new):
+    """ Medians per scale and stage of two versions, with new / base ratios """
+    results = pd.read_json(results_path, lines=True)
+    medians = (results[results["version"].isin([base, new])]
+               .groupby(["scale", "stage", "version"])[["wall_s", "messages_per_s", "peak_rss_mb"]]
+               .median()
+               .unstack("version"))
+    table = pd.DataFrame(index=medians.index)
+    for column in ["wall_s", "messages_per_s", "peak_rss_mb"]:
+        table[f"{column}_{base}"] = medians[(column, base)]
+        table[f"{column}_{new}"] = medians[(column, new)]
+        table[f"{column}_ratio"] = medians[(column, new)] / medians[(column, base)]
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline stages on synthetic data")
+    parser.add_argument("--scales", nargs="+", default=["small"], choices=list(SCALES))
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--data-dir", type=Path, default=DATA_DIR, help="where the synthetic data is kept")
+    parser.add_argument("--results", type=Path, default=RESULTS_PATH)
+    parser.add_argument("--version", help="label for the results (git revision by default)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two versions in the results")
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--scale-dir", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_stage:
+        print(json.dumps(run_stage(args.run_stage, args.scale_dir, args.workers)))
+    elif args.compare:
+        with pd.option_context("display.width", 200, "display.max_columns", None):
+            print(compare(args.results, *args.compare))
+    else:
+        run_benchmarks(args.scales, args.stages, args.repeat, args.workers,
+                       args.data_dir, args.results, args.version)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Extracting every conversation once, however many exports it is in.
+
+A conversation is in the export of every participant who handed in their
+data, and process_person used to extract all of the copies, leaving the
+duplicate edges for drop_duplicates at the very end. dedup_plan works that
+out from the zips' manifests before anything is extracted.
+
+Copies are matched on the thread type and the participants (hashed like
+create_group_id). The members of a zip with the same key (the message_1,
+message_2, ... files of a conversation) are one copy, their day sketches
+(convo_reader.day_sketch) summed. Copies are then taken biggest first: the
+first is extracted whole, the next ones only on the days where they have
+messages none of the copies before had (a day with another count or digest),
+so partial histories (an export made earlier, or after deleting messages)
+are merged in. A day in a member's plan means: extract the messages of that
+day, None means all of it and [] means the member is skipped.
+
+    plan, report = dedup_plan(data_paths, manifests)
+    process_people(data_paths, data_list, plan=plan)
+"""
+from collections import defaultdict
+
+from convo_reader import DAY_MS
+from identity import hash_name
+
+
+def thread_key(member):
+    """ What copies of a conversation have in common: its type and its participants """
+    return member["thread_type"], hash_name("".join(sorted(member["participants"])))
+
+
+def add_days(total, days):
+    """ Adds a member's day sketch to the copy's """
+    for day, (count, digest) in days.items():
+        total_count, total_digest = total.get(day, (0, 0))
+        total[day] = (total_count + count, (total_digest + digest) % 2**64)
+
+
+def copy_plan(members, days):
+    """ The plan of the members of a copy given its days to extract (all of them, None, or a set) """
+    if days is None:
+        return {member["name"]: None for member in members}
+    plan = {}
+    for member in members:
+        member_days = member["days"]
+        kept = sorted(day for day in member_days if day in days)
+        plan[member["name"]] = None if len(kept) == len(member_days) and kept else kept
+    return plan
+
+
+def dedup_plan(data_paths, manifests):
+    """
+    Which conversation members of which zips to extract (and on which days).
+    Returns {zip path: {member name: days}} (see above) and a report of how
+    many members and messages are left out
+    """
+    copies = defaultdict(lambda: defaultdict(list))
+    for data_path, manifest in zip(data_paths, manifests):
+        for member in manifest["members"]:
+            copies[thread_key(member)][str(data_path)].append(member)
+
+    plan = {str(data_path): {} for data_path in data_paths}
+    report = {"threads": len(copies), "members": 0, "skipped": 0, "partial": 0, "messages": 0, "kept_messages": 0}
+    for zips in copies.values():
+        sketches = {}
+        for data_path, members in zips.items():
+            sketches[data_path] = {}
+            for member in members:
+                add_days(sketches[data_path], member["days"])
+        order = sorted(zips, key=lambda path: (-sum(m["n_messages"] for m in zips[path]), path))
+        seen = defaultdict(set)
+        for i, data_path in enumerate(order):
+            members = zips[data_path]
+            sketch = sketches[data_path]
+            new = {day for day, count_digest in sketch.items() if count_digest not in seen[day]}
+            days = None if i == 0 or len(new) == len(sketch) else new
+            for day, count_digest in sketch.items():
+                seen[day].add(count_digest)
+            member_plan = copy_plan(members, days)
+            plan[data_path].update(member_plan)
+            for member in members:
+                kept = member_plan[member["name"]]
+                report["members"] += 1
+                report["messages"] += member["n_messages"]
+                if kept is None:
+                    report["kept_messages"] += member["n_messages"]
+                elif kept:
+                    report["partial"] += 1
+                    report["kept_messages"] += sum(member["days"][day][0] for day in kept)
+                else:
+                    report["skipped"] += 1
+    report["dedup_rate"] = 1 - report["kept_messages"] / report["messages"] if report["messages"] else 0.0
+    return plan, report
+
+
+def on_days(messages, days):
+    """ The messages sent on the days (day_sketch's day strings) """
+    return (msg for msg in messages if str(msg["timestamp_ms"] // DAY_MS) in days)
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+Reading anonymized conversations from the participants' zip-files.
+
+The old anonymizer wrote every conversation as a JSON string inside JSON
+(json.dump of an already stringified dict), newer archives are plain JSON.
+Both are read here, either in one go (read_conversation) or incrementally
+(iter_messages), which never holds more than a chunk of the file plus the
+message being parsed.
+
+Each zip gets a manifest (<zip>.manifest.json) summarizing its conversations,
+so the owner, dropout status and sizes are known without decoding it again.
+It also sketches each conversation's messages per day, which is what
+convo_dedup.py compares the copies of a conversation in different exports on.
+
+prefetch_members reads the members ahead on a few threads while the caller
+parses: zlib inflates without holding the GIL, so reading the next members
+overlaps with parsing this one. At most depth members (and max_bytes of
+them, uncompressed) are read ahead.
+"""
+import codecs
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from zipfile import ZipFile
+
+import profiling
+
+CHUNK_SIZE = 1 << 16
+# conversations bigger than this (uncompressed) are streamed
+STREAM_ABOVE = 64 * 2**20
+MANIFEST_VERSION = 2
+DAY_MS = 86_400_000
+# members read ahead by prefetch_members, their uncompressed size at most and the threads reading them
+PREFETCH_DEPTH = 4
+PREFETCH_BYTES = 256 * 2**20
+PREFETCH_THREADS = 2
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"\s*")
+_high_surrogate = re.compile(r"\\u[dD][89abAB][0-9a-fA-F]{2}$")
+
+
+def classify_member(file_name):
+    """ Classifies a zip member by name: 'dropout', 'convo' or 'other' """
+    if file_name.endswith("/"):
+        return "other"
+    name = PurePosixPath(file_name).name
+    if name == "dropout.json":
+        return "dropout"
+    if name.endswith(".json"):
+        return "convo"
+    return "other"
+
+
+def convo_members(zip_obj):
+    """ Names of the conversation members of an open ZipFile """
+    return [name for name in zip_obj.namelist() if classify_member(name) == "convo"]
+
+
+def is_double_encoded(first_char):
+    """ Old archives start with a JSON string instead of an object """
+    return first_char == '"'
+
+
+def decode_bytes(data):
+    """ Decodes a conversation from bytes (old double-encoded ones included) """
+    text = data.decode("utf-8")
+    convo = json.loads(text)
+    if isinstance(convo, str):
+        return json.loads(convo)
+    return convo
+
+
+def read_conversation(zip_obj, file_name):
+    """ Reads a whole conversation from an open ZipFile """
+    return decode_bytes(zip_obj.read(file_name))
+
+
+def prefetch_members(zip_path, file_names, stream_above=STREAM_ABOVE, depth=PREFETCH_DEPTH,
+                     max_bytes=PREFETCH_BYTES, n_threads=PREFETCH_THREADS):
+    """
+    Yields (file_name, bytes) for the members in order, reading the next ones
+    on n_threads threads (each with its own handle on the zip) while the
+    current one is used. Members bigger than stream_above are meant to be
+    streamed, they aren't read and come with None
+    """
+    handles = threading.local()
+    opened = []
+
+    def read(file_name):
+        if not hasattr(handles, "zip_obj"):
+            handles.zip_obj = ZipFile(zip_path, "r")
+            opened.append(handles.zip_obj)
+        return handles.zip_obj.read(file_name)
+
+    with ZipFile(zip_path, "r") as zip_obj:
+        sizes = [zip_obj.getinfo(file_name).file_size for file_name in file_names]
+    pending = deque()
+    pending_bytes = 0
+    next_member = 0
+    pool = ThreadPoolExecutor(n_threads, thread_name_prefix="prefetch")
+    try:
+        for i, file_name in enumerate(file_names):
+            # keep up to depth members (and max_bytes) in flight, at least the one needed now
+            while next_member < len(file_names) and len(pending) < depth:
+                size = sizes[next_member]
+                if stream_above is not None and size > stream_above:
+                    pending.append(None)
+                elif not pending or pending_bytes + size <= max_bytes:
+                    pending.append(pool.submit(read, file_names[next_member]))
+                    pending_bytes += size
+                else:
+                    break
+                next_member += 1
+            future = pending.popleft()
+            if future is None:
+                yield file_name, None
+                continue
+            with profiling.stage("prefetch_wait", member=file_name) as record:
+                data = future.result()
+                record["bytes"] = len(data)
+            pending_bytes -= sizes[i]
+            yield file_name, data
+    finally:
+        # members not started yet are dropped when the caller stops early
+        pool.shutdown(wait=True, cancel_futures=True)
+        for handle in opened:
+            handle.close()
+
+
+def member_digest(zip_obj, file_name, data=None):
+    """ sha1 of a member's bytes (read in chunks unless they are given) """
+    if data is not None:
+        return hashlib.sha1(data).hexdigest()
+    digest = hashlib.sha1()
+    with zip_obj.open(file_name, "r") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def text_chunks(binary_file, chunk_size=CHUNK_SIZE):
+    """ Yields decoded text chunks from a binary file """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        data = binary_file.read(chunk_size)
+        if not data:
+            break
+        yield decoder.decode(data)
+    yield decoder.decode(b"", final=True)
+
+
+def _escape_starts_at(s, i):
+    """ Whether the backslash at s[i] starts an escape (isn't the second of a pair) """
+    start = i
+    while start > 0 and s[start - 1] == "\\":
+        start -= 1
+    return (i - start) % 2 == 0
+
+
+def _safe_cut(s):
+    """ Position to cut escaped text without splitting an escape sequence """
+    cut = len(s)
+    i = s.rfind("\\", max(0, len(s) - 12))
+    if i != -1 and _escape_starts_at(s, i):
+        escape = s[i:]
+        if len(escape) < 2 or (escape[1] == "u" and len(escape) < 6):
+            cut = i
+    # keep surrogate pairs together
+    high = _high_surrogate.search(s, 0, cut)
+    if high and _escape_starts_at(s, high.start()):
+        cut = high.start()
+    return cut
+
+
+def unescape_chunks(chunks):
+    """
+    Yields the text inside a JSON string (the old double-encoded format)
+    chunk by chunk, so the inner JSON can be parsed incrementally
+    """
+    carry = ""
+    started = False
+    for chunk in chunks:
+        s = carry + chunk
+        if not started:
+            s = s.lstrip()
+            if not s:
+                continue
+            s = s[1:]
+            started = True
+        # hold back what might be the closing quote until the end
+        cut = _safe_cut(s.rstrip()[:-1])
+        if cut:
+            yield json.loads('"' + s[:cut] + '"')
+        carry = s[cut:]
+    carry = carry.rstrip()
+    if not carry.endswith('"'):
+        raise ValueError("unterminated conversation string")
+    if carry[:-1]:
+        yield json.loads('"' + carry[:-1] + '"')
+
+
+class _Buffer:
+    """ Text buffer over a chunk iterator that decodes one JSON value at a time """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.pos > CHUNK_SIZE:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.text += chunk
+                return True
+        self.eof = True
+        return False
+
+    def peek(self):
+        while True:
+            self.pos = _whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                raise ValueError("unexpected end of conversation")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} at {self.pos}")
+        self.pos += 1
+
+    def skip(self, char):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # a number at the very end might continue in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def array(self):
+        """ Yields the values of a JSON array one at a time """
+        self.expect("[")
+        if self.skip("]"):
+            return
+        scan = _decoder.scan_once
+        whitespace = _whitespace.match
+        text, pos = self.text, self.pos
+        while True:
+            try:
+                value, end = scan(text, pos)
+            except (StopIteration, json.JSONDecodeError):
+                start = whitespace(text, pos).end()
+                if pos < start < len(text):
+                    pos = start
+                    continue
+                if self.eof:
+                    raise ValueError(f"invalid message at {pos}")
+                end = None
+            # refill if the value might continue in the next chunk
+            if end is None or (end >= len(text) and not self.eof):
+                self.pos = pos
+                self.fill()
+                text, pos = self.text, self.pos
+                continue
+            yield value
+            separator = text[end:end + 1]
+            if separator == ",":
+                pos = whitespace(text, end + 1).end()
+            elif separator == "]":
+                self.pos = end + 1
+                return
+            else:
+                self.pos = end
+                if not self.skip(","):
+                    self.expect("]")
+                    return
+                text, pos = self.text, self.pos
+
+
+def iter_items(chunks, meta):
+    """
+    Yields the messages of a conversation one by one from text chunks.
+    All other top-level keys (participants, thread_type, ...) are put in meta
+    as they are passed, so meta is complete once the generator is exhausted
+    """
+    buffer = _Buffer(chunks)
+    buffer.expect("{")
+    if buffer.skip("}"):
+        return
+    while True:
+        key = buffer.value()
+        buffer.expect(":")
+        if key == "messages":
+            yield from buffer.array()
+        else:
+            meta[key] = buffer.value()
+        if not buffer.skip(","):
+            break
+    buffer.expect("}")
+
+
+def iter_messages(zip_obj, file_name, meta, chunk_size=CHUNK_SIZE):
+    """
+    Streams the messages of a conversation member of an open ZipFile,
+    filling meta with the rest of the conversation (see iter_items)
+    """
+    with zip_obj.open(file_name, "r") as f:
+        chunks = text_chunks(f, chunk_size)
+        first = next(chunks, "")
+        rest = _prepend(first, chunks)
+        if is_double_encoded(first.lstrip()[:1]):
+            rest = unescape_chunks(rest)
+        yield from iter_items(rest, meta)
+
+
+def _prepend(first, chunks):
+    yield first
+    yield from chunks
+
+
+def manifest_path(zip_path):
+    """ The manifest is kept next to the zip-file """
+    zip_path = Path(zip_path)
+    return zip_path.with_name(zip_path.name + ".manifest.json")
+
+
+def zip_key(zip_path):
+    """ Size and mtime of the zip, a manifest is only valid for these """
+    stat = Path(zip_path).stat()
+    return {"version": MANIFEST_VERSION, "zip_size": stat.st_size, "zip_mtime_ns": stat.st_mtime_ns}
+
+
+def day_sketch(senders, timestamps, reactors=(), reacted=(), reaction_times=()):
+    """
+    The messages of a conversation per day (epoch ms // DAY_MS, as a string):
+    how many there are and an order-free digest of their senders, times and
+    reactions (summed crc32s), so copies of a conversation from different
+    exports can be compared day by day (see convo_dedup.py)
+    """
+    sketch = {}
+    for sender, timestamp in zip(senders, timestamps):
+        day = str(timestamp // DAY_MS)
+        count, digest = sketch.get(day, (0, 0))
+        sketch[day] = (count + 1, digest + zlib.crc32(f"{timestamp}\0{sender}".encode()))
+    for reactor, sender, timestamp in zip(reactors, reacted, reaction_times):
+        day = str(timestamp // DAY_MS)
+        count, digest = sketch.get(day, (0, 0))
+        sketch[day] = (count, digest + zlib.crc32(f"{timestamp}\0{reactor}\0{sender}".encode()))
+    return {day: [count, digest % 2**64] for day, (count, digest) in sketch.items()}
+
+
+def manifest_entry(info, convo, timestamps, days):
+    """ Manifest entry for a conversation member (convo without its messages, days its day_sketch) """
+    return {"name": info.filename,
+            "thread_type": convo.get("thread_type"),
+            "participants": convo.get("participants", []),
+            "n_messages": len(timestamps),
+            "file_size": info.file_size,
+            "compress_size": info.compress_size,
+            "first_timestamp": min(timestamps, default=None),
+            "last_timestamp": max(timestamps, default=None),
+            "days": days}
+
+
+def summarize_member(zip_obj, info, stream_above=STREAM_ABOVE):
+    """ Reads one conversation member and returns its manifest entry """
+    if stream_above is not None and info.file_size > stream_above:
+        convo = {}
+        messages = iter_messages(zip_obj, info.filename, convo)
+    else:
+        convo = read_conversation(zip_obj, info.filename)
+        messages = convo.pop("messages", [])
+    senders, timestamps, reactors, reacted, reaction_times = [], [], [], [], []
+    for msg in messages:
+        senders.append(msg.get("sender_name"))
+        timestamps.append(msg["timestamp_ms"])
+        for reaction in msg.get("reactions", ()):
+            reactors.append(reaction)
+            reacted.append(msg.get("sender_name"))
+            reaction_times.append(msg["timestamp_ms"])
+    days = day_sketch(senders, timestamps, reactors, reacted, reaction_times)
+    return manifest_entry(info, convo, timestamps, days)
+
+
+def new_manifest(zip_path, zip_obj, entries):
+    """ Puts the manifest together from the conversation entries """
+    dropout = [name for name in zip_obj.namelist() if classify_member(name) == "dropout"]
+    return {**zip_key(zip_path),
+            "dropout": decode_bytes(zip_obj.read(dropout[0])) if dropout else None,
+            "members": entries}
+
+
+def build_manifest(zip_path, stream_above=STREAM_ABOVE):
+    """ One pass over the zip recording thread type, participants, size and time range of each conversation """
+    with ZipFile(zip_path, "r") as zip_obj:
+        entries = [summarize_member(zip_obj, zip_obj.getinfo(name), stream_above)
+                   for name in convo_members(zip_obj)]
+        return new_manifest(zip_path, zip_obj, entries)
+
+
+def save_manifest(zip_path, manifest):
+    """ Writes the manifest next to the zip (atomically, several workers might be at it) """
+    path = manifest_path(zip_path)
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def load_manifest(zip_path):
+    """ Loads the manifest of a zip, None if there is none or the zip has changed """
+    try:
+        with open(manifest_path(zip_path), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    key = zip_key(zip_path)
+    if any(manifest.get(k) != v for k, v in key.items()):
+        return None
+    return manifest
+
+
+def get_manifest(zip_path, stream_above=STREAM_ABOVE):
+    """ Loads the manifest of a zip, building and saving it if needed """
+    manifest = load_manifest(zip_path)
+    if manifest is None:
+        manifest = build_manifest(zip_path, stream_above)
+        save_manifest(zip_path, manifest)
+    return manifest
+
+
+def manifest_owner(manifest):
+    """ The owner of the export is the one taking part in all the direct chats """
+    participants = Counter(name for member in manifest["members"]
+                           if member["thread_type"] == "Regular"
+                           for name in member["participants"])
+    return participants.most_common(1)[0][0] if participants else None
+
+
+def manifest_schedule(manifest):
+    """ Conversation members, largest first """
+    members = sorted(manifest["members"], key=lambda m: (m["n_messages"], m["file_size"]), reverse=True)
+    return [member["name"] for member in members]
+
+
+def manifest_size(manifest):
+    """ Total uncompressed size of the conversations in the zip """
+    return sum(member["file_size"] for member in manifest["members"])
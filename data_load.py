@@ -14,31 +14,36 @@ import os
 import shutil
 import subprocess
 import sys
+import multiprocessing
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from zipfile import ZipFile
 from collections import Counter
 from pathlib import Path
+import edge_cache
+import out_of_core
+import profiling
+from convo_dedup import dedup_plan, on_days
+from edge_index import build_index
+from group_edges import aggregate_group_edges, expand_group_edges
+from identity import hash_name, as_hash_set, hex_column, hash_column, id_replacements, resolve_ids
+from interning import (add_ids, codes_mask, id_mask, intern_ids, non_cog_mask, random_id_lookup, relabel,
+                       resolve_codes, write_ids)
+from table_store import write_table, read_table, export_csv, typed_edges
+from convo_reader import (STREAM_ABOVE, PREFETCH_DEPTH, classify_member, convo_members, prefetch_members,
+                          read_conversation, decode_bytes, iter_messages, member_digest, day_sketch,
+                          load_manifest, get_manifest,
+                          save_manifest, new_manifest, manifest_entry, manifest_owner,
+                          manifest_schedule, manifest_size)
 # In[18]:
 
 
-def hash_name(name):
-    """ simplified version (no salt) """
-    return hashlib.sha1(name.encode()).hexdigest()
-
 def hash_with_salt(s):
     """ Hashes a string with a randomly generated salt """
     salt = uuid.uuid4().hex
     return hashlib.sha512(s + salt).hexdigest()
 
 
-def check_name(hashed_name, new_name):
-    return hashed_name == hash_name(new_name)
-
-
-def is_a_cogsci(cogsci_hashes, new_name):
-    return any(check_name(hsh, new_name) for hsh in cogsci_hashes)
-
-
 def unzip_msg_files(zip_path, target_dir):
     with ZipFile(zip_path, 'r') as zipObj:
         # Get a list of all archived file names from the zip
@@ -49,22 +54,22 @@ def unzip_msg_files(zip_path, target_dir):
 
                 
 def yield_msg_files(zip_path):
-    """ Creates generator for files in zipdir """
+    """ 
+    Creates generator for files in zipdir 
+    (conversations as dicts, other files by their name)
+    """
     with ZipFile(zip_path, 'r') as zipObj:
-        # Get a list of all archived file names from the zip
-        all_files = zipObj.namelist()
-        for file in all_files:
-            with zipObj.open(file, "r") as myfile:
-                try:
-                    yield json.loads(json.load(myfile))
-                except TypeError:
-                    yield file
+        for file in zipObj.namelist():
+            if classify_member(file) == "convo":
+                yield read_conversation(zipObj, file)
+            else:
+                yield file
 
 
 def count_msg_files(zip_path):
     """Counts the number of conversations in zip-file"""
     with ZipFile(zip_path, "r") as zipObj:
-        return len(zipObj.namelist())
+        return len(convo_members(zipObj))
     
 
 def read_zip_file(zip_path, file_name):
@@ -80,10 +85,6 @@ def read_convo(file):
     """reads conversation json file to dict """
     return json.loads(read_json(file))
 
-def hash_name(name):
-    """ simplified version (no salt) """
-    return hashlib.sha1(name.encode()).hexdigest()
-
 def create_group_id(groupchat):
     """creates a group id based on participant names"""
     participant_string = "".join(sorted(groupchat["participants"]))
@@ -94,116 +95,383 @@ def find_most_common(participant_list):
     return Counter(participant_list).most_common(1)[0][0]
 
 
-def add_reactions(msg, rel_list):
-    """ Appends reaction to a reaction list (preprocessing step) """
-    if "reactions" in msg.keys():
-        for reaction in msg["reactions"]:
-            reaction_dict = {"from": reaction, 
-                             "to": msg["sender_name"], 
-                             "timestamp": msg["timestamp_ms"], 
-                             "rel_type": "reaction"}
-            rel_list.append(reaction_dict)
+EDGE_COLUMNS = ["from", "to", "timestamp", "rel_type"]
+
+
+def collect_columns(messages):
+    """
+    Single pass over the messages of a conversation (a list or a stream)
+    filling plain lists (from, to, timestamp) for messages and reactions.
+    Rows coming from calls are noted, since only direct chats skip them
+    """
+    msg_from, msg_to, msg_time = [], [], []
+    react_from, react_to, react_time = [], [], []
+    call_rows, call_reaction_rows = [], []
+    for msg in messages:
+        sender = msg["sender_name"]
+        timestamp = msg["timestamp_ms"]
+        if "call_duration" in msg:
+            call_rows.append(len(msg_from))
+            if "reactions" in msg:
+                call_reaction_rows.extend(range(len(react_from), len(react_from) + len(msg["reactions"])))
+        msg_from.append(sender)
+        msg_to.append(msg.get("receiver_name"))
+        msg_time.append(timestamp)
+        for reaction in msg.get("reactions", ()):
+            react_from.append(reaction)
+            react_to.append(sender)
+            react_time.append(timestamp)
+    return ((msg_from, msg_to, msg_time), (react_from, react_to, react_time), 
+            (call_rows, call_reaction_rows))
+
+
+def drop_rows(block, rows):
+    """ Drops row numbers from a (from, to, timestamp) block """
+    rows = set(rows)
+    keep = [i for i in range(len(block[0])) if i not in rows]
+    return tuple([col[i] for i in keep] for col in block)
+
+
+def select_edges(columns, group_id=None):
+    """
+    (from, to, timestamp) blocks for messages and reactions from collect_columns.
+    Group chats send every message to the group id, direct chats use the
+    receiver and skip calls (same rows as the old per-cell version)
+    """
+    msgs, reactions, (call_rows, call_reaction_rows) = columns
+    if group_id is not None:
+        return (msgs[0], [group_id] * len(msgs[0]), msgs[2]), reactions
+    # the old per-cell version also dropped direct messages without a sender
+    if call_rows or None in msgs[0]:
+        no_sender = [i for i, sender in enumerate(msgs[0]) if sender is None]
+        msgs = drop_rows(msgs, call_rows + no_sender)
+    if call_reaction_rows:
+        reactions = drop_rows(reactions, call_reaction_rows)
+    return msgs, reactions
+
+
+def extract_edges(messages, group_id=None):
+    """ Message and reaction edges of a conversation (see select_edges) """
+    return select_edges(collect_columns(messages), group_id)
+
+
+def member_columns(group_convo, group_id):
+    """ participant --> group columns (timestamp is nan) """
+    participants = group_convo["participants"]
+    return list(participants), [group_id] * len(participants), [np.nan] * len(participants)
+
+
+def edge_frame(blocks):
+    """ 
+    Builds the edge dataframe once from a list of ((from, to, timestamp), rel_type) blocks 
+    """
+    froms, tos, timestamps, rel_types = [], [], [], []
+    for (block_from, block_to, block_time), rel_type in blocks:
+        froms.extend(block_from)
+        tos.extend(block_to)
+        timestamps.extend(block_time)
+        rel_types.extend([rel_type] * len(block_from))
+    return pd.DataFrame({"from": froms, "to": tos, 
+                         "timestamp": timestamps, "rel_type": rel_types}, 
+                        columns=EDGE_COLUMNS)
 
-            
             
 def create_member_edges(group_convo, group_id):
     """ 
     Create participant --> group relations for a conversation 
     NB: These will have timestamp as nan!
     """
-    return pd.DataFrame({"from": group_convo["participants"], 
-                          "to": group_id, 
-                          "timestamp": np.nan, 
-                          "rel_type": "group"})
+    return edge_frame([(member_columns(group_convo, group_id), "group")])
 
 def process_group_messages(group_convo, group_id):
     """ Create a nice dataframe with all the messages from group chat"""
     assert group_convo["thread_type"] == "RegularGroup"
-    group_msgs = pd.DataFrame(index=range(len(group_convo["messages"])), 
-                              columns=["from", "to", "timestamp", "rel_type"])
-    group_msgs = group_msgs.assign(to = group_id, rel_type = "msg")
-    rel_list = []
-    for i, msg in enumerate(group_convo["messages"]):
-        group_msgs.loc[i, "from"] = msg["sender_name"]
-        group_msgs.loc[i, "timestamp"] = msg["timestamp_ms"]
-        add_reactions(msg, rel_list)
-    return pd.concat([group_msgs, pd.DataFrame(rel_list)])
-
-def process_group_edges(group_convo):
-    """ Full pipeline for processing group chats """
+    msgs, reactions = extract_edges(group_convo["messages"], group_id)
+    return edge_frame([(msgs, "msg"), (reactions, "reaction")])
+
+def process_group_edges(group_convo, columns=None):
+    """ 
+    Full pipeline for processing group chats 
+    (columns can be passed if the messages were already collected while streaming)
+    """
+    assert group_convo["thread_type"] == "RegularGroup"
     group_id = create_group_id(group_convo)
-    group_msgs = process_group_messages(group_convo, group_id)
-    group_members = create_member_edges(group_convo, group_id)
-    return pd.concat([group_msgs, group_members]).reset_index(drop=True)
+    if columns is None:
+        columns = collect_columns(group_convo["messages"])
+    msgs, reactions = select_edges(columns, group_id)
+    members = member_columns(group_convo, group_id)
+    return edge_frame([(msgs, "msg"), (reactions, "reaction"), (members, "group")])
 
 
-def process_msgs(convo):
+def process_msgs(convo, columns=None):
     """ Processes messages and returns a nice dataframe :)) """
     if len(convo["participants"]) == 1:
         return None
     assert convo["thread_type"] == "Regular"
-    msgs = pd.DataFrame(index=range(len(convo["messages"])), 
-                        columns=["from", "to", "timestamp", "rel_type"])
-    msgs = msgs.assign(rel_type = "msg")
-    rel_list = []
-    for i, msg in enumerate(convo["messages"]):
-        if "call_duration" in msg.keys():
-            continue
-        msgs.loc[i, "from"] = msg["sender_name"]
-        msgs.loc[i, "to"] = msg["receiver_name"]
-        msgs.loc[i, "timestamp"] = msg["timestamp_ms"]
-        add_reactions(msg, rel_list)
-    return pd.concat([msgs.dropna(subset=["from"])
-                            , pd.DataFrame(rel_list)])
+    if columns is None:
+        columns = collect_columns(convo["messages"])
+    msgs, reactions = select_edges(columns)
+    return edge_frame([(msgs, "msg"), (reactions, "reaction")])
 
 
 def fix_dropout_dict(data_path):    
-    """adds name to dropout dict as well as fixes key"""
-    participant_list = []
-    num_two_person = 0
-    stop = False
-    while not stop:
-        for convo in yield_msg_files(data_path):
-            is_two_person = convo["thread_type"] == "Regular"
-            if is_two_person:
-                num_two_person += 1
-                participant_list.extend(convo["participants"])      
-            if num_two_person == 2:
-                stop = True
-                break
-        
-    dropout_dict = read_zip_file(data_path, "dropout.json")
+    """adds name to dropout dict as well as fixes key (read from the zip's manifest)"""
+    manifest = get_manifest(data_path)
+    dropout_dict = dict(manifest["dropout"])
     dropout_dict["still_cogsci"] = dropout_dict.pop("is_dropout")
-    dropout_dict["name"] = find_most_common(participant_list)
+    dropout_dict["name"] = manifest_owner(manifest)
     return dropout_dict
 
 
-def process_person(data_path):
+def read_member_columns(zip_obj, file_name, stream=False, data=None, days=None):
     """
-    processes all conversations from one person 
-    (inputs path to zip-file)
+    Reads one conversation in an open zip-file (or its already read bytes), 
+    returning the conversation (without messages) and its collected columns. 
+    When streaming, messages are parsed one at a time so only the extracted 
+    columns are held in memory. With days, only the messages of those days
+    are collected (see convo_dedup.py)
     """
-    df_list = []
-    for convo in yield_msg_files(data_path):
-        if type(convo) == str:
-            continue
-        elif convo["thread_type"] == "Regular":
-            df_list.append(process_msgs(convo))
+    with profiling.stage("decode", stream=stream) as record:
+        if stream:
+            convo = {}
+            messages = iter_messages(zip_obj, file_name, convo)
+        else:
+            convo = decode_bytes(zip_obj.read(file_name) if data is None else data)
+            messages = convo.pop("messages")
+        columns = collect_columns(messages if days is None else on_days(messages, days))
+        record["rows_out"] = len(columns[0][0]) + len(columns[1][0])
+    return convo, columns
+
+
+def convo_edges(convo, columns):
+    """ Edges of a conversation from its collected columns """
+    with profiling.stage("edges", thread_type=convo["thread_type"]) as record:
+        record["rows_in"] = len(columns[0][0]) + len(columns[1][0])
+        if convo["thread_type"] == "Regular":
+            edges = process_msgs(convo, columns)
         elif convo["thread_type"] == "RegularGroup":
-            df_list.append(process_group_edges(convo))
+            edges = process_group_edges(convo, columns)
         else:
             print(convo["thread_type"])
+            edges = None
+        record["rows_out"] = 0 if edges is None else len(edges)
+    return edges
+
+
+def member_entry(info, convo, columns):
+    """ Manifest entry of a conversation from its collected columns """
+    (senders, _, timestamps), reactions, _ = columns
+    return manifest_entry(info, convo, timestamps, day_sketch(senders, timestamps, *reactions))
+
+
+# bump when the extracted edges (or their manifest entries) change, so cached conversations are redone
+EXTRACTOR_VERSION = 2
+EDGE_CACHE = Path("../edge_cache")
+
+
+def process_member(zip_obj, info, stream=False, cache=EDGE_CACHE, data=None, days=None):
+    """
+    Processes one conversation in an open zip-file (or its already read bytes),
+    returning its manifest entry and edges. With a cache directory, conversations
+    already extracted (same bytes, same EXTRACTOR_VERSION) are read from the cache instead.
+    With days only the messages of those days are extracted (not cached), and
+    the entry is of those messages
+    """
+    if cache is None or days is not None:
+        convo, columns = read_member_columns(zip_obj, info.filename, stream, data, days)
+        return member_entry(info, convo, columns), convo_edges(convo, columns)
+    
+    if data is None and not stream:
+        data = zip_obj.read(info.filename)
+    key = edge_cache.entry_key(member_digest(zip_obj, info.filename, data), EXTRACTOR_VERSION)
+    cached = edge_cache.load_entry(cache, key)
+    if cached is not None:
+        entry, edges = cached
+        entry.pop("has_edges")
+        # the same conversation can have another name in another zip
+        return {**entry, "name": info.filename, "compress_size": info.compress_size}, edges
+    convo, columns = read_member_columns(zip_obj, info.filename, stream, data)
+    entry, edges = member_entry(info, convo, columns), convo_edges(convo, columns)
+    edge_cache.save_entry(cache, key, entry, edges)
+    return entry, edges
+
+
+# inflating ahead only pays off with a core to spare for it
+PREFETCH = PREFETCH_DEPTH if (os.cpu_count() or 1) > 1 else 0
+
+
+def process_person(data_path, stream_above=STREAM_ABOVE, cache=EDGE_CACHE, prefetch=PREFETCH, keep=None):
+    """
+    processes all conversations from one person 
+    (inputs path to zip-file). Conversations bigger than stream_above bytes 
+    (uncompressed) are streamed, so memory doesn't grow with the biggest group chat.
+    Conversations found in the cache (a directory, None to turn it off) aren't redone.
+    The next prefetch conversations are inflated on background threads while
+    one is parsed (0 reads them one at a time, see prefetch_members).
+    keep is the zip's part of a convo_dedup plan: conversations to skip or to
+    extract on some days only (it's ignored if the zip has changed since).
+    The zip's manifest is written along the way if it is missing
+    """
+    with profiling.stage("person", person=Path(data_path).name) as person_record:
+        manifest = load_manifest(data_path)
+        df_list = []
+        entries = []
+        with profiling.stage("zip_open") as record:
+            zipObj = ZipFile(data_path, "r")
+            record["bytes"] = os.path.getsize(data_path)
+        with zipObj:
+            file_names = convo_members(zipObj) if manifest is None else manifest_schedule(manifest)
+            if manifest is None or keep is None:
+                keep = {}
+            # copies extracted from another zip are left out ([] in the plan)
+            file_names = [file_name for file_name in file_names if keep.get(file_name) != []]
+            if prefetch:
+                members = prefetch_members(data_path, file_names, stream_above, prefetch)
+            else:
+                members = ((file_name, None) for file_name in file_names)
+            for file_name, data in members:
+                info = zipObj.getinfo(file_name)
+                stream = stream_above is not None and info.file_size > stream_above
+                with profiling.stage("conversation", member=file_name) as record:
+                    days = keep.get(file_name)
+                    entry, edges = process_member(zipObj, info, stream, cache, data,
+                                                  None if days is None else set(days))
+                    record.update(thread_type=entry["thread_type"], bytes=info.file_size,
+                                  rows_in=entry["n_messages"], rows_out=0 if edges is None else len(edges))
+                entries.append(entry)
+                df_list.append(edges)
+            if manifest is None:
+                save_manifest(data_path, new_manifest(data_path, zipObj, entries))
+        with profiling.stage("concat") as record:
+            try:
+                person_df = pd.concat(df_list)
+            except ValueError:
+                person_df = None
+            record["rows_out"] = person_record["rows_out"] = 0 if person_df is None else len(person_df)
+    return person_df
+
+
+# each worker holds a decoded zip (1-3 GB on the real cohort) and its edge frames,
+# so not one per core by default (the driver sets it)
+N_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def can_fork():
+    """ 
+    Checks whether worker processes can be forked. Forking lets the pool use the
+    functions defined here, also when running the cells in a notebook
+    """
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def ingest_pool(n_workers):
+    """ Process pool for the ingest stage """
+    return ProcessPoolExecutor(max_workers=n_workers, 
+                               mp_context=multiprocessing.get_context("fork"))
+
+
+def zip_workload(data_path):
+    """ 
+    Uncompressed size of the conversations in a zip, from its manifest if 
+    there is one (0 if the zip is missing) 
+    """
+    try:
+        manifest = load_manifest(data_path)
+        if manifest is not None:
+            return manifest_size(manifest)
+        with ZipFile(data_path, "r") as zipObj:
+            return sum(zipObj.getinfo(name).file_size for name in convo_members(zipObj))
+    except FileNotFoundError:
+        return 0
+
+
+def try_process_person(data_path, spill_path=None, keep=None):
+    """ 
+    process_person, but returns None if the zip has gone missing. With a 
+    spill_path the edges are written there as a table and the path is returned
+    """
     try:
-        return pd.concat(df_list)
-    except ValueError:
+        person_df = process_person(data_path, keep=keep)
+    except FileNotFoundError:
+        print(f"no file here: {data_path}")
         return None
+    if spill_path is None or person_df is None:
+        return person_df
+    write_table(typed_edges(person_df), spill_path)
+    return spill_path
 
 
-def create_dropout_df(data_paths):
+def spill_path(spill_dir, i):
+    """ Where person i's edges are spilled, None if they're kept in memory """
+    return None if spill_dir is None else Path(spill_dir) / f"person_{i:05d}.cols"
+
+
+def process_people(data_paths, data_list, n_workers=N_WORKERS, spill_dir=None, plan=None):
+    """
+    Processes the zips whose entry in data_list is still None (in place), 
+    spread across n_workers processes. data_list keeps the order of data_paths,
+    so rerunning only retries the ones that failed. With a spill_dir the edges
+    are written there per person (parts for out_of_core.py) and data_list gets their paths.
+    With a plan (conversation_plan) conversations in several zips are extracted from one
+    """
+    if spill_dir is not None:
+        Path(spill_dir).mkdir(parents=True, exist_ok=True)
+    plan = {} if plan is None else plan
+    todo = [i for i, df in enumerate(data_list) if df is None]
+    # biggest zips first so one huge export doesn't end up last
+    todo.sort(key=lambda i: zip_workload(data_paths[i]), reverse=True)
+    if n_workers is None or n_workers <= 1 or len(todo) <= 1 or not can_fork():
+        for i in todo:
+            print(f"processing person {i+1} out of {len(data_paths)}...")
+            data_list[i] = try_process_person(data_paths[i], spill_path(spill_dir, i), plan.get(str(data_paths[i])))
+        return data_list
+    
+    failed = []
+    with ingest_pool(min(n_workers, len(todo))) as pool:
+        futures = {pool.submit(try_process_person, data_paths[i], spill_path(spill_dir, i),
+                               plan.get(str(data_paths[i]))): i
+                   for i in todo}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                data_list[i] = future.result()
+            except Exception as e:
+                failed.append(i)
+                print(f"person {i+1} failed: {e!r}")
+                continue
+            print(f"processed person {i+1} ({n_done} out of {len(todo)})...")
+    if failed:
+        print(f"{len(failed)} people failed, rerun to retry them")
+    return data_list
+
+
+def conversation_plan(data_paths):
+    """
+    Which conversations to extract from which zip, so each is only extracted
+    once (convo_dedup.dedup_plan over the manifests). Only zips that already
+    have a manifest are planned: building one decodes the whole zip, which
+    costs more than the copies save, so a zip without one is extracted whole
+    and gets its manifest on the way (and is planned on the next run).
+    Prints how much is left out
+    """
+    manifests = [load_manifest(data_path) for data_path in data_paths]
+    planned = [(data_path, manifest) for data_path, manifest in zip(data_paths, manifests) if manifest is not None]
+    with profiling.stage("dedup_plan") as record:
+        plan, report = dedup_plan([data_path for data_path, _ in planned], [manifest for _, manifest in planned])
+        record.update(report)
+    print(f"{len(planned)} of {len(data_paths)} zips planned: {report['skipped']} of {report['members']} "
+          f"conversation files are copies, {report['partial']} more are partly; "
+          f"{report['dedup_rate']:.1%} of the messages are left out")
+    return plan
+
+
+def create_dropout_df(data_paths, n_workers=N_WORKERS):
     """Full pipeline for creating df with from the dropout.json """
-    dropout_list = [None for _ in range(len(data_paths))]
-    for i, data_path in enumerate(data_paths):
-        dropout_list[i] = fix_dropout_dict(data_path)
+    if n_workers is None or n_workers <= 1 or not can_fork():
+        dropout_list = [fix_dropout_dict(data_path) for data_path in data_paths]
+    else:
+        with ingest_pool(min(n_workers, max(len(data_paths), 1))) as pool:
+            dropout_list = list(pool.map(fix_dropout_dict, data_paths))
     return pd.DataFrame(dropout_list)
 
 def anonymize_filename(data_path):
@@ -218,69 +486,68 @@ def anonymize_folder(data_folder):
     for file in problem_paths:
         anonymize_filename(file)
         
-def find_unique_ids(cogscis, full_df):
-    """ Returns unique ids (groups and people) for filtering"""
-    unique_people = pd.Series(cogscis).unique()
-    unique_groups = full_df.loc[full_df["rel_type"] == "group", "to"].unique()
-    return set(np.concatenate((unique_people, unique_groups)))
+def interned(full_df, ids):
+    """ The edges with interned ids (interning.py) and their ids, interning them first if ids is None """
+    return (full_df, ids) if ids is not None else intern_ids(full_df)
+
+
+def find_unique_ids(cogscis, full_df, ids):
+    """ Mask of the ids (groups and people) kept by filter_consent, over the codes of full_df """
+    is_group = (full_df["rel_type"] == "group").to_numpy()
+    unique_ids = id_mask(ids, cogscis)
+    unique_ids[full_df["to"].to_numpy()[is_group]] = True
+    return unique_ids
 
 
 def load_cog_hash():
     """Loads the pickled cogsci hash file (should be in parent dir)"""
     with open(Path("../cogsci19_2.pkl"), "rb") as cog:
-        return pickle.load(cog)
+        return as_hash_set(pickle.load(cog))
     
     
-def find_non_cogs(full_df):
-    """Finds ids not recognized by the cogsci hash """
-    cogs = load_cog_hash()
-    non_cog_df = full_df[~full_df["from"].isin(cogs)]
-    non_cog_groups = non_cog_df.loc[non_cog_df["rel_type"] == "group", "to"].unique()
-    return set(np.concatenate((non_cog_df["from"], non_cog_groups)))
-
-
-def remove_non_cogs(full_df):
-    """ Remove all people not recognized by their cogsci hash"""
-    all_non_cogs = find_non_cogs(full_df)
-    non_cog_filter = ~(unique_master["to"].isin(all_non_cogs) | unique_master["from"].isin(all_non_cogs))
+def find_non_cogs(full_df, ids, cogs=None):
+    """Mask of the ids not recognized by the cogsci hash (and their groups), over the codes of full_df """
+    cogs = load_cog_hash() if cogs is None else cogs
+    is_group = (full_df["rel_type"] == "group").to_numpy()
+    from_codes, to_codes = full_df["from"].to_numpy(), full_df["to"].to_numpy()
+    return non_cog_mask(from_codes, from_codes[is_group], to_codes[is_group], id_mask(ids, cogs))
+
+
+def remove_non_cogs(full_df, ids=None, cogs=None):
+    """ Remove all people not recognized by their cogsci hash (ids as in filter_consent) """
+    edges, ids = interned(full_df, ids)
+    all_non_cogs = find_non_cogs(edges, ids, cogs)
+    non_cog_filter = ~(all_non_cogs[edges["to"].to_numpy()] | all_non_cogs[edges["from"].to_numpy()])
     return full_df[non_cog_filter]
 
 
-def filter_consent(full_df, dropout_df):
-    """ Filters so only people we have data / consent from """
-    unique_ids = find_unique_ids(dropout_df, full_df)
-    consenting_filter = full_df["from"].isin(unique_ids) & full_df["to"].isin(unique_ids)
-    return full_df[consenting_filter]
+def filter_consent(full_df, dropout_df, ids=None):
+    """ 
+    Filters so only people we have data / consent from. With ids the id 
+    columns of full_df are codes into it, otherwise they're interned here 
+    """
+    with profiling.stage("consent_filter", rows_in=len(full_df)) as record:
+        edges, ids = interned(full_df, ids)
+        unique_ids = find_unique_ids(dropout_df, edges, ids)
+        consenting_filter = unique_ids[edges["from"].to_numpy()] & unique_ids[edges["to"].to_numpy()]
+        consent_df = full_df[consenting_filter]
+        record["rows_out"] = len(consent_df)
+    return consent_df
 
 def calc_group_sizes(df):
     """ Finds the size of each groupchat in the df """
     return df[df["rel_type"] == "group"].groupby("to")["from"].agg("count")
 
 
-def find_hex(s):
-    """ Checks whether names are valid hashes """
-    try:
-        int(s, 16)
-        return True
-    except ValueError:
-        return False
-    
-
 def add_hash_check(df):
     """ Adds columns to the df checking which names are hashed """
-    return df.assign(from_hex = df["from"].apply(lambda x: find_hex(x)),
-                     to_hex = df["to"].apply(lambda x: find_hex(x)))
+    return df.assign(from_hex = hex_column(df["from"]),
+                     to_hex = hex_column(df["to"]))
 
 def hash_plaintext(df):
     """ hash names that haven't been hashed"""
-    df.loc[~df["from_hex"], "from"] = df.loc[~df["from_hex"], "from"].apply(lambda x: hash_name(x))
-    df.loc[~df["to_hex"], "to"] = df.loc[~df["to_hex"], "to"].apply(lambda x: hash_name(x))
-    
-
-def fix_vero(df):
-    """ Fixes weird vero bug """
-    df.loc[df["from"] == "Verus Juhasz", "from"] = hash_name("Verus Juhasz")
-    df.loc[df["to"] == "Verus Juhasz", "to"] = hash_name("Verus Juhasz")
+    df["from"] = hash_column(df["from"])
+    df["to"] = hash_column(df["to"])
 
 
 def calculate_group_weights(group_sizes):
@@ -294,10 +561,11 @@ def create_random_ids(id_tuple):
     random_id = np.random.choice(range(len(unique_ids)), size=len(unique_ids), replace=False)
     return {k: v for k, v in zip(list(unique_ids), random_id)}
 
-def repeat_data(weighted_data, weight_col="weight"):
-    """ Repeat each row n times where n is described by the weight_col"""
-    return pd.DataFrame(weighted_data.values.repeat(weighted_data[weight_col], axis=0), 
-                        columns=weighted_data.columns)
+
+def create_random_lookup(code_tuple, n_ids):
+    """ create_random_ids on codes: a lookup giving every code in the tuple a random id (-1 for the others) """
+    return random_id_lookup(codes_mask(np.concatenate(code_tuple), n_ids))
+
 
 def group_weight_pipe(df):
     """ Creates a df with index of group ids and a column with msg weights + series with group sizes"""
@@ -320,36 +588,92 @@ def clean_merged_group(group_merge):
     """ Cleans up the merged group dataframe, renaming and dropping nans"""
     return group_merge.assign(to_person=group_merge["from_y"].combine_first(group_merge["to"]))[["from_x", "to_person", "timestamp", "rel_type", "weight"]]            .rename({"from_x": "from", "to_person":"to"}, axis=1)            .replace([np.inf, -np.inf], np.nan)            .dropna()
 
-def pathpy_pipeline(df):
-    """ Full pipeline for getting dataframe in Pathpy friendly format"""
-    weighted_group = add_group_weights(df)
-    merged_group = merge_group_members(df, weighted_group)
-    final_merge = clean_merged_group(merged_group)
-    repeated_data = repeat_data(final_merge)
-    return repeated_data[["from", "to", "timestamp"]]
+TEMPORAL_KEYS = ["from", "to", "timestamp"]
+PATHPY_COLUMNS = {"from": "source", "to": "target", "timestamp": "time"}
+
+
+def aggregate_temporal_edges(chunks):
+    """
+    Sums weight and counts messages per distinct (from, to, timestamp) over 
+    chunks of exploded edges, so only the distinct edges are kept in memory
+    """
+    partial = None
+    for chunk in chunks:
+        agg = chunk.groupby(TEMPORAL_KEYS, observed=True)["weight"].agg(weight="sum", count="size")
+        partial = agg if partial is None else pd.concat([partial, agg]).groupby(level=TEMPORAL_KEYS).sum()
+    if partial is None:
+        return pd.DataFrame(columns=TEMPORAL_KEYS + ["weight", "count"])
+    tedges = typed_edges(partial.reset_index())
+    return tedges.sort_values("timestamp", kind="stable").reset_index(drop=True)
 
 
-def tidy_pipeline(df):
-    """ Full pipeline for tidyverse data """
+def pathpy_pipeline(df, chunksize=500_000):
+    """ 
+    Full pipeline for getting dataframe in Pathpy friendly format: 
+    temporal edges with their multiplicity as weight (sum of message weights) 
+    and count (number of messages) instead of repeated rows
+    """
     weighted_group = add_group_weights(df)
-    merged_group = merge_group_members(df, weighted_group)
-    final_merge = clean_merged_group(merged_group)
-    return final_merge[["from", "to", "timestamp", "weight"]]
-    
+    chunks = (clean_merged_group(merge_group_members(df, weighted_group.iloc[start:start + chunksize]))
+              for start in range(0, len(weighted_group), chunksize))
+    return aggregate_temporal_edges(chunks)
 
 
-# In[3]:
+def write_temporal_edges(tedges, path, chunksize=1_000_000):
+    """ Streams weighted temporal edges to csv (source,target,time,weight,count) """
+    tedges.rename(columns=PATHPY_COLUMNS).to_csv(path, index=False, chunksize=chunksize)
 
 
-DATA_DIR = Path("./data")
-anonymize_folder(DATA_DIR)
-data_paths = list(DATA_DIR.glob("*.zip"))
+def write_expanded_edges(tedges, path, scale=None, chunksize=100_000):
+    """
+    Exact integer expansion (one row per observation) for tools without weights.
+    Each edge is repeated count times, or round(weight * scale) times if a scale 
+    is given (the lcm of the group sizes minus one makes every weight an integer).
+    Written chunk by chunk, so the expansion is never held in memory
+    """
+    if scale is None:
+        repeats = tedges["count"].to_numpy(np.int64)
+    else:
+        repeats = np.rint(tedges["weight"].to_numpy(np.float64) * scale).astype(np.int64)
+    columns = tedges[TEMPORAL_KEYS].rename(columns=PATHPY_COLUMNS)
+    with open(path, "w", newline="") as f:
+        for start in range(0, len(tedges), chunksize):
+            chunk = columns.iloc[start:start + chunksize]
+            rows = np.repeat(np.arange(len(chunk)), repeats[start:start + chunksize])
+            chunk.iloc[rows].to_csv(f, index=False, header=start == 0)
+
+
+def tidy_pipeline(df, aggregate=False, bucket=None):
+    """ 
+    Full pipeline for tidyverse data: group messages are sent to every member
+    (see group_edges.py, same rows as merging the members in). With aggregate,
+    the weight and count are summed per pair and time bucket (e.g. "1D", None
+    for the exact timestamps) without expanding the group messages
+    """
+    with profiling.stage("tidy_pipeline", rows_in=len(df), aggregate=aggregate) as record:
+        tidy_df = aggregate_group_edges(df, bucket) if aggregate else expand_group_edges(df)
+        record["rows_out"] = len(tidy_df)
+    return tidy_df
+    
 
 
-# In[4]:
+# In[3]:
 
 
-dropout_df = create_dropout_df(data_paths)
+DATA_DIR = Path("./data")
+# stage timings are appended here when set (python profiling.py ../profile.jsonl for a summary)
+PROFILE_PATH = None
+if PROFILE_PATH is not None:
+    profiling.enable(PROFILE_PATH)
+# for more edges than fit in memory: spilled per person and deduplicated, filtered
+# and expanded in chunks of at most MAX_MEMORY bytes (see out_of_core.py)
+OUT_OF_CORE = False
+MAX_MEMORY = out_of_core.MAX_MEMORY
+SPILL_DIR = Path("../spill") if OUT_OF_CORE else None
+# ingest processes, each holds a decoded zip and its edges: more only where the memory allows it
+N_WORKERS = min(4, os.cpu_count() or 1)
+anonymize_folder(DATA_DIR)
+data_paths = sorted(DATA_DIR.glob("*.zip"))
 
 
 # In[5]:
@@ -361,73 +685,79 @@ data_list = [None for _ in range(len(data_paths))]
 # In[11]:
 
 
-for i, data_path in enumerate(data_paths):
-    if data_list[i] is None:
-        print(f"processing person {i+1} out of {len(data_paths)}...")
-        try:
-            data_list[i] = process_person(data_path)
-        except FileNotFoundError:
-            print("no file here")
-            continue
+# conversations that are in several exports are only extracted from one (see convo_dedup.py),
+# planned from the manifests written by earlier runs
+DEDUP_CONVERSATIONS = True
+plan = conversation_plan(data_paths) if DEDUP_CONVERSATIONS else None
+process_people(data_paths, data_list, n_workers=N_WORKERS, spill_dir=SPILL_DIR, plan=plan)
 print("all done!")
 
 
-# In[5]:
+# In[4]:
 
 
-replacement_dict = {hash_name("Lasse Hyldig Hansen"): [hash_name("Lasse Hansen")],
-                    hash_name("Pernille HÃ¸jlund Brams"): [hash_name("Pernille Brams")],
-                    hash_name("Tobias GrÃ¸nhÃ¸i Hansen"): [hash_name("Tobias Hansen")]}
+# reads the manifests written while processing
+dropout_df = create_dropout_df(data_paths, n_workers=N_WORKERS)
 
 
 # In[12]:
 
 
-master_df = pd.concat(data_list)
-unique_master = master_df.drop_duplicates()
-unique_master.to_csv(Path("../full_mess.csv"), index=False)
-
-
-# In[6]:
-
+if OUT_OF_CORE:
+    out_of_core.dedup_parts(SPILL_DIR, Path("../full_mess.parts"), MAX_MEMORY)
+    random_replacement_dict = out_of_core.consent_parts(Path("../full_mess.parts"), "raw_consensual.parts",
+                                                        dropout_df["name"], load_cog_hash(), MAX_MEMORY)
+    dropout_df.replace(random_replacement_dict, inplace=True)
+    dropout_df.to_csv("dropout_dat.csv", index=False)
+    out_of_core.tidy_parts("raw_consensual.parts", "tidy_data.parts", MAX_MEMORY)
+else:
+    with profiling.stage("concat_people") as record:
+        master_df = pd.concat(data_list)
+        record["rows_out"] = len(master_df)
+    with profiling.stage("dedup", rows_in=len(master_df)) as record:
+        unique_master = master_df.drop_duplicates()
+        record["rows_out"] = len(unique_master)
+    write_table(typed_edges(unique_master), Path("../full_mess.cols"))
+
+    # from here on ids are int32 codes into ids (kept in ../ids.cols, see interning.py)
+    unique_master, ids = intern_ids(read_table(Path("../full_mess.cols")))
+    # aliases and plaintext names are listed in identity.py
+    ids, resolved_codes = resolve_codes(ids, id_replacements())
+    unique_master = relabel(unique_master, resolved_codes)
+    ids = add_ids(ids, dropout_df["name"])
+    write_ids(ids, Path("../ids.cols"))
+
+    cog_df = remove_non_cogs(unique_master, ids)
+    write_table(typed_edges(cog_df), Path("../cog_raw.cols"))
+    cog_df = read_table(Path("../cog_raw.cols"))
+    consent_df = filter_consent(cog_df, dropout_df["name"], ids)
+
+    dropout_codes = ids.get_indexer(dropout_df["name"])
+    random_lookup = create_random_lookup((consent_df["from"], consent_df["to"], dropout_codes), len(ids))
+    consent_df = relabel(consent_df, random_lookup)
+    dropout_df["name"] = random_lookup[dropout_codes]
+    dropout_df.to_csv("dropout_dat.csv", index=False)
+    write_table(typed_edges(consent_df), "raw_consensual.cols")
+
+    consent_df = read_table("raw_consensual.cols")
+    tidy_df = tidy_pipeline(consent_df)
+    write_table(typed_edges(tidy_df), "tidy_data.cols")
 
-unique_master = pd.read_csv(Path("../full_mess.csv"))
-unique_master = unique_master.replace(replacement_dict)
-fix_vero(unique_master)
-
-
-# In[7]:
-
-
-cog_df = remove_non_cogs(unique_master)
-cog_df.to_csv(Path("../cog_raw.csv"), index=False)
-cog_df = pd.read_csv(Path("../cog_raw.csv"))
-consent_df = filter_consent(cog_df, dropout_df["name"])
-
-
-# In[8]:
-
-
-random_replacement_dict = create_random_ids((consent_df["from"], consent_df["to"], dropout_df["name"]))
-consent_df.replace(random_replacement_dict, inplace=True)
-dropout_df.replace(random_replacement_dict, inplace=True)
-dropout_df.to_csv("dropout_dat.csv", index=False)
 
 # In[10]:
 
 
-consent_df.to_csv("raw_consensual.csv", index=False)
-
-
-# In[6]:
-
-
-consent_df = pd.read_csv("raw_consensual.csv")
-# In[36]:
-
-
-tidy_df = tidy_pipeline(consent_df)
-tidy_df.to_csv("tidy_data.csv", index=False)
+if OUT_OF_CORE:
+    out_of_core.export_parts_csv("raw_consensual.parts", "raw_consensual.csv")
+    out_of_core.export_parts_csv("tidy_data.parts", "tidy_data.csv")
+    # the index is one table, it's built from all the parts at once
+    tidy_df = out_of_core.read_parts("tidy_data.parts")
+else:
+    export_csv("raw_consensual.cols", "raw_consensual.csv")
+    export_csv("tidy_data.cols", "tidy_data.csv")
+    tidy_df = read_table("tidy_data.cols")
+# sorted by time for slicing by window, person or pair (edge_index.open_index)
+build_index(tidy_df, "tidy_index.cols")
 
 #cogs.add(hash_name("Cecilie Stilling Pedersen"))
 #cogs.add(hash_name("Alba Herrero"))
@@ -438,6 +768,8 @@ tidy_df.to_csv("tidy_data.csv", index=False)
 # In[ ]:
 
 
-#pathpy_df = pathpy_pipeline(consent_df)
+consent_df = out_of_core.read_parts("raw_consensual.parts") if OUT_OF_CORE else read_table("raw_consensual.cols")
+pathpy_df = pathpy_pipeline(consent_df)
+write_temporal_edges(pathpy_df, "pathpy_edges.csv")
 
 
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of the edges extracted from each conversation.
+
+Entries are keyed on a hash of the conversation's bytes plus the extractor
+version, so rerunning the ingest (after a crash or with a new participant)
+only extracts conversations it hasn't seen. Each entry is a compressed .npz
+with integer-coded names and rel_types.
+
+    python edge_cache.py report ../edge_cache
+    python edge_cache.py clean ../edge_cache --max-size 2GB --older-than 30
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REL_TYPES = ["msg", "reaction", "group"]
+EDGE_COLUMNS = ["from", "to", "timestamp", "rel_type"]
+
+
+def entry_key(member_digest, extractor_version):
+    """ Cache key of a conversation: its content hash plus the extractor version """
+    return hashlib.sha1(f"{member_digest}:{extractor_version}".encode()).hexdigest()
+
+
+def entry_path(cache_dir, key):
+    """ Entries are spread over subdirectories by the first two characters of the key """
+    return Path(cache_dir) / key[:2] / f"{key}.npz"
+
+
+def frame_arrays(df):
+    """ Compact arrays for an edge dataframe (names are factorized) """
+    codes, names = pd.factorize(np.concatenate([df["from"].to_numpy(object), df["to"].to_numpy(object)]))
+    return {"names": np.asarray(names, dtype=str),
+            "from": codes[:len(df)].astype(np.int32),
+            "to": codes[len(df):].astype(np.int32),
+            "timestamp": df["timestamp"].to_numpy(),
+            "rel_type": pd.Categorical(df["rel_type"], categories=REL_TYPES).codes}
+
+
+def arrays_frame(arrays):
+    """ Edge dataframe from the arrays of frame_arrays """
+    # code -1 (missing name) picks the trailing None
+    names = np.append(arrays["names"].astype(object), None)
+    return pd.DataFrame({"from": names[arrays["from"]],
+                         "to": names[arrays["to"]],
+                         "timestamp": arrays["timestamp"],
+                         "rel_type": np.array(REL_TYPES + [None], dtype=object)[arrays["rel_type"]]},
+                        columns=EDGE_COLUMNS)
+
+
+def save_entry(cache_dir, key, meta, df):
+    """ Stores the edges (None for conversations without any) and meta data of a conversation """
+    path = entry_path(cache_dir, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    arrays = {} if df is None else frame_arrays(df)
+    meta = {**meta, "has_edges": df is not None}
+    temp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+    np.savez_compressed(temp_path, meta=np.array(json.dumps(meta, ensure_ascii=False)), **arrays)
+    os.replace(temp_path, path)
+
+
+def load_entry(cache_dir, key):
+    """ (meta, edges) of a cached conversation, None if it isn't cached """
+    path = entry_path(cache_dir, key)
+    try:
+        with np.load(path) as npz:
+            meta = json.loads(str(npz["meta"]))
+            df = arrays_frame(npz) if meta["has_edges"] else None
+    except (FileNotFoundError, ValueError, KeyError, OSError):
+        return None
+    # mtime marks the last use, for evicting
+    os.utime(path)
+    return meta, df
+
+
+def cache_entries(cache_dir):
+    """ Dataframe with path, size and last use of every entry """
+    paths = list(Path(cache_dir).glob("*/*.npz"))
+    stats = [path.stat() for path in paths]
+    return pd.DataFrame({"path": paths,
+                         "bytes": [stat.st_size for stat in stats],
+                         "last_used": [stat.st_mtime for stat in stats]})
+
+
+def cache_report(cache_dir):
+    """ Number of entries and total size of the cache """
+    entries = cache_entries(cache_dir)
+    return {"entries": len(entries), "bytes": int(entries["bytes"].sum())}
+
+
+def evict(cache_dir, max_bytes=None, older_than_days=None):
+    """
+    Removes entries not used for older_than_days and then the least recently used
+    ones until the cache is at most max_bytes. Returns the number of removed entries
+    """
+    entries = cache_entries(cache_dir).sort_values("last_used", ascending=False)
+    remove = np.zeros(len(entries), dtype=bool)
+    if older_than_days is not None:
+        remove |= (entries["last_used"] < time.time() - older_than_days * 86400).to_numpy()
+    if max_bytes is not None:
+        remove |= (entries["bytes"].where(~remove, 0).cumsum() > max_bytes).to_numpy()
+    for path in entries.loc[remove, "path"]:
+        path.unlink(missing_ok=True)
+    for directory in Path(cache_dir).glob("*/"):
+        if directory.is_dir() and not any(directory.iterdir()):
+            directory.rmdir()
+    return int(remove.sum())
+
+
+def parse_size(size):
+    """ '2GB' -> 2 * 1024**3 """
+    units = {"KB": 2**10, "MB": 2**20, "GB": 2**30, "TB": 2**40}
+    size = size.strip().upper()
+    for unit, factor in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(size.rstrip("B"))
+
+
+def format_size(n_bytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n_bytes < 1024:
+            return f"{n_bytes:.1f}{unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f}TB"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clean the edge cache")
+    parser.add_argument("command", choices=["report", "clean"])
+    parser.add_argument("cache_dir", nargs="?", default="../edge_cache")
+    parser.add_argument("--max-size", help="e.g. 2GB, least recently used entries go first")
+    parser.add_argument("--older-than", type=float, help="remove entries unused for this many days")
+    args = parser.parse_args()
+    if args.command == "clean":
+        max_bytes = None if args.max_size is None else parse_size(args.max_size)
+        removed = evict(args.cache_dir, max_bytes, args.older_than)
+        print(f"removed {removed} entries")
+    report = cache_report(args.cache_dir)
+    print(f"{report['entries']} entries, {format_size(report['bytes'])}")
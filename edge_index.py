@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Time-indexed tidy edges, for taking time slices without scanning the table.
+
+build_index sorts the tidy_pipeline output by timestamp (int64 epoch ms)
+once and stores it as a table_store table, with the offsets in its index/:
+
+    <unit>_starts, <unit>_offsets   start of every day, week (sunday, like lubridate), month
+                                    and year from the first to the last edge, and its first row
+    node_rows, node_offsets         rows of each person (sender or receiver), in time order
+    pair_keys, pair_rows,           rows of each pair (either direction), in time order
+    pair_offsets
+    nodes.cols                      the people the node codes stand for
+
+open_index memory-maps it. A [t0, t1) window is two binary searches on the
+timestamps and slices of the memory-mapped columns (no copy, no parsing).
+As rows are in time order, a person's or pair's rows in [t0, t1) are the
+ones between the window's first and last row: two more binary searches in
+its rows. Edges without a timestamp (or people) are left out.
+
+    index = open_index("tidy_index.cols")
+    march = index.window("2020-03-01", "2020-04-01")
+    for start, week in index.periods("week"): ...
+    index.node(name, "2020-03-13"), index.pair(a, b, columns=["timestamp", "weight"])
+
+    python edge_index.py tidy_data.cols tidy_index.cols
+"""
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from node_metrics import _unit_bounds
+from table_store import read_schema, read_table, typed_edges, write_table
+
+UNITS = ["day", "week", "month", "year"]
+INDEX_DIR = "index"
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+_STEPS = {"day": np.timedelta64(1, "D"), "week": np.timedelta64(7, "D"),
+          "month": np.timedelta64(1, "M"), "year": np.timedelta64(1, "Y")}
+
+
+def epoch_ms(t):
+    """ Epoch ms of a timestamp given as ms (int or float), a string or anything pd.Timestamp takes (naive is UTC) """
+    if t is None or isinstance(t, (int, np.integer)):
+        return t
+    # pd.Timestamp takes numbers as ns, the csvs have ms as floats (1597412375331.0)
+    if isinstance(t, (float, np.floating)):
+        return int(round(t))
+    t = pd.Timestamp(t)
+    if t.tzinfo is not None:
+        t = t.tz_convert("UTC").tz_localize(None)
+    return (t - pd.Timestamp(0)) // pd.Timedelta(milliseconds=1)
+
+
+def period_starts(timestamps, unit):
+    """ Start (epoch ms) of every unit from the one of the first timestamp to the one of the last (sorted) """
+    if not len(timestamps):
+        return np.empty(0, dtype=np.int64)
+    first, _ = _unit_bounds(timestamps[:1], unit)
+    last, _ = _unit_bounds(timestamps[-1:], unit)
+    if unit in ("month", "year"):
+        # calendar units are counted in their own resolution
+        resolution = "M" if unit == "month" else "Y"
+        starts = np.arange(first[0].astype(f"datetime64[{resolution}]"),
+                           last[0].astype(f"datetime64[{resolution}]") + 1)
+    else:
+        starts = np.arange(first[0], last[0] + 1, _STEPS[unit])
+    return starts.astype("datetime64[ms]").astype(np.int64)
+
+
+def node_codes(df):
+    """ from/to as codes into the people (categoricals keep their codes, ids are factorized) and the people """
+    if isinstance(df["from"].dtype, pd.CategoricalDtype):
+        return df["from"].cat.codes.to_numpy(), df["to"].cat.codes.to_numpy(), pd.Index(df["from"].cat.categories)
+    people, codes = np.unique(np.concatenate([df["from"].to_numpy(), df["to"].to_numpy()]), return_inverse=True)
+    return codes[:len(df)], codes[len(df):], pd.Index(people)
+
+
+def grouped_rows(keys, rows, n_keys):
+    """ rows ordered by key and by row within a key (time order) and the offsets of the keys into them, CSR style """
+    offsets = np.zeros(n_keys + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n_keys), out=offsets[1:])
+    return rows[np.lexsort((rows, keys))], offsets
+
+
+def build_index(df, path, units=UNITS):
+    """ Writes the time index of a tidy edge dataframe (from, to, timestamp, ...) to path """
+    df = typed_edges(df)
+    df = df[(df["timestamp"].notna() & df["from"].notna() & df["to"].notna()).to_numpy()]
+    df = df.assign(timestamp=df["timestamp"].astype(np.int64))
+    df = df.iloc[np.argsort(df["timestamp"].to_numpy(), kind="stable")].reset_index(drop=True)
+    timestamps = df["timestamp"].to_numpy()
+    n = len(df)
+    arrays = {}
+    for unit in units:
+        starts = period_starts(timestamps, unit)
+        arrays[f"{unit}_starts"] = starts
+        arrays[f"{unit}_offsets"] = np.append(np.searchsorted(timestamps, starts), n)
+
+    src, dst, people = node_codes(df)
+    # a message to oneself is one of that person's rows, not two
+    other = np.flatnonzero(src != dst)
+    arrays["node_rows"], arrays["node_offsets"] = grouped_rows(np.concatenate([src, dst[other]]),
+                                                               np.concatenate([np.arange(n), other]), len(people))
+    pair_keys, pair = np.unique(np.minimum(src, dst).astype(np.int64) * len(people) + np.maximum(src, dst),
+                                return_inverse=True)
+    arrays["pair_keys"] = pair_keys
+    arrays["pair_rows"], arrays["pair_offsets"] = grouped_rows(pair.ravel(), np.arange(n), len(pair_keys))
+
+    path = Path(path)
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.index")
+    write_table(df, temp_path)
+    index_dir = temp_path / INDEX_DIR
+    index_dir.mkdir()
+    write_table(pd.DataFrame({"name": people}), index_dir / "nodes.cols")
+    for name, values in arrays.items():
+        np.save(index_dir / f"{name}.npy", values)
+    with open(index_dir / INDEX_FILE, "w", encoding="utf-8") as f:
+        json.dump({"version": INDEX_VERSION, "units": list(units), "n_rows": n,
+                   "first": int(timestamps[0]) if n else None, "last": int(timestamps[-1]) if n else None}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp_path, path)
+
+
+class EdgeIndex:
+    """
+    A time index opened memory-mapped. Times (t0, t1) are epoch ms or anything
+    pd.Timestamp takes, None leaves that end open. Frames come back like
+    read_table's (columns=[...] to load only some)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        index_dir = self.path / INDEX_DIR
+        with open(index_dir / INDEX_FILE, encoding="utf-8") as f:
+            self.info = json.load(f)
+        if self.info["version"] != INDEX_VERSION:
+            raise ValueError(f"{path} is a version {self.info['version']} index, rebuild it with build_index")
+        self.people = pd.Index(read_table(index_dir / "nodes.cols", mmap=False, categorical=False)["name"])
+        self.arrays = {file.stem: np.load(file, mmap_mode="r") for file in index_dir.glob("*.npy")}
+        self.schema = {entry["name"]: entry for entry in read_schema(self.path)["columns"]}
+        self.columns = {column: np.load(self.path / f"{column}.npy", mmap_mode="r") for column in self.schema}
+        self.timestamps = self.columns["timestamp"]
+        self.dtypes = {column: pd.CategoricalDtype(entry["categories"])
+                       for column, entry in self.schema.items() if entry["kind"] == "categorical"}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def rows(self, t0=None, t1=None):
+        """ The rows in [t0, t1) as a slice """
+        low = 0 if t0 is None else int(np.searchsorted(self.timestamps, epoch_ms(t0)))
+        high = len(self) if t1 is None else int(np.searchsorted(self.timestamps, epoch_ms(t1)))
+        return slice(low, max(low, high))
+
+    def take(self, rows, columns=None, categorical=True):
+        """
+        The rows of the columns as a dataframe. A slice of rows gives views of
+        the memory-mapped columns, an array of rows copies them
+        """
+        data = {}
+        for column in list(self.schema) if columns is None else columns:
+            entry = self.schema[column]
+            values = self.columns[column][rows]
+            if entry["kind"] == "categorical":
+                values = pd.Categorical.from_codes(values, dtype=self.dtypes[column], validate=False)
+                if not categorical:
+                    values = np.asarray(values, dtype=object)
+            elif entry["kind"] == "nullable":
+                mask = np.load(self.path / f"{column}.mask.npy", mmap_mode="r")[rows]
+                values = pd.arrays.IntegerArray(np.asarray(values), np.asarray(mask))
+            data[column] = values
+        return pd.DataFrame(data, columns=list(data), copy=False)
+
+    def window(self, t0=None, t1=None, columns=None, categorical=True):
+        """ The edges in [t0, t1) """
+        return self.take(self.rows(t0, t1), columns, categorical)
+
+    def period_offsets(self, unit):
+        """ Starts (datetime64[ms]) of the unit's periods and their first rows (one more, the end) """
+        return self.arrays[f"{unit}_starts"].astype("datetime64[ms]"), self.arrays[f"{unit}_offsets"]
+
+    def periods(self, unit, t0=None, t1=None, columns=None, categorical=True):
+        """ (start, edges) of every day, week, month or year starting in [t0, t1) with edges in it """
+        starts, offsets = self.arrays[f"{unit}_starts"], self.arrays[f"{unit}_offsets"]
+        first = 0 if t0 is None else int(np.searchsorted(starts, epoch_ms(t0)))
+        last = len(starts) if t1 is None else int(np.searchsorted(starts, epoch_ms(t1)))
+        for i in range(first, last):
+            if offsets[i + 1] > offsets[i]:
+                rows = slice(offsets[i], offsets[i + 1])
+                yield pd.Timestamp(starts[i], unit="ms"), self.take(rows, columns, categorical)
+
+    def _group_rows(self, group, code, t0, t1):
+        """ A node's or pair's rows in [t0, t1), found in its own (ascending) rows """
+        group_rows = self.arrays[f"{group}_rows"]
+        offsets = self.arrays[f"{group}_offsets"]
+        rows = group_rows[offsets[code]:offsets[code + 1]]
+        window = self.rows(t0, t1)
+        return np.asarray(rows[np.searchsorted(rows, window.start):np.searchsorted(rows, window.stop)])
+
+    def _code(self, name):
+        code = self.people.get_indexer([name])[0]
+        if code < 0:
+            raise KeyError(name)
+        return code
+
+    def node_rows(self, name, t0=None, t1=None):
+        """ Rows in [t0, t1) where name is the sender or the receiver """
+        return self._group_rows("node", self._code(name), t0, t1)
+
+    def pair_rows(self, a, b, t0=None, t1=None):
+        """ Rows in [t0, t1) between a and b (either direction), empty if they never talk """
+        low, high = sorted([self._code(a), self._code(b)])
+        keys = self.arrays["pair_keys"]
+        key = low * len(self.people) + high
+        position = int(np.searchsorted(keys, key))
+        if position == len(keys) or keys[position] != key:
+            return np.empty(0, dtype=np.int64)
+        return self._group_rows("pair", position, t0, t1)
+
+    def node(self, name, t0=None, t1=None, columns=None, categorical=True):
+        """ The edges of name in [t0, t1) """
+        return self.take(self.node_rows(name, t0, t1), columns, categorical)
+
+    def pair(self, a, b, t0=None, t1=None, columns=None, categorical=True, directed=False):
+        """ The edges between a and b in [t0, t1), only the ones from a to b if directed """
+        rows = self.pair_rows(a, b, t0, t1)
+        if directed:
+            rows = rows[(self.take(rows, ["from"], categorical=False)["from"] == a).to_numpy()]
+        return self.take(rows, columns, categorical)
+
+
+def open_index(path):
+    return EdgeIndex(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time index of the tidy edges")
+    parser.add_argument("tidy_path", nargs="?", default="tidy_data.cols")
+    parser.add_argument("index_path", nargs="?", default="tidy_index.cols")
+    parser.add_argument("--units", nargs="+", default=UNITS, choices=UNITS)
+    args = parser.parse_args()
+    if Path(args.tidy_path).is_dir():
+        tidy_df = read_table(args.tidy_path)
+    else:
+        tidy_df = pd.read_csv(args.tidy_path)
+    build_index(tidy_df, args.index_path, args.units)
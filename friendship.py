@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Weekly friendship time series per pair of people (disaster_dat.csv).
+
+Does what the "Lost connections" part of brms_preprocessing.Rmd does, on the
+tidy_pipeline output. Pairs are packed into integer keys, weights are summed
+per pair and week in one grouped pass and the filters (EWMA, rolling sums,
+streaks) run over a pairs x weeks matrix at once instead of per pair.
+
+Like the Rmd, pairs are keyed on the people's positions in each week's graph
+(tidygraph's edge from/to), the k-th column of a pair is its k-th week with
+messages and the week column is the k-th week of the data overall.
+
+    python friendship.py tidy_data.cols disaster_dat.csv
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from node_metrics import message_edges, read_tidy, round_date
+
+SEMESTERS = {"first_sem": ("2019-09-01", "2020-01-14"),
+             "second_sem": ("2020-02-03", "2020-03-13"),
+             "lockdown": ("2020-03-13", "2020-06-08"),
+             "summer": ("2020-06-08", "2020-08-31"),
+             "third_sem": ("2020-08-31", "2020-12-31")}
+LOCKDOWN_PERIODS = ["lockdown", "third_sem"]
+EWMA_RATIO = 0.95
+FRIEND_THRESHOLD = 0.2
+STRENGTH_WEEKS = 4
+DISASTER_END = "2021-01-01"
+DISASTER_COLUMNS = ["pair_key", "timecol", "week", "friendship", "friendship_strength", "lost_con", "lockdown"]
+
+
+def within(dates, periods):
+    """ Whether each date (datetime64) is in any of the periods (both ends included, like %within%) """
+    dates = np.asarray(dates, dtype="datetime64[ms]")
+    inside = np.zeros(len(dates), dtype=bool)
+    for period in periods:
+        start, end = (np.datetime64(day, "ms") for day in SEMESTERS[period])
+        inside |= (dates >= start) & (dates <= end)
+    return inside
+
+
+def week_pairs(df):
+    """
+    Summed weight per pair and week. Only messages sent (by day) within a
+    semester, lockdown or summer count. Returns pair keys (packed lo * n + hi
+    of the positions in the week's sorted names), week index and weight per
+    row, the weeks and the packing base
+    """
+    src, dst, timestamps, weight, names = message_edges(df)
+    keep = within(round_date(timestamps, "day"), SEMESTERS)
+    src, dst, timestamps, weight = src[keep], dst[keep], timestamps[keep], weight[keep]
+    weeks, week = np.unique(round_date(timestamps, "week"), return_inverse=True)
+    week = week.ravel()
+
+    # the week's graph has its people in (string) sorted order, positions start at 1
+    n_names = len(names)
+    name_rank = np.empty(n_names, dtype=np.int64)
+    name_rank[np.argsort(names.astype(str), kind="stable")] = np.arange(n_names)
+    ends = np.concatenate([week * n_names + name_rank[src], week * n_names + name_rank[dst]])
+    present, inverse = np.unique(ends, return_inverse=True)
+    week_start = np.searchsorted(present // n_names, np.arange(len(weeks)))
+    position = np.arange(len(present)) - week_start[present // n_names] + 1
+    inverse = inverse.ravel()
+    from_pos, to_pos = position[inverse[:len(src)]], position[inverse[len(src):]]
+
+    # summed per (to, from, week) first and then per pair, like the Rmd
+    base = int(position.max()) + 1 if len(position) else 1
+    directed, inverse = np.unique((from_pos * base + to_pos) * len(weeks) + week, return_inverse=True)
+    directed_weight = r_sums(inverse.ravel(), weight, len(directed))
+    directed_week = directed % len(weeks)
+    from_pos, to_pos = (directed // len(weeks)) // base, (directed // len(weeks)) % base
+    pair = np.minimum(from_pos, to_pos) * base + np.maximum(from_pos, to_pos)
+    keys, inverse = np.unique(pair * len(weeks) + directed_week, return_inverse=True)
+    friendship = r_sums(inverse.ravel(), directed_weight, len(keys))
+    return keys // len(weeks), keys % len(weeks), friendship, weeks, base
+
+
+def r_sums(groups, values, n_groups):
+    """ Sums per group in row order with a long double accumulator (as R's sum) """
+    sums = np.zeros(n_groups, dtype=np.longdouble)
+    np.add.at(sums, groups, values.astype(np.longdouble))
+    return sums.astype(np.float64)
+
+
+def pair_labels(pairs, base):
+    """ 'lo hi' keys as in the Rmd (create_pair_key) """
+    return np.array([f"{pair // base} {pair % base}" for pair in pairs], dtype=object)
+
+
+def series_matrix(pair, values):
+    """
+    Pairs x weeks matrix of each pair's values in week order (rows sorted by
+    label), left-aligned and zero-padded, plus each pair's number of weeks
+    """
+    pairs, row, n_weeks = np.unique(pair, return_inverse=True, return_counts=True)
+    row = row.ravel()
+    column = np.arange(len(pair)) - np.concatenate([[0], np.cumsum(n_weeks)[:-1]])[row]
+    matrix = np.zeros((len(pairs), int(n_weeks.max()) if len(pairs) else 0))
+    matrix[row, column] = values
+    return pairs, matrix, n_weeks
+
+
+def rolling_sum(matrix, k, align="right", lengths=None):
+    """
+    zoo::rollsum(fill = NA) along the rows, computed the way zoo does it: the
+    first window's sum and then a running sum of what enters minus what leaves
+    (in long double like R's cumsum), so the results round the same way.
+    With lengths, each row is a series of its own length (the rest is padding)
+    """
+    n = matrix.shape[1]
+    sums = np.full(matrix.shape, np.nan)
+    if n >= k:
+        steps = matrix[:, k - 1:] - np.concatenate([matrix[:, :1], matrix[:, :n - k]], axis=1)
+        steps[:, 0] = matrix[:, :k].astype(np.longdouble).sum(axis=1)
+        window = np.cumsum(steps.astype(np.longdouble), axis=1).astype(np.float64)
+        if align == "right":
+            sums[:, k - 1:] = window
+        else:
+            sums[:, :n - k + 1] = window
+    if lengths is not None and align == "left":
+        sums[np.arange(n)[None, :] > (lengths[:, None] - k)] = np.nan
+    return sums
+
+
+def ewma(matrix, ratio=EWMA_RATIO):
+    """ ewma.filter of the Rmd for every row: y[t] = ratio * x[t] + (1 - ratio) * y[t - 1], y[0] = x[0] """
+    if not matrix.size:
+        return matrix.copy()
+    zi = (1 - ratio) * matrix[:, :1]
+    filtered, _ = lfilter([ratio], [1, -(1 - ratio)], matrix, axis=1, zi=zi)
+    return filtered
+
+
+def friendship_series(df):
+    """
+    week_friends of the Rmd: per pair and week with messages the friendship,
+    its EWMA and log, is_friend, friendship_strength (4 week mean), new_con and
+    the previous/next friend streaks
+    """
+    pair, week, friendship, weeks, base = week_pairs(df)
+    labels = pair_labels(pair, base)
+    order = np.lexsort((week, labels))
+    pairs, matrix, n_weeks = series_matrix(labels[order], friendship[order])
+    observed = np.arange(matrix.shape[1])[None, :] < n_weeks[:, None]
+
+    smoothed = ewma(matrix)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_smoothed = np.log(smoothed)
+    is_friend = (log_smoothed > FRIEND_THRESHOLD).astype(np.float64)
+    strength = rolling_sum(matrix, STRENGTH_WEEKS) / STRENGTH_WEEKS
+    with np.errstate(invalid="ignore"):
+        new_con = matrix > 2 * strength
+    columns = {"friendship": matrix,
+               "ewma_friendship": smoothed,
+               "log_ewma_friend": log_smoothed,
+               "is_friend": is_friend.astype(bool),
+               "friendship_strength": strength,
+               "new_con": new_con,
+               "previous_streak": rolling_sum(is_friend, STRENGTH_WEEKS),
+               "next_streak": rolling_sum(is_friend, STRENGTH_WEEKS, "left", n_weeks)}
+    return pd.DataFrame({"pair_key": np.repeat(pairs, n_weeks),
+                         "week": weeks[week[order]],
+                         "timecol": np.nonzero(observed)[1] + 1,
+                         **{name: values[observed] for name, values in columns.items()}})
+
+
+def disaster_data(df, end=DISASTER_END):
+    """
+    disaster_dat of the Rmd: every pair gets as many weeks as the pair with
+    the most, unobserved ones are 0 and week is the timecol-th week of the data.
+    Weeks without a full 4 week strength and from end on are left out
+    """
+    pair, week, friendship, weeks, base = week_pairs(df)
+    labels = pair_labels(pair, base)
+    order = np.lexsort((week, labels))
+    pairs, matrix, _ = series_matrix(labels[order], friendship[order])
+    strength = rolling_sum(matrix, STRENGTH_WEEKS) / STRENGTH_WEEKS
+    with np.errstate(invalid="ignore"):
+        lost_con = (matrix < 0.5 * strength) & (strength > 0.001)
+    column_weeks = weeks[:matrix.shape[1]]
+    keep = (np.arange(matrix.shape[1]) >= STRENGTH_WEEKS - 1) & (column_weeks < np.datetime64(end))
+    n_pairs, n_kept = len(pairs), int(keep.sum())
+    return pd.DataFrame({"pair_key": np.repeat(pairs, n_kept),
+                         "timecol": np.tile(np.flatnonzero(keep) + 1, n_pairs),
+                         "week": np.tile(column_weeks[keep], n_pairs),
+                         "friendship": matrix[:, keep].ravel(),
+                         "friendship_strength": strength[:, keep].ravel(),
+                         "lost_con": lost_con[:, keep].ravel(),
+                         "lockdown": np.tile(within(column_weeks[keep], LOCKDOWN_PERIODS), n_pairs)},
+                        columns=DISASTER_COLUMNS)
+
+
+def _r_number(x):
+    """ A double as write_csv writes it (1 not 1.0, NA, Inf) """
+    if np.isnan(x):
+        return "NA"
+    if np.isinf(x):
+        return "Inf" if x > 0 else "-Inf"
+    text = repr(float(x))
+    return text[:-2] if text.endswith(".0") else text
+
+
+def write_r_csv(df, path):
+    """ csv as readr::write_csv writes it (TRUE/FALSE, ISO datetimes in UTC, shortest doubles) """
+    formatted = df.copy()
+    for column in df.columns:
+        dtype = df[column].dtype
+        if pd.api.types.is_bool_dtype(dtype):
+            formatted[column] = np.where(df[column], "TRUE", "FALSE")
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            formatted[column] = pd.to_datetime(df[column]).dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+        elif pd.api.types.is_float_dtype(dtype):
+            formatted[column] = [_r_number(x) for x in df[column].to_numpy()]
+    formatted.to_csv(path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Weekly friendship per pair (disaster_dat.csv)")
+    parser.add_argument("tidy_path", nargs="?", default="tidy_data.cols")
+    parser.add_argument("out_path", nargs="?", default="disaster_dat.csv")
+    args = parser.parse_args()
+    write_r_csv(disaster_data(read_tidy(args.tidy_path)), args.out_path)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Group chat messages as person to person edges, without the pandas merge.
+
+Group membership is a sparse (CSR) incidence matrix, groups x people, with
+the message weight 1 / (group size - 1) as its values. expand_group_edges
+gives one row per message and member, like tidy_pipeline (same rows, order,
+index and dtypes), by indexing the incidence rows directly instead of a
+many-to-many merge. aggregate_group_edges never expands the messages: group
+messages are counted per sender, group and time bucket first and multiplied
+with the incidence matrix, giving the summed weight per pair and bucket.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+TIDY_COLUMNS = ["from", "to", "timestamp", "weight"]
+AGGREGATE_COLUMNS = ["from", "to", "timestamp", "weight", "count"]
+# pairs multiplied out at a time in aggregate_group_edges
+BLOCK_ENTRIES = 2**22
+
+
+def _values(column):
+    """ The column's array (numpy or extension array, so takes keep its dtype) """
+    return column.array if isinstance(column, pd.Series) else column
+
+
+def incidence(df):
+    """
+    Group memberships of an edge table (rel_type 'group' rows). Returns the
+    group ids, their CSR incidence matrix (groups x members, valued with the
+    groups' message weight, 1 / (size - 1)), and the people (the members'
+    ids) the columns stand for. Members are in row order within a group
+    """
+    groups = df[(df["rel_type"] == "group").to_numpy() & df["from"].notna().to_numpy() & df["to"].notna().to_numpy()]
+    group_codes, group_ids = pd.factorize(_values(groups["to"]))
+    member_codes, people = pd.factorize(_values(groups["from"]))
+    order = np.argsort(group_codes, kind="stable")
+    sizes = np.bincount(group_codes, minlength=len(group_ids))
+    indptr = np.concatenate([[0], np.cumsum(sizes)])
+    with np.errstate(divide="ignore"):
+        weights = 1 / (sizes - 1)
+    matrix = sp.csr_matrix((np.repeat(weights, sizes), member_codes[order], indptr),
+                           shape=(len(group_ids), len(people)))
+    return group_ids, matrix, people
+
+
+def group_keys(to, group_ids):
+    """ Row of the incidence matrix of each receiver, -1 if it isn't a group """
+    return pd.Index(group_ids).get_indexer(_values(to))
+
+
+def _ranges(starts, lengths):
+    """ starts[i], starts[i] + 1, ..., starts[i] + lengths[i] - 1 for every i, in one array """
+    steps = np.ones(int(lengths.sum()), dtype=starts.dtype)
+    if len(steps):
+        first = np.cumsum(lengths) - lengths
+        steps[first[0]] = starts[0]
+        steps[first[1:]] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+    return np.cumsum(steps, out=steps)
+
+
+def _present(values):
+    """ Not missing (nor infinite, for floats) """
+    present = values.notna().to_numpy()
+    if pd.api.types.is_float_dtype(values.dtype):
+        present = present & np.isfinite(values.to_numpy())
+    return present
+
+
+def expand_group_edges(df, membership=None):
+    """
+    tidy_pipeline without the merge: every message to a group becomes one row
+    per member (the sender included) weighted 1 / (size - 1), other messages
+    keep their receiver and weight 1. Rows with a missing id or timestamp
+    and messages to one person groups are left out, the index is the row
+    numbers the merge would have had. membership is incidence() of the
+    whole table when df is only a chunk of it
+    """
+    group_ids, matrix, people = incidence(df) if membership is None else membership
+    messages = df[(df["rel_type"] != "group").to_numpy()]
+    key = group_keys(messages["to"], group_ids)
+    is_group = key >= 0
+    # a last slot for the key -1 of other messages, so there's one even without groups
+    sizes = np.append(np.diff(matrix.indptr), 1)
+    repeats = np.where(is_group, sizes[key], 1)
+    starts = np.cumsum(repeats) - repeats
+    # messages whose rows would be dropped aren't expanded at all
+    with np.errstate(divide="ignore"):
+        group_weight = 1 / (sizes - 1)
+    keep = (_present(messages["from"]) & _present(messages["timestamp"])
+            & np.where(is_group, np.isfinite(group_weight[key]), messages["to"].notna().to_numpy()))
+    messages, key, is_group, repeats, starts = messages[keep], key[keep], is_group[keep], repeats[keep], starts[keep]
+
+    row_type = np.int32 if len(messages) < 2**31 else np.int64
+    rows = np.repeat(np.arange(len(messages), dtype=row_type), repeats)
+    from_group = np.repeat(is_group, repeats)
+    weight = np.ones(len(rows))
+    member = np.full(len(rows), -1, dtype=row_type)
+    if matrix.nnz:
+        position = _ranges(np.where(is_group, matrix.indptr[key], 0).astype(matrix.indptr.dtype), repeats)
+        weight[from_group] = matrix.data[position[from_group]]
+        member[from_group] = matrix.indices[position[from_group]]
+        del position
+    # as the merge: members taken with missing values filled in, then the receivers of other messages
+    to = pd.api.extensions.take(people, member, allow_fill=True)
+    del member
+    direct = ~from_group
+    if direct.any():
+        to[direct] = _values(messages["to"]).take(rows[direct])
+    return pd.DataFrame({"from": _values(messages["from"]).take(rows),
+                         "to": to,
+                         "timestamp": _values(messages["timestamp"]).take(rows),
+                         "weight": weight},
+                        index=_ranges(starts, repeats), columns=TIDY_COLUMNS, copy=False)
+
+
+def time_buckets(timestamps, bucket=None):
+    """ Epoch ms floored to the bucket (a duration like '1D' or ms), the timestamps themselves if None """
+    if bucket is None:
+        return timestamps
+    size = bucket if isinstance(bucket, (int, np.integer)) else pd.Timedelta(bucket) // pd.Timedelta(milliseconds=1)
+    return timestamps // size * size
+
+
+def aggregate_group_edges(df, bucket=None, block_entries=BLOCK_ENTRIES):
+    """
+    Summed weight and number of messages per (from, to, time bucket), the
+    aggregate of expand_group_edges without expanding the group messages:
+    group messages are counted per (bucket, sender) and group, and multiplied
+    with the incidence matrix a block of about block_entries pairs at a time.
+    Sorted by bucket, then by the order the people first show up
+    """
+    group_ids, matrix, people = incidence(df)
+    messages = df[(df["rel_type"] != "group").to_numpy()]
+    messages = messages[_present(messages["from"]) & _present(messages["timestamp"])]
+    timestamps = pd.to_numeric(messages["timestamp"]).to_numpy(np.float64).astype(np.int64)
+    key = group_keys(messages["to"], group_ids)
+
+    # people codes: the members first (the incidence columns), then everyone else
+    codes, ids = pd.factorize(pd.concat([pd.Series(people), messages["from"], messages["to"]],
+                                        ignore_index=True).array)
+    sender = codes[len(people):len(people) + len(messages)]
+    receiver = codes[len(people) + len(messages):]
+    buckets, bucket_code = np.unique(time_buckets(timestamps, bucket), return_inverse=True)
+    n_ids = len(ids)
+    if len(buckets) * n_ids * n_ids >= 2**63:
+        raise OverflowError("too many people and buckets for the packed keys")
+    # (bucket, sender, receiver) packed, so sorted keys are in output order
+    bucket_sender = bucket_code.ravel() * n_ids + sender
+
+    # weight + 1j per membership: one product sums both the weights and the messages
+    spread = sp.csr_matrix((np.where(np.isfinite(matrix.data), matrix.data + 1j, 0), matrix.indices, matrix.indptr),
+                           shape=matrix.shape)
+    in_group = key >= 0
+    rows, row = np.unique(bucket_sender[in_group], return_inverse=True)
+    counts = sp.csr_matrix((np.ones(int(in_group.sum())), (row.ravel(), key[in_group])),
+                           shape=(len(rows), len(group_ids)))
+    offsets = np.concatenate([[0], np.cumsum((counts > 0) @ np.diff(matrix.indptr))])
+    cuts = np.unique(np.append(np.searchsorted(offsets, np.arange(0, offsets[-1], block_entries), side="right") - 1,
+                               len(rows)))
+    keys, weight, count = [np.empty(0, np.int64)], [np.empty(0)], [np.empty(0, np.int32)]
+    for start, stop in zip(cuts[:-1], cuts[1:]):
+        product = counts[start:stop] @ spread
+        product.sum_duplicates()
+        messages_in = np.rint(product.data.imag).astype(np.int32)
+        # pairs only reached through one person groups
+        reached = messages_in > 0
+        keys.append((np.repeat(rows[start:stop], np.diff(product.indptr)) * n_ids + product.indices)[reached])
+        weight.append(product.data.real[reached])
+        count.append(messages_in[reached])
+    keys, weight, count = np.concatenate(keys), np.concatenate(weight), np.concatenate(count)
+
+    # direct messages (weight 1 each) added to the pairs, or inserted in order
+    direct = (key < 0) & (receiver >= 0)
+    direct_keys, direct_count = np.unique(bucket_sender[direct] * n_ids + receiver[direct], return_counts=True)
+    position = np.searchsorted(keys, direct_keys)
+    found = np.zeros(len(direct_keys), dtype=bool)
+    found[position < len(keys)] = keys[position[position < len(keys)]] == direct_keys[position < len(keys)]
+    weight[position[found]] += direct_count[found]
+    count[position[found]] += direct_count[found]
+    keys = np.insert(keys, position[~found], direct_keys[~found])
+    weight = np.insert(weight, position[~found], direct_count[~found])
+    count = np.insert(count, position[~found], direct_count[~found])
+
+    receiver = ids.take(keys % n_ids)
+    keys //= n_ids
+    sender = ids.take(keys % n_ids)
+    keys //= n_ids
+    return pd.DataFrame({"from": sender,
+                         "to": receiver,
+                         "timestamp": buckets.take(keys, out=keys),
+                         "weight": weight,
+                         "count": count},
+                        columns=AGGREGATE_COLUMNS, copy=False)
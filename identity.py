@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Identity resolution shared by anonymize_messages.py and data_load.py.
+
+Names are hashed once each (hash_name is cached) and checked against the
+cogsci hashes as a set. Known aliases are kept as data below, and whole
+id columns are fixed by working on their unique values only.
+pandas is only needed for the column functions (not on participants' laptops).
+"""
+import hashlib
+from functools import lru_cache
+
+# name as it shows up in some exports -> the name in the cogsci hash file
+# (the mojibake is how the names were hashed)
+NAME_ALIASES = {"Lasse Hyldig Hansen": "Lasse Hansen",
+                "Pernille HÃ¸jlund Brams": "Pernille Brams",
+                "Tobias GrÃ¸nhÃ¸i Hansen": "Tobias Hansen"}
+
+# names that slipped through the anonymizer without being hashed
+PLAINTEXT_NAMES = ["Verus Juhasz"]
+
+
+@lru_cache(maxsize=None)
+def hash_name(name):
+    """ simplified version (no salt) """
+    return hashlib.sha1(name.encode()).hexdigest()
+
+
+def check_name(hashed_name, new_name):
+    return hashed_name == hash_name(new_name)
+
+
+def as_hash_set(cog_hashes):
+    """ The cogsci hashes as a set (the pickles might hold lists) """
+    return cog_hashes if isinstance(cog_hashes, (set, frozenset)) else set(cog_hashes)
+
+
+def is_a_cogsci(cogsci_hashes, new_name):
+    return hash_name(new_name) in cogsci_hashes
+
+
+def is_cog_convo(participants, cog_hashes):
+    """ Checks whether any participant in convo is cogsci19 """
+    return any(hash_name(name) in cog_hashes for name in participants)
+
+
+def create_hash_dict(participants):
+    return {hash_name(name): [name] for name in participants}
+
+
+def find_hex(s):
+    """ Checks whether names are valid hashes """
+    try:
+        int(s, 16)
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+def id_replacements():
+    """ Hashed alias -> hashed name, plus plaintext names -> their hash """
+    replacements = {hash_name(alias): hash_name(name) for alias, name in NAME_ALIASES.items()}
+    replacements.update({name: hash_name(name) for name in PLAINTEXT_NAMES})
+    return replacements
+
+
+def map_unique(series, func):
+    """ Applies func to each distinct value of a column once (via factorization) """
+    import numpy as np
+    import pandas as pd
+    codes, uniques = pd.factorize(series)
+    # missing values have code -1, which picks the trailing None
+    mapped = np.array([func(value) for value in uniques] + [None], dtype=object)
+    return pd.Series(mapped[codes], index=series.index, name=series.name)
+
+
+def hex_column(series):
+    """ Whether each value of a column is a valid hash """
+    return map_unique(series, find_hex).astype(bool)
+
+
+def hash_column(series):
+    """ Hashes the values that aren't hashes already """
+    return map_unique(series, lambda s: s if find_hex(s) else hash_name(s))
+
+
+def resolve_ids(df, columns=("from", "to")):
+    """ Replaces known aliases and plaintext names in the id columns """
+    replacements = id_replacements()
+    return df.assign(**{column: map_unique(df[column], lambda s: replacements.get(s, s))
+                        for column in columns})
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Ids as int32 codes into one table of the ids themselves.
+
+The ids are 40 character hashes, so the consent steps spent their time
+hashing and comparing strings (isin) and replacing them cell by cell.
+intern_ids turns the id columns into codes once (missing ids are -1), and
+the ids table is kept next to the edges (write_ids / read_ids). A set of
+ids is then a mask with a slot per code, plus a last one for the missing
+ids that code -1 picks, so mask[codes] is isin and lookup[codes] is replace:
+
+    edges, ids = intern_ids(full_df)
+    kept = id_mask(ids, consenting)
+    edges = edges[kept[edges["from"]] & kept[edges["to"]]]
+    edges = relabel(edges, random_id_lookup(codes_mask(edges["from"], len(ids))))
+"""
+import numpy as np
+import pandas as pd
+
+from table_store import read_table, write_table
+
+
+def intern_ids(df, columns=("from", "to")):
+    """
+    The id columns as int32 codes into ids (missing ids are -1), returns
+    (df, ids). Categoricals sharing their categories (as typed_ids writes
+    them) keep their codes, anything else is factorized
+    """
+    dtypes = [df[column].dtype for column in columns]
+    if all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes) and all(d == dtypes[0] for d in dtypes):
+        ids = pd.Index(dtypes[0].categories)
+        return df.assign(**{column: df[column].cat.codes.astype(np.int32) for column in columns}), ids
+    codes, ids = pd.factorize(np.concatenate([np.asarray(df[column], dtype=object) for column in columns]))
+    codes = codes.astype(np.int32).reshape(len(columns), len(df))
+    return df.assign(**dict(zip(columns, codes))), pd.Index(ids)
+
+
+def add_ids(ids, values):
+    """ ids with the values that aren't in it yet added at the end (the codes stay the same) """
+    values = pd.Index(pd.unique(pd.Series(values, dtype=object).dropna()))
+    return ids.append(values[~values.isin(ids)])
+
+
+def id_values(codes, ids):
+    """ The ids of codes (missing for -1) """
+    return pd.api.extensions.take(np.asarray(ids, dtype=object), np.asarray(codes), allow_fill=True)
+
+
+def id_mask(ids, values):
+    """ Which codes are one of values (a set or column of ids), the last slot is the missing ids """
+    values = pd.Series(list(values) if isinstance(values, (set, frozenset)) else values, dtype=object)
+    mask = np.zeros(len(ids) + 1, dtype=bool)
+    mask[:-1] = ids.isin(values.dropna())
+    mask[-1] = values.isna().any()
+    return mask
+
+
+def codes_mask(codes, n_ids):
+    """ Which of n_ids codes (and the missing slot) show up in codes """
+    mask = np.zeros(n_ids + 1, dtype=bool)
+    mask[np.asarray(codes)] = True
+    return mask
+
+
+def resolve_codes(ids, replacements):
+    """
+    resolve_ids on the ids table: ids with the replacements made (aliases
+    merged into one id) and the old code -> new code lookup for relabel
+    """
+    new_codes, new_ids = pd.factorize(pd.Series([replacements.get(i, i) for i in ids], dtype=object))
+    return pd.Index(new_ids), np.append(new_codes, -1).astype(np.int32)
+
+
+def relabel(df, lookup, columns=("from", "to")):
+    """ The codes of the id columns through lookup (its last slot is for the missing ids) """
+    return df.assign(**{column: lookup[df[column].to_numpy()] for column in columns})
+
+
+def non_cog_mask(senders, group_from, group_to, is_cog):
+    """
+    find_non_cogs on codes: the senders that aren't cogsci and the groups
+    with one of them in it (is_cog is a mask over the codes)
+    """
+    non_cog = codes_mask(senders, len(is_cog) - 1) & ~is_cog
+    non_cog[group_to[non_cog[group_from]]] = True
+    return non_cog
+
+
+def random_id_lookup(present):
+    """ create_random_ids on codes: the present ones get 0, 1, ... in random order, the rest -1 """
+    lookup = np.full(len(present), -1, dtype=np.int64)
+    lookup[present] = np.random.permutation(int(present.sum()))
+    return lookup
+
+
+def write_ids(ids, path):
+    write_table(pd.DataFrame({"id": ids}), path)
+
+
+def read_ids(path):
+    return pd.Index(read_table(path, categorical=False)["id"])
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+Node-level network measures by year, month, week and day (all_node_measures.csv).
+
+Does what GetMeasures in convert.r does, without building a graph per window:
+messages are bucketed like lubridate's round_date, the (multi-)edges of every
+window are summed into one sparse pair list and the measures are computed on
+batches of similarly sized windows as stacked dense matrices, over several cores.
+The graphs are the same as in convert.r (undirected, one edge per message, no
+self-messages), so are the measures. Like the tidygraph centralities, they use
+the message counts and not the weights, only diversity uses the weights:
+
+    centrality_degreein     messages the node takes part in (multi-edges count)
+    pagerank                damping 0.85
+    eigenvector_centrality  scaled to max 1
+    hub_centrality          scaled to max 1
+    subgraph
+    clustering_coef         global transitivity of the simple graph
+    scaled_shannon_entropy  igraph's diversity over the node's messages
+    density                 messages / possible pairs
+
+    python node_metrics.py tidy_data.cols all_node_measures.csv
+    python node_metrics.py tidy_data.cols rolling_node_measures.csv --window 7D --stride 1D
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import eigsh
+
+UNITS = ["year", "month", "week", "day"]
+MEASURE_COLUMNS = ["name", "date", "centrality_degreein", "pagerank", "eigenvector_centrality",
+                   "hub_centrality", "subgraph", "clustering_coef", "scaled_shannon_entropy",
+                   "density", "unit"]
+TIDY_COLUMNS = ["from", "to", "timestamp", "weight"]
+DAMPING = 0.85
+# every worker builds the dense matrices of a batch, a few are enough
+N_WORKERS = min(4, os.cpu_count() or 1)
+# matrix cells per batch (windows * nodes**2), a few of these arrays are alive at a time
+BATCH_CELLS = 2**21
+
+_DAY_MS = 86_400_000
+# 1970-01-01 was a thursday, lubridate's weeks start on sunday
+_WEEK_OFFSET = 4
+
+
+def _unit_bounds(ms, unit):
+    """ Start of the unit containing each timestamp and start of the next one (datetime64[ms]) """
+    t = ms.astype("datetime64[ms]")
+    if unit == "day":
+        below = t.astype("datetime64[D]")
+        above = below + np.timedelta64(1, "D")
+    elif unit == "week":
+        days = t.astype("datetime64[D]").astype(np.int64)
+        below = (days - (days + _WEEK_OFFSET) % 7).astype("datetime64[D]")
+        above = below + np.timedelta64(7, "D")
+    elif unit == "month":
+        below = t.astype("datetime64[M]")
+        above = below + np.timedelta64(1, "M")
+    elif unit == "year":
+        below = t.astype("datetime64[Y]")
+        above = below + np.timedelta64(1, "Y")
+    else:
+        raise ValueError(f"unknown unit {unit!r}")
+    return below.astype("datetime64[ms]"), above.astype("datetime64[ms]")
+
+
+def round_date(timestamps, unit):
+    """ Rounds epoch ms to the nearest unit boundary like lubridate::round_date (ties go up) """
+    ms = np.asarray(timestamps, dtype=np.float64).round().astype(np.int64)
+    below, above = _unit_bounds(ms, unit)
+    t = ms.astype("datetime64[ms]")
+    return np.where(above - t <= t - below, above, below).astype("datetime64[D]")
+
+
+def message_edges(df):
+    """
+    from/to codes, timestamps and weights of the messages between two different
+    people, plus the names the codes refer to
+    """
+    df = df[df["from"].notna() & df["to"].notna()]
+    ids = pd.concat([df["from"], df["to"]], ignore_index=True)
+    numeric = pd.to_numeric(ids, errors="coerce")
+    # ids read from csv can be floats (83.0), they are the same people as 83
+    if numeric.notna().all() and (numeric % 1 == 0).all():
+        ids = numeric.astype(np.int64)
+    else:
+        ids = ids.astype(str)
+    codes, names = pd.factorize(ids)
+    src, dst = codes[:len(df)], codes[len(df):]
+    keep = src != dst
+    return (src[keep], dst[keep],
+            df["timestamp"].to_numpy(np.float64)[keep],
+            df["weight"].to_numpy(np.float64)[keep],
+            np.asarray(names))
+
+
+def window_nodes(win, src, dst, n_names):
+    """
+    Numbers the nodes of each window in order of appearance in c(from, to) (the
+    vertex order of CreateGraph). Returns the global slot of every message end,
+    the window and name of every slot and the first slot of each window
+    """
+    m = len(win)
+    win2 = np.concatenate([win, win])
+    part = np.repeat([0, 1], m)
+    keys = win2.astype(np.int64) * n_names + np.concatenate([src, dst])
+    order = np.lexsort((np.tile(np.arange(m), 2), part, win2))
+    uniq, first, inverse = np.unique(keys[order], return_index=True, return_inverse=True)
+    slot_of_uniq = np.empty(len(uniq), dtype=np.int64)
+    slot_of_uniq[np.argsort(first, kind="stable")] = np.arange(len(uniq))
+    slots = np.empty(2 * m, dtype=np.int64)
+    slots[order] = slot_of_uniq[inverse.ravel()]
+    slot_win = np.empty(len(uniq), dtype=np.int64)
+    slot_name = np.empty(len(uniq), dtype=np.int64)
+    slot_win[slot_of_uniq] = uniq // n_names
+    slot_name[slot_of_uniq] = uniq % n_names
+    n_windows = int(win.max()) + 1 if m else 0
+    offsets = np.searchsorted(slot_win, np.arange(n_windows))
+    return slots[:m], slots[m:], slot_win, slot_name, offsets
+
+
+def window_pairs(from_slot, to_slot, n_slots):
+    """
+    The sparse adjacency of all windows at once: one row per connected pair of
+    node slots (a < b, slots of different windows never meet) with the number
+    of messages between them
+    """
+    a = np.minimum(from_slot, to_slot)
+    b = np.maximum(from_slot, to_slot)
+    uniq, inverse = np.unique(a * n_slots + b, return_inverse=True)
+    return uniq // n_slots, uniq % n_slots, np.bincount(inverse.ravel(), minlength=len(uniq)).astype(np.float64)
+
+
+def block_order(a, b, slot_win):
+    """
+    Orders the nodes of each window by connected component. With the components
+    as contiguous blocks, eigh gives eigenvectors that are exactly zero outside
+    their component (as R's eigen does), otherwise rounding errors get multiplied
+    by exp() of other components' eigenvalues in the subgraph centrality.
+    Returns the slots in that order (each window still starts at its offset)
+    """
+    n_slots = len(slot_win)
+    graph = coo_matrix((np.ones(len(a)), (a, b)), shape=(n_slots, n_slots))
+    _, component = connected_components(graph, directed=False)
+    return np.lexsort((np.arange(n_slots), component, slot_win))
+
+
+def window_batches(n_nodes, max_cells=BATCH_CELLS):
+    """ Groups windows of similar size so the padding of the stacked matrices stays small """
+    order = np.argsort(n_nodes, kind="stable")
+    batches, batch = [], []
+    for window in order:
+        if batch and (len(batch) + 1) * int(n_nodes[window]) ** 2 > max_cells:
+            batches.append(np.array(batch))
+            batch = []
+        batch.append(window)
+    if batch:
+        batches.append(np.array(batch))
+    return batches
+
+
+def _leading(vals, vecs, index):
+    """ Eigenvector at index (per window), made positive and scaled to max 1 """
+    vectors = np.abs(np.take_along_axis(vecs, index[:, None, None], axis=2)[:, :, 0])
+    top = vectors.max(axis=1, keepdims=True)
+    return vectors / np.where(top > 0, top, 1)
+
+
+def batch_measures(n_nodes, win, a, b, count):
+    """
+    Pagerank, eigenvector, hub and subgraph centrality (windows x nodes, padded)
+    and transitivity (per window) of a batch of windows given as pairs
+    """
+    n_windows, size = len(n_nodes), int(n_nodes.max())
+    adjacency = np.zeros((n_windows, size, size))
+    adjacency[win, a, b] = count
+    adjacency[win, b, a] = count
+    active = np.arange(size)[None, :] < n_nodes[:, None]
+
+    # pagerank solved exactly, every node has an edge so there are no dangling ones
+    strength = adjacency.sum(axis=2)
+    transition = adjacency / np.where(strength > 0, strength, 1)[:, :, None]
+    system = np.eye(size)[None] - DAMPING * transition.transpose(0, 2, 1)
+    teleport = (1 - DAMPING) / n_nodes[:, None] * active
+    pagerank = np.linalg.solve(system, teleport[:, :, None])[:, :, 0]
+
+    vals, vecs = np.linalg.eigh(adjacency)
+    last = np.full(n_windows, size - 1)
+    eigenvector = _leading(vals, vecs, last)
+    # hubs are the leading eigenvector of A %*% t(A), i.e. of the largest |eigenvalue| of A
+    hub_index = np.where(-vals[:, 0] > vals[:, -1] * (1 + 1e-9), 0, last)
+    hub = _leading(vals, vecs, hub_index)
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        subgraph = np.einsum("wij,wj->wi", vecs ** 2, np.exp(vals))
+
+    simple = (adjacency > 0).astype(np.float64)
+    closed = (np.matmul(simple, simple) * simple).sum(axis=(1, 2))
+    degree = simple.sum(axis=2)
+    triples = (degree * (degree - 1)).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        transitivity = np.where(triples > 0, closed / np.where(triples > 0, triples, 1), np.nan)
+    return pagerank, eigenvector, hub, subgraph, transitivity
+
+
+def _run_batch(args):
+    return batch_measures(*args)
+
+
+def node_diversity(degree, strength, entropy_sum):
+    """
+    igraph's diversity: entropy of the incident edge weights over log(degree).
+    Like igraph, nodes with a single message get 0/0 (NaN, or -inf by rounding)
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (np.log(strength) - entropy_sum / strength) / np.log(degree)
+
+
+def unit_measures(edges, unit, executor=None, max_cells=BATCH_CELLS):
+    """ Node measures of every window of a unit (the output of GetMeasures(unit)) """
+    src, dst, timestamps, weight, names = edges
+    if not len(src):
+        return pd.DataFrame(columns=MEASURE_COLUMNS)
+    dates, win = np.unique(round_date(timestamps, unit), return_inverse=True)
+    win = win.ravel()
+    # group_split keeps the row order within each window
+    order = np.argsort(win, kind="stable")
+    win, src, dst, weight = win[order], src[order], dst[order], weight[order]
+
+    from_slot, to_slot, slot_win, slot_name, offsets = window_nodes(win, src, dst, len(names))
+    n_slots = len(slot_win)
+    n_nodes = np.bincount(slot_win, minlength=len(dates))
+    n_messages = np.bincount(win, minlength=len(dates))
+
+    ends = np.concatenate([from_slot, to_slot])
+    ends_weight = np.concatenate([weight, weight])
+    degree = np.bincount(ends, minlength=n_slots).astype(np.float64)
+    strength = np.bincount(ends, weights=ends_weight, minlength=n_slots)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy_terms = np.where(ends_weight > 0, ends_weight * np.log(ends_weight), 0.0)
+    entropy_sum = np.bincount(ends, weights=entropy_terms, minlength=n_slots)
+    pairs_possible = n_nodes * (n_nodes - 1) / 2
+    density = n_messages / np.where(pairs_possible > 0, pairs_possible, np.nan)
+
+    pair_a, pair_b, pair_count = window_pairs(from_slot, to_slot, n_slots)
+    ordered_slots = block_order(pair_a, pair_b, slot_win)
+    position = np.empty(n_slots, dtype=np.int64)
+    position[ordered_slots] = np.arange(n_slots) - offsets[slot_win[ordered_slots]]
+    pair_win = slot_win[pair_a]
+
+    batches = window_batches(n_nodes, max_cells)
+    batch_of = np.empty(len(dates), dtype=np.int64)
+    batch_position = np.empty(len(dates), dtype=np.int64)
+    for i, batch in enumerate(batches):
+        batch_of[batch] = i
+        batch_position[batch] = np.arange(len(batch))
+    pair_batch = batch_of[pair_win]
+    pair_order = np.argsort(pair_batch, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(pair_batch, minlength=len(batches)))])
+    jobs = []
+    for i, batch in enumerate(batches):
+        rows = pair_order[bounds[i]:bounds[i + 1]]
+        jobs.append((n_nodes[batch], batch_position[pair_win[rows]],
+                     position[pair_a[rows]], position[pair_b[rows]], pair_count[rows]))
+    results = map(_run_batch, jobs) if executor is None else executor.map(_run_batch, jobs)
+
+    spectral = np.empty((4, n_slots))
+    transitivity = np.empty(len(dates))
+    for batch, (pagerank, eigenvector, hub, subgraph, batch_transitivity) in zip(batches, results):
+        padded = np.arange(pagerank.shape[1])[None, :]
+        active = padded < n_nodes[batch][:, None]
+        slots = ordered_slots[(offsets[batch][:, None] + padded)[active]]
+        for k, values in enumerate([pagerank, eigenvector, hub, subgraph]):
+            spectral[k, slots] = values[active]
+        transitivity[batch] = batch_transitivity
+
+    return pd.DataFrame({"name": names[slot_name],
+                         "date": pd.to_datetime(dates[slot_win]).strftime("%Y-%m-%d"),
+                         "centrality_degreein": degree.astype(np.int64),
+                         "pagerank": spectral[0],
+                         "eigenvector_centrality": spectral[1],
+                         "hub_centrality": spectral[2],
+                         "subgraph": spectral[3],
+                         "clustering_coef": transitivity[slot_win],
+                         "scaled_shannon_entropy": node_diversity(degree, strength, entropy_sum),
+                         "density": density[slot_win],
+                         "unit": unit},
+                        columns=MEASURE_COLUMNS)
+
+
+def node_measures(df, units=UNITS, n_workers=N_WORKERS, max_cells=BATCH_CELLS):
+    """ Node measures of a tidy edge dataframe (from, to, timestamp, weight) for all units """
+    edges = message_edges(df)
+    if n_workers is not None and n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as executor:
+            frames = [unit_measures(edges, unit, executor, max_cells) for unit in units]
+    else:
+        frames = [unit_measures(edges, unit, None, max_cells) for unit in units]
+    return pd.concat(frames, ignore_index=True)
+
+
+ROLLING_COLUMNS = ["name", "start", "end", "centrality_degreein", "pagerank",
+                   "eigenvector_centrality", "hub_centrality"]
+TOLERANCE = 1e-10
+MAX_ITER = 1000
+
+
+def window_starts(timestamps, window, stride):
+    """ Window starts (epoch ms) from midnight of the first day, every stride, while they overlap the data """
+    first = int(np.floor(timestamps.min() / _DAY_MS)) * _DAY_MS
+    return np.arange(first, timestamps.max() + 1, stride)
+
+
+def pagerank_iteration(adjacency, strength, start, tol=TOLERANCE, max_iter=MAX_ITER):
+    """ Power iteration for pagerank on an undirected graph (no dangling nodes), from start """
+    n = len(strength)
+    x = start
+    for _ in range(max_iter):
+        new = DAMPING * (adjacency @ (x / strength)) + (1 - DAMPING) / n
+        if np.abs(new - x).sum() < tol:
+            return new
+        x = new
+    return x
+
+
+def leading_eigenvector(adjacency, start, which="LA", tol=TOLERANCE):
+    """
+    Leading eigenvector (ARPACK, started from start) made positive and scaled
+    to max 1. which="LM" takes the largest |eigenvalue|, i.e. the hub scores
+    """
+    if adjacency.shape[0] <= 2:
+        vals, vecs = np.linalg.eigh(adjacency.toarray())
+        index = np.argmax(np.abs(vals)) if which == "LM" else -1
+        vector = np.abs(vecs[:, index])
+    else:
+        _, vecs = eigsh(adjacency, k=1, which=which, v0=start, tol=tol)
+        vector = np.abs(vecs[:, 0])
+    return vector / vector.max()
+
+
+def _warm_start(previous, active, default):
+    """ Previous solution of the nodes still in the window, default for the new ones """
+    start = np.where(np.isnan(previous[active]), default, previous[active])
+    return np.where(start > 0, start, default)
+
+
+def rolling_measures(df, window="7D", stride="1D", weighted=False):
+    """
+    Degree, pagerank, eigenvector and hub centrality in sliding windows
+    [start, start + window) every stride over a tidy edge dataframe.
+
+    The adjacency (one value per distinct pair) is kept up to date by adding the
+    messages that enter the window and subtracting the ones that leave it, and
+    the centralities are iterative (power iteration for pagerank, ARPACK for the
+    eigenvectors) and start from the previous window's solution, so consecutive
+    windows that share most edges take a few iterations.
+    Like node_measures, the graphs use message counts unless weighted=True
+    """
+    src, dst, timestamps, weight, names = message_edges(df)
+    if not len(src):
+        return pd.DataFrame(columns=ROLLING_COLUMNS)
+    order = np.argsort(timestamps, kind="stable")
+    src, dst, timestamps, weight = src[order], dst[order], timestamps[order], weight[order]
+    value = weight if weighted else np.ones(len(src))
+    n_names = len(names)
+    pair_keys, pair = np.unique(np.minimum(src, dst) * n_names + np.maximum(src, dst), return_inverse=True)
+    pair = pair.ravel()
+    pair_a, pair_b = pair_keys // n_names, pair_keys % n_names
+
+    window_ms = pd.Timedelta(window) // pd.Timedelta(milliseconds=1)
+    stride_ms = pd.Timedelta(stride) // pd.Timedelta(milliseconds=1)
+    starts = window_starts(timestamps, window_ms, stride_ms)
+    lows = np.searchsorted(timestamps, starts)
+    highs = np.searchsorted(timestamps, starts + window_ms)
+
+    pair_value = np.zeros(len(pair_keys))
+    pair_count = np.zeros(len(pair_keys), dtype=np.int64)
+    degree = np.zeros(n_names, dtype=np.int64)
+    previous = {key: np.full(n_names, np.nan) for key in ["pagerank", "eigenvector", "hub"]}
+    low = high = 0
+    frames = []
+    for start, new_low, new_high in zip(starts, lows, highs):
+        for rows, sign in [(slice(high, new_high), 1), (slice(low, new_low), -1)]:
+            np.add.at(pair_value, pair[rows], sign * value[rows])
+            np.add.at(pair_count, pair[rows], sign)
+            np.add.at(degree, src[rows], sign)
+            np.add.at(degree, dst[rows], sign)
+        low, high = new_low, new_high
+        live = np.flatnonzero(pair_count)
+        if not len(live):
+            continue
+        active = np.flatnonzero(degree)
+        local = np.full(n_names, -1)
+        local[active] = np.arange(len(active))
+        n = len(active)
+        upper = coo_matrix((pair_value[live], (local[pair_a[live]], local[pair_b[live]])), shape=(n, n))
+        adjacency = (upper + upper.T).tocsr()
+        strength = np.asarray(adjacency.sum(axis=1)).ravel()
+
+        pagerank = pagerank_iteration(adjacency, strength, _warm_start(previous["pagerank"], active, 1 / n))
+        pagerank /= pagerank.sum()
+        eigenvector = leading_eigenvector(adjacency, _warm_start(previous["eigenvector"], active, 1.0))
+        # for an undirected graph the hubs (leading eigenvector of A %*% t(A)) are that of A's largest |eigenvalue|
+        hub = leading_eigenvector(adjacency, _warm_start(previous["hub"], active, 1.0), which="LM")
+        for key, values in [("pagerank", pagerank), ("eigenvector", eigenvector), ("hub", hub)]:
+            previous[key][:] = np.nan
+            previous[key][active] = values
+        frames.append(pd.DataFrame({"name": names[active],
+                                    "start": start,
+                                    "end": start + window_ms,
+                                    "centrality_degreein": degree[active],
+                                    "pagerank": pagerank,
+                                    "eigenvector_centrality": eigenvector,
+                                    "hub_centrality": hub},
+                                   columns=ROLLING_COLUMNS))
+    if not frames:
+        return pd.DataFrame(columns=ROLLING_COLUMNS)
+    rolling = pd.concat(frames, ignore_index=True)
+    for column in ["start", "end"]:
+        rolling[column] = pd.to_datetime(rolling[column], unit="ms").dt.strftime("%Y-%m-%d")
+    return rolling
+
+
+def read_tidy(path, columns=TIDY_COLUMNS):
+    """ tidy_data (or raw_consensual) as stored by data_load.py, either the .cols table or the csv """
+    if Path(path).is_dir():
+        from table_store import read_schema, read_table
+        stored = {entry["name"] for entry in read_schema(path)["columns"]}
+        return read_table(path, columns=[column for column in columns if column in stored], categorical=False)
+    return pd.read_csv(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Node measures by year, month, week and day")
+    parser.add_argument("tidy_path", nargs="?", default="tidy_data.cols")
+    parser.add_argument("out_path", nargs="?", default="all_node_measures.csv")
+    parser.add_argument("--units", nargs="+", default=UNITS, choices=UNITS)
+    parser.add_argument("--workers", type=int, default=N_WORKERS)
+    parser.add_argument("--window", help="rolling windows of this length instead (e.g. 7D)")
+    parser.add_argument("--stride", default="1D", help="step between rolling windows")
+    parser.add_argument("--weighted", action="store_true", help="rolling measures on the weights, not message counts")
+    args = parser.parse_args()
+    if args.window:
+        measures = rolling_measures(read_tidy(args.tidy_path), args.window, args.stride, args.weighted)
+    else:
+        measures = node_measures(read_tidy(args.tidy_path), args.units, args.workers)
+    measures.to_csv(args.out_path, index=False)
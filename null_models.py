@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Permutation tests of the lockdown effect on weekly network measures.
+
+hypothesis_testing.csv compares lockdown and non-lockdown weeks through
+brms models. This is the non-parametric check: the effect (mean over the
+lockdown weeks minus mean over the other weeks) of a weekly graph measure
+is compared with its distribution under null models of the edge table:
+
+    timestamps   message times shuffled across all messages (weekly volume kept)
+    pair_times   each pair's weeks rotated by a random number of weeks (wrapping
+                 around), so the pair keeps its messages and their rhythm
+    rewire       receivers shuffled among the week's messages (each person's weekly
+                 in- and out-degree kept, self-messages made this way are dropped)
+
+Weeks are lubridate weeks (round_date, as node_metrics.py), lockdown weeks
+are the ones in the lockdown or third semester (friendship.py). The graphs
+are the ones of node_metrics.py (undirected, message counts) and the
+measures are computed for all weeks of a batch of replicates at once as
+stacked dense matrices:
+
+    pagerank      standard deviation of n * pagerank (0 if everyone is equal)
+    transitivity  global transitivity of the simple graph (clustering_coef)
+    density       messages / possible pairs
+
+Replicates run in batches across a process pool. The edge arrays are put
+in shared memory once, workers attach to them instead of getting a copy
+with every batch. Each batch has its own seed (spawned from seed), so the
+results don't depend on the number of workers.
+
+    python null_models.py tidy_data.cols permutation_testing.csv permutation_nulls.csv --replicates 2000
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from friendship import LOCKDOWN_PERIODS, within
+from node_metrics import BATCH_CELLS, DAMPING, TIDY_COLUMNS, message_edges, read_tidy, round_date, window_batches
+
+NULL_MODELS = ["timestamps", "pair_times", "rewire"]
+METRICS = ["pagerank", "transitivity", "density"]
+REPLICATES = 1000
+SEED = 0
+# every worker builds the dense matrices of a batch, a few are enough
+N_WORKERS = min(4, os.cpu_count() or 1)
+# edges of all replicates of a batch together
+BATCH_EDGES = 2**22
+TEST_COLUMNS = ["null_model", "metric", "effect", "null_mean", "null_sd", "p_greater", "p_less",
+                "p_two_sided", "replicates"]
+
+# the worker's views of the shared edge arrays
+_edges = {}
+
+
+def dense_metrics(n_nodes, adjacency):
+    """ Pagerank spread and transitivity of a batch of (padded) adjacency matrices, as in batch_measures """
+    size = adjacency.shape[1]
+    active = np.arange(size)[None, :] < n_nodes[:, None]
+
+    strength = adjacency.sum(axis=2)
+    transition = adjacency / np.where(strength > 0, strength, 1)[:, :, None]
+    system = np.eye(size)[None] - DAMPING * transition.transpose(0, 2, 1)
+    teleport = (1 - DAMPING) * active
+    # n * pagerank, mean 1
+    pagerank = np.linalg.solve(system, teleport[:, :, None])[:, :, 0]
+    spread = np.sqrt((np.where(active, pagerank - 1, 0) ** 2).sum(axis=1) / n_nodes)
+
+    simple = (adjacency > 0).astype(np.float64)
+    closed = (np.matmul(simple, simple) * simple).sum(axis=(1, 2))
+    degree = simple.sum(axis=2)
+    triples = (degree * (degree - 1)).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        transitivity = np.where(triples > 0, closed / np.where(triples > 0, triples, 1), np.nan)
+    return spread, transitivity
+
+
+def window_metrics(win, src, dst, n_windows, n_names, max_cells=BATCH_CELLS):
+    """
+    The METRICS (windows x metrics) of the graph of every window (win is the
+    window of each message). Node order doesn't matter for them, so nodes are
+    numbered by name within a window and the messages are added straight into
+    the dense matrices, no sorting
+    """
+    keep = src != dst
+    win, src, dst = win[keep], src[keep], dst[keep]
+    metrics = np.full((n_windows, len(METRICS)), np.nan)
+    if not len(win):
+        return metrics
+    from_key = win.astype(np.int64) * n_names + src
+    to_key = win.astype(np.int64) * n_names + dst
+    present = np.zeros(n_windows * n_names, dtype=bool)
+    present[from_key] = True
+    present[to_key] = True
+    n_nodes = present.reshape(n_windows, n_names).sum(axis=1)
+    first_slot = np.concatenate([[0], np.cumsum(n_nodes)[:-1]])
+    slot = np.cumsum(present) - 1
+    a = slot[from_key] - first_slot[win]
+    b = slot[to_key] - first_slot[win]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        metrics[:, 2] = np.bincount(win, minlength=n_windows) / (n_nodes * (n_nodes - 1) / 2)
+
+    windows = np.flatnonzero(n_nodes)
+    batches = [windows[batch] for batch in window_batches(n_nodes[windows], max_cells)]
+    batch_of = np.empty(n_windows, dtype=np.int64)
+    position = np.empty(n_windows, dtype=np.int64)
+    for i, batch in enumerate(batches):
+        batch_of[batch] = i
+        position[batch] = np.arange(len(batch))
+    edge_batch = batch_of[win]
+    order = np.argsort(edge_batch, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(edge_batch, minlength=len(batches)))])
+    for i, batch in enumerate(batches):
+        rows = order[bounds[i]:bounds[i + 1]]
+        size = int(n_nodes[batch].max())
+        cells = (position[win[rows]] * size + a[rows]) * size + b[rows]
+        adjacency = np.bincount(cells, minlength=len(batch) * size * size).astype(np.float64)
+        adjacency = adjacency.reshape(len(batch), size, size)
+        adjacency += adjacency.transpose(0, 2, 1)
+        metrics[batch, 0], metrics[batch, 1] = dense_metrics(n_nodes[batch], adjacency)
+    return metrics
+
+
+def _shuffle_within(groups, by_group, values, rng):
+    """ values shuffled among the rows of the same group (by_group is the stable argsort of groups) """
+    shuffled = np.empty_like(values)
+    keys = (groups.astype(np.int64) << 32) | rng.integers(0, 2**32, len(groups))
+    shuffled[by_group] = values[np.argsort(keys)]
+    return shuffled
+
+
+def permuted(model, edges, n_windows, rng):
+    """ (window, from, to) of the messages under a null model """
+    win, src, dst = edges["win"], edges["src"], edges["dst"]
+    if model == "timestamps":
+        return win[rng.permutation(len(win))], src, dst
+    if model == "pair_times":
+        # shuffling the times of a pair among themselves would keep its weekly counts, its weeks are rotated instead
+        shift = rng.integers(0, n_windows, int(edges["pair"].max()) + 1)
+        return (win + shift[edges["pair"]]) % n_windows, src, dst
+    if model == "rewire":
+        return win, src, _shuffle_within(win, edges["by_win"], dst, rng)
+    raise ValueError(f"unknown null model {model!r}")
+
+
+def replicate_metrics(model, edges, n_windows, n_names, n_replicates, seed, max_cells=BATCH_CELLS):
+    """ Metrics (replicates x windows x metrics) of a batch of replicates of a null model, computed together """
+    rng = np.random.default_rng(seed)
+    wins, srcs, dsts = zip(*(permuted(model, edges, n_windows, rng) for _ in range(n_replicates)))
+    # replicate r's windows are r * n_windows, ...
+    offsets = np.repeat(np.arange(n_replicates) * n_windows, len(edges["win"]))
+    metrics = window_metrics(np.concatenate(wins) + offsets, np.concatenate(srcs), np.concatenate(dsts),
+                             n_replicates * n_windows, n_names, max_cells)
+    return metrics.reshape(n_replicates, n_windows, len(METRICS))
+
+
+def share_arrays(arrays):
+    """ Copies the arrays to shared memory blocks, returns the blocks and what attach_arrays needs """
+    blocks, specs = [], {}
+    for name, values in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, values.dtype, buffer=block.buf)[:] = values
+        blocks.append(block)
+        specs[name] = (block.name, values.shape, values.dtype.str)
+    return blocks, specs
+
+
+def attach_arrays(specs):
+    """ Pool initializer: read-only views of the shared edge arrays """
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        view = np.ndarray(shape, dtype, buffer=block.buf)
+        view.flags.writeable = False
+        # the block has to stay open as long as the view is used
+        _edges[name] = view
+        _edges[f"_{name}_block"] = block
+
+
+def _run_replicates(args):
+    return replicate_metrics(args[0], _edges, *args[1:])
+
+
+def lockdown_effects(metrics, lockdown):
+    """ Mean over the lockdown windows minus the mean over the others (... x metrics) """
+    with np.errstate(invalid="ignore"):
+        return (np.nanmean(metrics[..., lockdown, :], axis=-2)
+                - np.nanmean(metrics[..., ~lockdown, :], axis=-2))
+
+
+def null_distributions(df, null_models=NULL_MODELS, n_replicates=REPLICATES, seed=SEED,
+                       n_workers=N_WORKERS, batch_edges=BATCH_EDGES):
+    """
+    The observed lockdown effect of each metric and its null distribution
+    under each null model (a row per replicate, null model and metric)
+    """
+    src, dst, timestamps, _, names = message_edges(df)
+    weeks, win = np.unique(round_date(timestamps, "week"), return_inverse=True)
+    win = win.ravel()
+    lockdown = within(weeks, LOCKDOWN_PERIODS)
+    n_names = len(names)
+    _, pair = np.unique(np.minimum(src, dst).astype(np.int64) * n_names + np.maximum(src, dst), return_inverse=True)
+    edges = {"win": win, "src": src, "dst": dst, "pair": pair.ravel(), "by_win": np.argsort(win, kind="stable")}
+    observed = lockdown_effects(window_metrics(win, src, dst, len(weeks), n_names), lockdown)
+
+    per_batch = max(1, batch_edges // max(len(win), 1))
+    jobs = []
+    seeds = np.random.SeedSequence(seed).spawn(len(null_models) * -(-n_replicates // per_batch))
+    for model in null_models:
+        for start in range(0, n_replicates, per_batch):
+            jobs.append((model, len(weeks), n_names, min(per_batch, n_replicates - start), seeds[len(jobs)]))
+    if n_workers is not None and n_workers > 1:
+        blocks, specs = share_arrays(edges)
+        try:
+            with ProcessPoolExecutor(n_workers, initializer=attach_arrays, initargs=(specs,)) as pool:
+                results = list(pool.map(_run_replicates, jobs))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    else:
+        results = [replicate_metrics(job[0], edges, *job[1:]) for job in jobs]
+
+    frames = []
+    for model in null_models:
+        effects = lockdown_effects(np.concatenate([r for job, r in zip(jobs, results) if job[0] == model]),
+                                   lockdown)
+        for k, metric in enumerate(METRICS):
+            frames.append(pd.DataFrame({"null_model": model, "metric": metric,
+                                        "replicate": np.arange(len(effects)), "effect": effects[:, k]}))
+    return dict(zip(METRICS, observed)), pd.concat(frames, ignore_index=True)
+
+
+def permutation_tests(observed, nulls):
+    """ Empirical p-values of the observed effects against their null distributions (the +1 kind) """
+    rows = []
+    for (model, metric), null in nulls.groupby(["null_model", "metric"], sort=False):
+        effects = null["effect"].dropna().to_numpy()
+        effect = observed[metric]
+        n = len(effects)
+        rows.append({"null_model": model,
+                     "metric": metric,
+                     "effect": effect,
+                     "null_mean": effects.mean() if n else np.nan,
+                     "null_sd": effects.std(ddof=1) if n > 1 else np.nan,
+                     "p_greater": (1 + (effects >= effect).sum()) / (n + 1),
+                     "p_less": (1 + (effects <= effect).sum()) / (n + 1),
+                     "p_two_sided": (1 + (np.abs(effects - effects.mean()) >= abs(effect - effects.mean())).sum())
+                                    / (n + 1) if n else np.nan,
+                     "replicates": n})
+    return pd.DataFrame(rows, columns=TEST_COLUMNS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Permutation tests of the lockdown effect on weekly network measures")
+    parser.add_argument("tidy_path", nargs="?", default="tidy_data.cols")
+    parser.add_argument("tests_path", nargs="?", default="permutation_testing.csv")
+    parser.add_argument("nulls_path", nargs="?", default="permutation_nulls.csv")
+    parser.add_argument("--null-models", nargs="+", default=NULL_MODELS, choices=NULL_MODELS)
+    parser.add_argument("--replicates", type=int, default=REPLICATES)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--workers", type=int, default=N_WORKERS)
+    args = parser.parse_args()
+    observed, nulls = null_distributions(read_tidy(args.tidy_path, TIDY_COLUMNS), args.null_models,
+                                         args.replicates, args.seed, args.workers)
+    permutation_tests(observed, nulls).to_csv(args.tests_path, index=False)
+    nulls.to_csv(args.nulls_path, index=False)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+The dedup, consent and tidy steps of data_load.py in bounded memory, for when
+the edges don't fit.
+
+Edges are kept as parts, a directory of tables (table_store) that
+process_people(spill_dir=...) writes a person at a time. Every step streams
+the parts in chunks of chunk_rows(max_memory) rows. What has to be known
+about the whole table is per id (group memberships, who is a cogsci,
+who consented), so it is small: it's gathered first and applied to every
+chunk as lookup tables over id codes.
+
+Duplicates are found by hash partitioning: rows are spilled to partition
+files by a hash of their values, each partition is deduplicated on its own
+and the first occurrence of every row is marked in an on-disk bitmap. The
+parts are then streamed again, giving drop_duplicates' rows in its order.
+
+    dedup_parts("../spill", "../full_mess.parts")
+    replacements = consent_parts("../full_mess.parts", "raw_consensual.parts", dropout_df["name"], load_cog_hash())
+    tidy_parts("raw_consensual.parts", "tidy_data.parts")
+    export_parts_csv("tidy_data.parts", "tidy_data.csv")
+"""
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import profiling
+from group_edges import expand_group_edges, group_keys, incidence
+from identity import id_replacements
+from interning import add_ids, id_mask, id_values, non_cog_mask, random_id_lookup, resolve_codes
+from table_store import REL_TYPES, read_schema, read_table, typed_edges, write_table
+
+MAX_MEMORY = 2**30
+# bytes a row takes while a chunk is worked on (its columns, codes, masks and copies)
+ROW_BYTES = 256
+MAX_PARTITIONS = 1024
+# missing timestamps (group memberships) in the dedup records
+MISSING_TIME = np.iinfo(np.int64).min
+RECORD = np.dtype([("row", np.int64), ("from", np.int32), ("to", np.int32),
+                   ("timestamp", np.int64), ("rel_type", np.int8)])
+
+
+def chunk_rows(max_memory=MAX_MEMORY):
+    return max(1, int(max_memory) // ROW_BYTES)
+
+
+def part_paths(parts_dir):
+    return sorted(Path(parts_dir).glob("*.cols"))
+
+
+def count_rows(paths):
+    return sum(read_schema(path)["n_rows"] for path in paths)
+
+
+def new_parts(parts_dir):
+    """ Empties (or makes) a parts directory """
+    parts_dir = Path(parts_dir)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    parts_dir.mkdir(parents=True)
+    return parts_dir
+
+
+def write_part(df, parts_dir, i):
+    """ Writes chunk i of a step, unless it's empty (its ids couldn't be typed like the others') """
+    if len(df):
+        write_table(df, Path(parts_dir) / f"part_{i:05d}.cols")
+
+
+def iter_frames(paths, rows, columns=None):
+    """ (first row number, frame) of at most rows rows at a time, read memory-mapped from the parts """
+    start = 0
+    for path in paths:
+        table = read_table(path, columns)
+        for begin in range(0, len(table), rows):
+            chunk = table.iloc[begin:begin + rows]
+            yield start + begin, chunk
+        start += len(table)
+
+
+def intern(values, names, lookup):
+    """ Codes of values in names (which grows, lookup is name -> code), missing values are -1 """
+    codes, uniques = pd.factorize(values)
+    mapping = np.empty(len(uniques) + 1, dtype=np.int32)
+    for i, name in enumerate(uniques):
+        code = lookup.get(name)
+        if code is None:
+            code = lookup[name] = len(names)
+            names.append(name)
+        mapping[i] = code
+    mapping[-1] = -1
+    return mapping[codes]
+
+
+def id_codes(column, names, lookup):
+    """ Codes of an id column, mapping a categorical's categories only """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return np.append(intern(column.cat.categories, names, lookup), -1)[column.cat.codes.to_numpy()]
+    return intern(column.to_numpy(), names, lookup)
+
+
+def time_codes(column):
+    """ Timestamps as int64 with MISSING_TIME for the missing ones """
+    return pd.to_numeric(column).round().astype("Int64").to_numpy(np.int64, na_value=MISSING_TIME)
+
+
+def rel_codes(column):
+    return pd.Categorical(column, categories=REL_TYPES).codes.astype(np.int8)
+
+
+def iter_codes(paths, rows, names, lookup):
+    """ (first row number, from, to, timestamp, rel_type codes) chunks of the parts """
+    for start, chunk in iter_frames(paths, rows):
+        yield (start, id_codes(chunk["from"], names, lookup), id_codes(chunk["to"], names, lookup),
+               time_codes(chunk["timestamp"]), rel_codes(chunk["rel_type"]))
+
+
+def _mix(x):
+    """ splitmix64 finalizer (uint64 arrays) """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def row_hash(records):
+    """ 64 bit hash of the values of each record (not its row number) """
+    h = _mix(records["from"].astype(np.int64).view(np.uint64))
+    for field in ["to", "timestamp", "rel_type"]:
+        h = _mix(h ^ records[field].astype(np.int64).view(np.uint64))
+    return h
+
+
+def first_occurrences(records):
+    """ Positions of the first record (by row number) of every distinct value """
+    order = np.lexsort((records["row"], records["rel_type"], records["timestamp"], records["to"], records["from"]))
+    ordered = records[order]
+    first = np.ones(len(ordered), dtype=bool)
+    for field in ["from", "to", "timestamp", "rel_type"]:
+        first[1:] &= ordered[field][1:] == ordered[field][:-1]
+    first[1:] = ~first[1:]
+    return order[first]
+
+
+def edge_frame(from_codes, to_codes, timestamps, rels, names, all_names=False):
+    """
+    Typed edge frame from codes: categorical ids over the names it uses (over
+    all the names with all_names, so the frames can be concatenated and
+    compared as they are), Int64 timestamps
+    """
+    if all_names:
+        categories = pd.Index(names)
+        from_codes, to_codes = from_codes.astype(np.int32), to_codes.astype(np.int32)
+    else:
+        used, codes = np.unique(np.concatenate([from_codes, to_codes, [-1]]), return_inverse=True)
+        codes = codes.ravel().astype(np.int32) - 1
+        categories = pd.Index([names[code] for code in used[1:]])
+        from_codes, to_codes = codes[:len(from_codes)], codes[len(from_codes):-1]
+    return pd.DataFrame({"from": pd.Categorical.from_codes(from_codes, categories=categories),
+                         "to": pd.Categorical.from_codes(to_codes, categories=categories),
+                         "timestamp": pd.arrays.IntegerArray(timestamps, timestamps == MISSING_TIME),
+                         "rel_type": pd.Categorical.from_codes(rels, categories=REL_TYPES)})
+
+
+def partition_path(work_dir, p):
+    return Path(work_dir) / f"{p:04d}.bin"
+
+
+def dedup_parts(in_dir, out_dir, max_memory=MAX_MEMORY):
+    """
+    drop_duplicates over all the parts of in_dir (in their order), written as
+    parts to out_dir. Rows are spilled to partitions by hash that are each
+    deduplicated in max_memory. Returns the number of rows kept
+    """
+    paths = part_paths(in_dir)
+    n_rows = count_rows(paths)
+    rows = chunk_rows(max_memory)
+    out_dir = new_parts(out_dir)
+    work = new_parts(out_dir.with_name(out_dir.name + ".work"))
+    n_partitions = int(min(MAX_PARTITIONS, max(1, -(-n_rows * RECORD.itemsize * 4 // int(max_memory)))))
+    names, lookup = [], {}
+
+    with profiling.stage("dedup_spill", rows_in=n_rows, partitions=n_partitions):
+        for start, from_codes, to_codes, timestamps, rels in iter_codes(paths, rows, names, lookup):
+            records = np.empty(len(from_codes), dtype=RECORD)
+            records["row"] = np.arange(start, start + len(records))
+            records["from"], records["to"], records["timestamp"], records["rel_type"] = (
+                from_codes, to_codes, timestamps, rels)
+            partition = row_hash(records) % np.uint64(n_partitions)
+            order = np.argsort(partition, kind="stable")
+            bounds = np.searchsorted(partition[order], np.arange(n_partitions + 1))
+            # a file at a time, a thousand partitions open at once would hit the limit on open files
+            for p in np.flatnonzero(np.diff(bounds)):
+                with open(partition_path(work, p), "ab") as f:
+                    f.write(records[order[bounds[p]:bounds[p + 1]]].tobytes())
+
+    with profiling.stage("dedup_partitions") as record:
+        keep = np.lib.format.open_memmap(work / "keep.npy", mode="w+", dtype=bool, shape=(n_rows,))
+        for p in range(n_partitions):
+            path = partition_path(work, p)
+            if not path.exists():
+                continue
+            records = np.fromfile(path, dtype=RECORD)
+            keep[records["row"][first_occurrences(records)]] = True
+            path.unlink()
+        record["rows_out"] = n_kept = int(keep.sum())
+
+    with profiling.stage("dedup_write", rows_out=n_kept):
+        for i, (start, from_codes, to_codes, timestamps, rels) in enumerate(iter_codes(paths, rows, names, lookup)):
+            kept = np.asarray(keep[start:start + len(from_codes)])
+            write_part(edge_frame(from_codes[kept], to_codes[kept], timestamps[kept], rels[kept], names), out_dir, i)
+    del keep
+    shutil.rmtree(work)
+    return n_kept
+
+
+def consent_parts(in_dir, out_dir, consent_names, cog_hashes=None, max_memory=MAX_MEMORY, random_ids=True):
+    """
+    resolve_ids, remove_non_cogs (when cog_hashes are given), filter_consent and
+    the random ids of data_load.py over deduplicated parts, written as parts to
+    out_dir. Returns the id -> random id replacements (for dropout_df), None
+    without random_ids
+    """
+    paths = part_paths(in_dir)
+    rows = chunk_rows(max_memory)
+    out_dir = new_parts(out_dir)
+    names, lookup = [], {}
+
+    # the memberships and the senders are all that's needed to know who is kept
+    with profiling.stage("consent_scan"):
+        group_from, group_to, senders = [], [], []
+        for _, from_codes, to_codes, timestamps, rels in iter_codes(paths, rows, names, lookup):
+            is_group = rels == REL_TYPES.index("group")
+            group_from.append(from_codes[is_group])
+            group_to.append(to_codes[is_group])
+            senders.append(np.unique(from_codes))
+        group_from, group_to = np.concatenate(group_from or [[]]).astype(np.int32), np.concatenate(group_to or [[]]).astype(np.int32)
+        senders = np.unique(np.concatenate(senders or [[]])).astype(np.int32)
+
+    # resolve_ids on the ids table: aliases get the code of the name they stand for
+    ids, resolve = resolve_codes(pd.Index(names, dtype=object), id_replacements())
+    ids = add_ids(ids, consent_names)
+    group_from, group_to, senders = resolve[group_from], resolve[group_to], resolve[senders]
+
+    # remove_non_cogs: senders that aren't cogsci and the groups they are in
+    non_cog = np.zeros(len(ids) + 1, dtype=bool)
+    if cog_hashes is not None:
+        non_cog = non_cog_mask(senders, group_from, group_to, id_mask(ids, cog_hashes))
+    # filter_consent: the consenting people and the groups left after the above
+    allowed = id_mask(ids, consent_names)
+    cog_groups = ~non_cog[group_from] & ~non_cog[group_to]
+    allowed[group_to[cog_groups]] = True
+    allowed &= ~non_cog
+
+    def kept_chunks():
+        for start, from_codes, to_codes, timestamps, rels in iter_codes(paths, rows, names, lookup):
+            from_codes, to_codes = resolve[from_codes], resolve[to_codes]
+            kept = allowed[from_codes] & allowed[to_codes]
+            yield from_codes[kept], to_codes[kept], timestamps[kept], rels[kept]
+
+    if not random_ids:
+        # tidy_parts puts the memberships of all the parts together with each part, the categories have to match
+        with profiling.stage("consent_write"):
+            for i, chunk in enumerate(kept_chunks()):
+                write_part(edge_frame(*chunk, ids, all_names=True), out_dir, i)
+        return None
+
+    # random ids for everyone left and the consenting people (create_random_ids)
+    with profiling.stage("consent_ids"):
+        present = id_mask(ids, consent_names)
+        for from_codes, to_codes, _, _ in kept_chunks():
+            present[from_codes] = present[to_codes] = True
+        # a missing id that got through gets an id too, as in create_random_ids
+        random_code = random_id_lookup(present)
+    with profiling.stage("consent_write"):
+        for i, (from_codes, to_codes, timestamps, rels) in enumerate(kept_chunks()):
+            chunk = pd.DataFrame({"from": random_code[from_codes], "to": random_code[to_codes],
+                                  "timestamp": pd.arrays.IntegerArray(timestamps, timestamps == MISSING_TIME),
+                                  "rel_type": pd.Categorical.from_codes(rels, categories=REL_TYPES)})
+            write_part(typed_edges(chunk), out_dir, i)
+    present_codes = np.flatnonzero(present)
+    # the missing slot's code is len(ids), as -1 it's taken as a missing id
+    keys = id_values(np.where(present_codes < len(ids), present_codes, -1), ids)
+    return dict(zip(keys, random_code[present_codes].tolist()))
+
+
+def gather_groups(paths):
+    """ The group membership rows of all the parts (small), as one frame """
+    groups = [table[(table["rel_type"] == "group").to_numpy()]
+              for table in (read_table(path) for path in paths)]
+    groups = [table for table in groups if len(table)]
+    return pd.concat(groups, ignore_index=True) if groups else read_table(paths[0]).iloc[:0]
+
+
+def tidy_parts(in_dir, out_dir, max_memory=MAX_MEMORY):
+    """
+    tidy_pipeline over the parts of in_dir (raw_consensual), written as parts
+    to out_dir. The memberships are gathered once and every chunk is cut so
+    that its expansion stays within max_memory. Returns the number of rows written
+    """
+    paths = part_paths(in_dir)
+    rows = chunk_rows(max_memory)
+    out_dir = new_parts(out_dir)
+    membership = incidence(gather_groups(paths)) if paths else None
+    # a last slot of 1 for the key -1 of other messages
+    sizes = np.append(np.diff(membership[1].indptr), 1) if paths else None
+    n_written = n_parts = 0
+    with profiling.stage("tidy_parts") as record:
+        for path in paths:
+            table = read_table(path)
+            key = group_keys(table["to"], membership[0])
+            expanded = np.cumsum(np.where(key >= 0, sizes[key], 1))
+            cuts = np.unique(np.append(np.searchsorted(expanded, np.arange(rows, expanded[-1] if len(expanded) else 0, rows)),
+                                       [0, len(table)]))
+            for begin, end in zip(cuts[:-1], cuts[1:]):
+                tidy_df = expand_group_edges(table.iloc[begin:end], membership)
+                write_part(typed_edges(tidy_df), out_dir, n_parts)
+                n_parts += 1
+                n_written += len(tidy_df)
+        record["rows_out"] = n_written
+    return n_written
+
+
+def read_parts(parts_dir, columns=None, categorical=True):
+    """ All the parts as one frame (when it fits) """
+    frames = [read_table(path, columns, categorical=categorical) for path in part_paths(parts_dir)]
+    return pd.concat(frames, ignore_index=True)
+
+
+def export_parts_csv(parts_dir, csv_path, columns=None):
+    """ Writes the parts as one csv (for the R scripts), a part at a time """
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        for i, path in enumerate(part_paths(parts_dir)):
+            read_table(path, columns, categorical=False).to_csv(f, index=False, header=i == 0)
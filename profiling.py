@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Stage timings for long data_load.py runs.
+
+Code is wrapped in stages, which can say how many rows went in and out
+and how many bytes were read:
+
+    with stage("decode", member=file_name) as record:
+        ...
+        record["rows_out"] = len(messages)
+
+When profiling is on (enable(path), or the PROFILE_PATH environment
+variable) each stage appends a JSON line with its wall time, CPU time and
+peak memory (the stage's own on linux, the process' so far elsewhere),
+tagged with the fields of the stages around it (person, member, ...).
+Worker processes append to the same file. When it's off, stage() hands
+back a do-nothing context with a throwaway dict.
+
+    python profiling.py ../profile.jsonl --top 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+_path = None
+_file = None
+_file_pid = None
+# open stages of this process, innermost last
+_stack = []
+
+
+def enable(path):
+    """ Turns profiling on, appending records to path """
+    global _path
+    _path = os.fspath(path)
+
+
+def disable():
+    global _path
+    _path = None
+
+
+def enabled():
+    return _path is not None
+
+
+def stage(name, **fields):
+    """ Context timing a stage (yields a dict for rows_in, rows_out, bytes, ...) """
+    if _path is None:
+        # a fresh dict, so nothing a caller stores outlives its stage
+        return nullcontext({})
+    return _profiled(name, fields)
+
+
+def _clear_peak():
+    """ Resets the peak RSS of this process (linux), False if it can't be done """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """ Peak RSS (since it was cleared on linux) in MB, None if it isn't known """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # kilobytes on linux, bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _write(record):
+    """ One line per write, so processes appending to the same file don't interleave """
+    global _file, _file_pid
+    if _file is None or _file_pid != os.getpid():
+        _file = open(_path, "a", encoding="utf-8")
+        _file_pid = os.getpid()
+    _file.write(json.dumps(record, default=str) + "\n")
+    _file.flush()
+
+
+@contextmanager
+def _profiled(name, fields):
+    context = {**_stack[-1]["context"], **fields} if _stack else fields
+    if _stack:
+        # clearing resets the high-water mark, the open stages keep what they reached so far
+        peak = _peak_rss_mb() or 0.0
+        for open_frame in _stack:
+            open_frame["peak"] = max(open_frame["peak"], peak)
+    frame = {"context": context, "peak": 0.0}
+    _stack.append(frame)
+    record = {}
+    _clear_peak()
+    start = time.time()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        _stack.pop()
+        peak = max(frame["peak"], _peak_rss_mb() or 0.0)
+        # a nested stage clears the peak, so it's handed on to the stages around it
+        if _stack:
+            _stack[-1]["peak"] = max(_stack[-1]["peak"], peak)
+        _write({"stage": name, **context, **record, "wall_s": wall, "cpu_s": cpu,
+                "peak_rss_mb": peak or None, "start": start, "pid": os.getpid()})
+
+
+def read_profile(path):
+    import pandas as pd
+    return pd.read_json(path, lines=True)
+
+
+def stage_summary(profile):
+    """ Per stage: calls, total and slowest wall time, CPU time, rows, bytes and peak memory """
+    profile = profile.reindex(columns=profile.columns.union(["rows_in", "rows_out", "bytes"]))
+    summary = profile.groupby("stage").agg(calls=("wall_s", "size"),
+                                           wall_s=("wall_s", "sum"),
+                                           max_wall_s=("wall_s", "max"),
+                                           cpu_s=("cpu_s", "sum"),
+                                           rows_in=("rows_in", "sum"),
+                                           rows_out=("rows_out", "sum"),
+                                           bytes=("bytes", "sum"),
+                                           peak_rss_mb=("peak_rss_mb", "max"))
+    return summary.sort_values("wall_s", ascending=False)
+
+
+def slowest(profile, stage_name, top=10, by="wall_s"):
+    """ The top slowest records of a stage ('conversation', 'person', ...) """
+    records = profile[profile["stage"] == stage_name].dropna(axis=1, how="all")
+    records = records.drop(columns=["stage", "start", "pid"], errors="ignore")
+    return records.nlargest(top, by)
+
+
+def report(path, top=10):
+    """ Text report of the stages and the slowest people and conversations """
+    import pandas as pd
+    profile = read_profile(path)
+    parts = [("stages", stage_summary(profile))]
+    for stage_name in ["person", "conversation"]:
+        if (profile["stage"] == stage_name).any():
+            parts.append((f"slowest {stage_name}s", slowest(profile, stage_name, top)))
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.max_colwidth", 40):
+        return "\n\n".join(f"{title}:\n{table.to_string()}" for title, table in parts)
+
+
+if os.environ.get("PROFILE_PATH"):
+    enable(os.environ["PROFILE_PATH"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summary of a profile written by data_load.py")
+    parser.add_argument("profile_path")
+    parser.add_argument("--top", type=int, default=10, help="how many of the slowest to show")
+    args = parser.parse_args()
+    print(report(args.profile_path, args.top))
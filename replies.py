@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Replies, response latencies and conversation initiations between people.
+
+What the "Cognitive models" chunk of timeseries_visualization.Rmd was after,
+at millisecond precision and without per-group lag chains. Messages are sorted
+once by pair and time; each message is then compared with the pair's previous
+message and joined (searchsorted) to the other person's latest message to them.
+
+    reply        the pair's previous message was from the other person, within threshold
+    initiation   no message between the two (either way) for gap before this one
+
+    python replies.py tidy_data.cols reply_events.cols reply_summary.csv --threshold 7D --gap 7D
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from node_metrics import TIDY_COLUMNS, message_edges, read_tidy
+
+REPLY_THRESHOLD = "7D"
+INITIATION_GAP = "7D"
+# raw_consensual rows that are messages between people (group rows are memberships)
+MESSAGE_TYPES = ["msg", "reaction"]
+EVENT_COLUMNS = ["from", "to", "timestamp", "weight", "prior_weight", "pair_prior_weight",
+                 "since_previous_ms", "since_other_ms", "is_reply", "reply_latency_ms",
+                 "is_initiation", "ends_turn", "last_reply"]
+
+
+def _ms(duration):
+    return pd.Timedelta(duration) // pd.Timedelta(milliseconds=1)
+
+
+def group_starts(keys):
+    """ Index of the first row of each row's group (keys sorted) """
+    new_group = np.ones(len(keys), dtype=bool)
+    new_group[1:] = keys[1:] != keys[:-1]
+    return np.maximum.accumulate(np.where(new_group, np.arange(len(keys)), 0))
+
+
+def prior_sums(keys, values):
+    """ Sum of the values of the earlier rows of the same group (keys sorted) """
+    cumulative = np.cumsum(values)
+    starts = group_starts(keys)
+    return cumulative - values - (cumulative[starts] - values[starts])
+
+
+def last_before(keys, by_key, timestamps, query_keys):
+    """
+    searchsorted join over time sorted rows: for each row, the index of the
+    latest row with key query_keys[i] and an earlier timestamp, -1 if none.
+    by_key is the stable argsort of keys
+    """
+    n = len(keys)
+    if (int(max(keys.max(), query_keys.max())) + 1) * n >= 2**63:
+        raise OverflowError("too many pairs for the packed search keys")
+    # (key, row) packed, sorted as rows are in time order and by_key is stable
+    packed = keys[by_key] * n + by_key
+    queries = query_keys * n + np.searchsorted(timestamps, timestamps, side="left")
+    # searchsorted is much faster with the queries in order
+    query_order = np.argsort(queries)
+    position = _unsort(np.searchsorted(packed, queries[query_order]), query_order) - 1
+    found = position >= 0
+    found[found] = packed[position[found]] // n == query_keys[found]
+    return np.where(found, by_key[np.maximum(position, 0)], -1)
+
+
+def _nullable(values, valid):
+    """ Int64 column with <NA> where not valid """
+    return pd.arrays.IntegerArray(np.where(valid, values, 0).astype(np.int64), ~valid)
+
+
+def _unsort(values, order):
+    unsorted = np.empty_like(values)
+    unsorted[order] = values
+    return unsorted
+
+
+def message_stream(df, message_types=MESSAGE_TYPES):
+    """ Person to person messages in time order (from, to codes, int ms timestamps, weights) and the names """
+    if "rel_type" in df.columns:
+        df = df[df["rel_type"].isin(message_types)]
+    if "weight" not in df.columns:
+        df = df.assign(weight=1.0)
+    df = df[df["timestamp"].notna()]
+    src, dst, timestamps, weight, names = message_edges(df)
+    timestamps = np.rint(timestamps).astype(np.int64)
+    order = np.argsort(timestamps, kind="stable")
+    return src[order], dst[order], timestamps[order], weight[order], names
+
+
+def reply_events(df, threshold=REPLY_THRESHOLD, gap=INITIATION_GAP, message_types=MESSAGE_TYPES):
+    """
+    One row per message (in time order) with the weight already exchanged
+    (prior_weight from -> to, pair_prior_weight both ways), the time since the
+    pair's previous message and since the other's last message to from,
+    whether it's a reply (and its latency), an initiation, whether it ends the
+    sender's turn and when from last replied to to
+    """
+    src, dst, timestamps, weight, names = message_stream(df, message_types)
+    if not len(src):
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    n_names = len(names)
+    directed = src.astype(np.int64) * n_names + dst
+    undirected = np.minimum(src, dst).astype(np.int64) * n_names + np.maximum(src, dst)
+
+    # stable sorts by pair keep the time order within each pair
+    by_pair = np.argsort(undirected, kind="stable")
+    pair_keys = undirected[by_pair]
+    first = group_starts(pair_keys) == np.arange(len(by_pair))
+    previous = np.roll(by_pair, 1)
+    since_previous = _unsort(timestamps[by_pair] - timestamps[previous], by_pair)
+    has_previous = _unsort(~first, by_pair)
+    previous_from_other = _unsort(~first & (src[previous] != src[by_pair]), by_pair)
+    last = np.append(first[1:], True)
+    following = np.roll(by_pair, -1)
+    ends_turn = _unsort(last | (src[following] != src[by_pair]), by_pair)
+
+    by_direction = np.argsort(directed, kind="stable")
+    prior_weight = _unsort(prior_sums(directed[by_direction], weight[by_direction]), by_direction)
+    pair_prior_weight = _unsort(prior_sums(pair_keys, weight[by_pair]), by_pair)
+    other = last_before(directed, by_direction, timestamps, dst.astype(np.int64) * n_names + src)
+
+    is_reply = previous_from_other & (since_previous <= _ms(threshold))
+    return pd.DataFrame({"from": names[src],
+                         "to": names[dst],
+                         "timestamp": timestamps,
+                         "weight": weight,
+                         "prior_weight": prior_weight,
+                         "pair_prior_weight": pair_prior_weight,
+                         "since_previous_ms": _nullable(since_previous, has_previous),
+                         "since_other_ms": _nullable(timestamps - timestamps[other], other >= 0),
+                         "is_reply": is_reply,
+                         "reply_latency_ms": _nullable(since_previous, is_reply),
+                         "is_initiation": ~has_previous | (since_previous > _ms(gap)),
+                         "ends_turn": ends_turn,
+                         "last_reply": last_reply(directed, timestamps, is_reply, by_direction)},
+                        columns=EVENT_COLUMNS)
+
+
+def last_reply(directed, timestamps, is_reply, by_direction):
+    """ Time of the sender's previous reply to the same person (forward filled), <NA> before the first """
+    starts = group_starts(directed[by_direction])
+    # latest reply up to and including each row, shifted to strictly before
+    latest = np.maximum.accumulate(np.where(is_reply[by_direction], np.arange(len(by_direction)), -1))
+    before = np.concatenate([[-1], latest[:-1]])
+    valid = before >= starts
+    filled = timestamps[by_direction][np.maximum(before, 0)]
+    return _nullable(_unsort(filled, by_direction), _unsort(valid, by_direction))
+
+
+def latency_quantiles(events, by="from", quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    """ Reply latency distribution (ms) per sender """
+    replies = events[events["is_reply"]]
+    table = replies["reply_latency_ms"].astype(np.float64).groupby(replies[by]).quantile(list(quantiles)).unstack()
+    table.columns = [f"latency_p{round(q * 100)}_ms" for q in quantiles]
+    return table
+
+
+def person_summary(events, quantiles=(0.5, 0.9)):
+    """
+    Per person: messages sent, initiations, replies, the turns they received
+    (messages from someone else that the sender didn't follow up themselves),
+    the share of those they replied to in time and their latency quantiles
+    """
+    sent = events.groupby("from").agg(messages=("timestamp", "size"),
+                                      initiations=("is_initiation", "sum"),
+                                      replies=("is_reply", "sum"))
+    turns = events[events["ends_turn"]].groupby("to").size().rename("turns_received")
+    summary = sent.join(turns, how="outer").fillna(0).astype(np.int64)
+    summary["reply_rate"] = summary["replies"] / summary["turns_received"].where(summary["turns_received"] > 0)
+    summary = summary.join(latency_quantiles(events, quantiles=quantiles))
+    summary.index.name = "name"
+    return summary.reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replies, latencies and initiations per message")
+    parser.add_argument("tidy_path", nargs="?", default="tidy_data.cols")
+    parser.add_argument("events_path", nargs="?", default="reply_events.cols")
+    parser.add_argument("summary_path", nargs="?", default="reply_summary.csv")
+    parser.add_argument("--threshold", default=REPLY_THRESHOLD, help="longest gap a reply can have")
+    parser.add_argument("--gap", default=INITIATION_GAP, help="silence before a message starts a conversation")
+    args = parser.parse_args()
+    from table_store import write_table
+    events = reply_events(read_tidy(args.tidy_path, TIDY_COLUMNS + ["rel_type"]), args.threshold, args.gap)
+    write_table(events, args.events_path)
+    person_summary(events).to_csv(args.summary_path, index=False)
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the analysis chain as a graph of stages, rerunning only what is stale.
+
+    anonymize       raw/facebook-*.zip -> data/*.zip            (anonymize_messages.py, if raw/ has exports)
+    full_mess       data/*.zip -> ../full_mess.cols              (data_load.py: process_people, dedup)
+    cog_raw         -> ../ids.cols, ../cog_raw.cols              (data_load.py: intern, resolve, remove_non_cogs)
+    raw_consensual  -> raw_consensual.cols/.csv, dropout_dat.csv (data_load.py: filter_consent, random ids)
+    tidy_data       -> tidy_data.cols/.csv, tidy_index.cols      (data_load.py: tidy_pipeline)
+    node_measures   tidy_data.csv -> all_node_measures.csv       (convert.r)
+    brms_data       -> brms_model_data.csv, disaster_dat.csv     (brms_preprocessing.Rmd)
+    permutation     tidy_data.cols -> permutation_testing.csv    (null_models.py)
+
+Every stage declares its inputs, its outputs and its code. Stages depend
+on the stages writing their inputs. A stage is rerun when its code, version
+or an input changed since its last run, or when one of its outputs is
+missing or was changed by something else. The fingerprints are content
+hashes (blake2b, cached by size and mtime), so a stage that reruns and
+writes the same output doesn't make the stages after it rerun.
+
+Code is a file ("convert.r"), or for python a name in a module
+("data_load.py:tidy_pipeline"): the definition and, recursively, the
+definitions of the module level names it uses, including those imported
+from (or used as attributes of) the repo's other modules. The definitions
+are compared as syntax trees, so comments and formatting don't count. A
+change to tidy_pipeline only reruns tidy_data and the stages after it.
+
+Stages run as separate processes, independent ones at the same time (up to
+--jobs), their output going to stage_logs/<stage>.log. Wall time, CPU time
+and peak memory of each run (of the stage's process and its workers) are
+appended to stage_timings.jsonl in profiling.py's format, the fingerprints
+are kept in stage_state.json. Paths are relative to the working directory,
+as in data_load.py.
+
+    python stages.py                     # everything that is stale
+    python stages.py tidy_data --dry-run # what would run to bring tidy_data up to date
+    python stages.py --force cog_raw
+    python profiling.py stage_timings.jsonl
+"""
+import argparse
+import ast
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from graphlib import TopologicalSorter
+from pathlib import Path
+
+CODE_DIR = Path(__file__).resolve().parent
+STATE_PATH = Path("stage_state.json")
+TIMINGS_PATH = Path("stage_timings.jsonl")
+LOG_DIR = Path("stage_logs")
+# stages start their own worker pools, so only a few run at a time
+JOBS = min(4, os.cpu_count() or 1)
+STATE_VERSION = 1
+CHUNK_SIZE = 1 << 20
+
+RAW_DIR = Path("raw")
+DATA_DIR = Path("data")
+# dropout answers of the raw exports ({export file name: answer}), the question anonymize_messages.py asks
+RAW_ANSWERS = RAW_DIR / "dropout.json"
+COG_HASHES = Path("cogsci19.pkl")
+FULL_MESS = Path("../full_mess.cols")
+DROPOUT_RAW = Path("../dropout_raw.cols")
+IDS = Path("../ids.cols")
+COG_RAW = Path("../cog_raw.cols")
+# what load_cog_hash reads
+COG_HASHES_2 = Path("../cogsci19_2.pkl")
+
+
+class Stage:
+    """ A step of the chain: the command it runs, what it reads and writes and the code it depends on """
+
+    def __init__(self, name, command, inputs=(), outputs=(), code=(), version=1):
+        self.name = name
+        self.command = list(command)
+        self.inputs = [os.path.normpath(spec) for spec in inputs]
+        self.outputs = [os.path.normpath(spec) for spec in outputs]
+        self.code = list(code)
+        self.version = version
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+def python_step(name, inputs, outputs, code=(), version=1):
+    """ A stage running step_<name> of this module """
+    return Stage(name, [sys.executable, str(CODE_DIR / "stages.py"), "--step", name], inputs, outputs,
+                 [f"stages.py:step_{name}", *code], version)
+
+
+def pipeline():
+    """ data_load.py's definitions (without running its cells) """
+    from benchmark import load_pipeline
+    return load_pipeline(CODE_DIR / "data_load.py")
+
+
+def raw_exports(raw_dir=RAW_DIR):
+    return sorted(Path(raw_dir).glob("facebook*.zip"))
+
+
+def anonymized_path(export_path, data_dir=DATA_DIR):
+    """ Where an export's anonymized zip goes: the same place every time, without the name in it """
+    from identity import hash_name
+    return Path(data_dir) / f"all_the_data_{hash_name(Path(export_path).name)[:8]}.zip"
+
+
+def step_anonymize():
+    import anonymize_messages
+    from zipfile import ZIP_DEFLATED, ZipFile
+
+    anonymize_messages.COG_HASHES = anonymize_messages.as_hash_set(anonymize_messages.read_pickle(COG_HASHES))
+    with open(RAW_ANSWERS, encoding="utf-8") as f:
+        answers = json.load(f)
+    DATA_DIR.mkdir(exist_ok=True)
+    for export_path in raw_exports():
+        out_path = anonymized_path(export_path)
+        temp_path = out_path.with_name(f"{out_path.name}.tmp")
+        with ZipFile(temp_path, "w", ZIP_DEFLATED) as out_zip:
+            out_zip.writestr("dropout.json", json.dumps({"is_dropout": answers[export_path.name]}))
+            messages = anonymize_messages.iter_zip_messages([export_path])
+            anonymize_messages.anonymize_all(messages, out_zip, anonymize_messages.N_WORKERS)
+        os.replace(temp_path, out_path)
+
+
+def step_full_mess():
+    import pandas as pd
+
+    data_load = pipeline()
+    data_load.anonymize_folder(DATA_DIR)
+    data_paths = sorted(DATA_DIR.glob("*.zip"))
+    data_list = [None for _ in range(len(data_paths))]
+    plan = data_load.conversation_plan(data_paths)
+    data_load.process_people(data_paths, data_list, n_workers=data_load.N_WORKERS, plan=plan)
+    # the next stages need the dropout answers, the cells kept them in memory
+    data_load.write_table(data_load.create_dropout_df(data_paths, n_workers=data_load.N_WORKERS), DROPOUT_RAW)
+    data_load.write_table(data_load.typed_edges(pd.concat(data_list).drop_duplicates()), FULL_MESS)
+
+
+def step_cog_raw():
+    data_load = pipeline()
+    dropout_df = data_load.read_table(DROPOUT_RAW, categorical=False)
+    unique_master, ids = data_load.intern_ids(data_load.read_table(FULL_MESS))
+    ids, resolved_codes = data_load.resolve_codes(ids, data_load.id_replacements())
+    unique_master = data_load.relabel(unique_master, resolved_codes)
+    ids = data_load.add_ids(ids, dropout_df["name"])
+    data_load.write_ids(ids, IDS)
+    data_load.write_table(data_load.typed_edges(data_load.remove_non_cogs(unique_master, ids)), COG_RAW)
+
+
+def step_raw_consensual():
+    from interning import read_ids
+
+    data_load = pipeline()
+    ids = read_ids(IDS)
+    dropout_df = data_load.read_table(DROPOUT_RAW, categorical=False)
+    consent_df = data_load.filter_consent(data_load.read_table(COG_RAW), dropout_df["name"], ids)
+    dropout_codes = ids.get_indexer(dropout_df["name"])
+    random_lookup = data_load.create_random_lookup((consent_df["from"], consent_df["to"], dropout_codes), len(ids))
+    consent_df = data_load.relabel(consent_df, random_lookup)
+    dropout_df["name"] = random_lookup[dropout_codes]
+    dropout_df.to_csv("dropout_dat.csv", index=False)
+    data_load.write_table(data_load.typed_edges(consent_df), "raw_consensual.cols")
+    data_load.export_csv("raw_consensual.cols", "raw_consensual.csv")
+
+
+def step_tidy_data():
+    data_load = pipeline()
+    tidy_df = data_load.tidy_pipeline(data_load.read_table("raw_consensual.cols"))
+    data_load.write_table(data_load.typed_edges(tidy_df), "tidy_data.cols")
+    data_load.export_csv("tidy_data.cols", "tidy_data.csv")
+    data_load.build_index(data_load.read_table("tidy_data.cols"), "tidy_index.cols")
+
+
+STEPS = {"anonymize": step_anonymize,
+         "full_mess": step_full_mess,
+         "cog_raw": step_cog_raw,
+         "raw_consensual": step_raw_consensual,
+         "tidy_data": step_tidy_data}
+
+
+def chain(raw_dir=RAW_DIR):
+    """ The stages of the analysis (the anonymize stage only if there are raw exports) """
+    stages = []
+    exports = raw_exports(raw_dir)
+    if exports:
+        stages.append(python_step("anonymize", [*map(str, exports), str(RAW_ANSWERS), str(COG_HASHES)],
+                                  [str(anonymized_path(path)) for path in exports], ["anonymize_messages.py"]))
+    stages += [
+        python_step("full_mess", [str(DATA_DIR / "*.zip")], [FULL_MESS, DROPOUT_RAW]),
+        python_step("cog_raw", [FULL_MESS, DROPOUT_RAW, COG_HASHES_2], [IDS, COG_RAW]),
+        python_step("raw_consensual", [COG_RAW, IDS, DROPOUT_RAW],
+                    ["raw_consensual.cols", "raw_consensual.csv", "dropout_dat.csv"]),
+        python_step("tidy_data", ["raw_consensual.cols"], ["tidy_data.cols", "tidy_data.csv", "tidy_index.cols"]),
+        Stage("node_measures", ["Rscript", str(CODE_DIR / "convert.r")],
+              ["tidy_data.csv"], ["all_node_measures.csv"], ["convert.r"]),
+        Stage("brms_data", ["Rscript", "-e", f"rmarkdown::render({json.dumps(str(CODE_DIR / 'brms_preprocessing.Rmd'))}, "
+                                             "knit_root_dir = getwd(), output_dir = tempdir())"],
+              ["tidy_data.csv", "dropout_dat.csv"], ["brms_model_data.csv", "disaster_dat.csv"],
+              ["brms_preprocessing.Rmd"]),
+        Stage("permutation", [sys.executable, str(CODE_DIR / "null_models.py"), "tidy_data.cols",
+                              "permutation_testing.csv", "permutation_nulls.csv"],
+              ["tidy_data.cols"], ["permutation_testing.csv", "permutation_nulls.csv"], ["null_models.py"]),
+    ]
+    return stages
+
+
+# fingerprints
+
+
+def _is_glob(spec):
+    return glob.has_magic(spec)
+
+
+def file_digest(path, cache):
+    """ Content hash of a file, reused while its size and mtime are the same """
+    stat = os.stat(path)
+    cached = cache.get(str(path))
+    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    cache[str(path)] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def fingerprint(spec, cache):
+    """
+    Content hash of a file, a directory (a .cols table) or a glob, None if
+    there's nothing there. A glob's names don't count (anonymize_folder renames
+    the zips)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if _is_glob(spec):
+        paths = sorted(path for path in glob.glob(spec) if os.path.isfile(path))
+        if not paths:
+            return None
+        for part in sorted(file_digest(path, cache) for path in paths):
+            digest.update(part.encode())
+    elif os.path.isdir(spec):
+        for root, dirs, files in os.walk(spec):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(f"{os.path.relpath(path, spec)}\0{file_digest(path, cache)}\0".encode())
+    elif os.path.isfile(spec):
+        return file_digest(spec, cache)
+    else:
+        return None
+    return digest.hexdigest()
+
+
+def _imports(nodes):
+    """ {name: (module file, name in it, None for the module)} of the import statements among nodes """
+    imports = {}
+    for node in nodes:
+        if isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            for alias in node.names:
+                imports[alias.asname or alias.name] = (f"{node.module}.py", alias.name)
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                imports[alias.asname or alias.name] = (f"{alias.name}.py", None)
+    return imports
+
+
+def _module_names(path):
+    """ A module's syntax tree, its module level definitions and the names it imports """
+    tree = ast.parse(Path(path).read_text(encoding="utf-8"), str(path))
+    definitions = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            definitions.setdefault(node.name, []).append(node)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name):
+                        definitions.setdefault(name.id, []).append(node)
+    return tree, definitions, _imports(tree.body)
+
+
+def _local_names(node):
+    """ Names bound inside a function (arguments, assignments, ...) other than by imports, they aren't the module's """
+    if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+        return set()
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.arg):
+            names.add(child.arg)
+        elif isinstance(child, ast.Name) and isinstance(child.ctx, (ast.Store, ast.Del)):
+            names.add(child.id)
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and child is not node:
+            names.add(child.name)
+    return names
+
+
+def code_fingerprint(specs, code_dir=CODE_DIR):
+    """
+    Hash of the code of a stage: whole files ("convert.r") or python names
+    ("data_load.py:tidy_pipeline") with the definitions they use (see above)
+    """
+    modules = {}
+    parts = []
+    queue = [tuple(spec.split(":", 1)) if ":" in spec else (spec, None) for spec in specs]
+    done = set()
+    while queue:
+        item = queue.pop()
+        file_name, name = item
+        path = code_dir / file_name
+        if item in done or not path.is_file():
+            continue
+        done.add(item)
+        if not file_name.endswith(".py"):
+            parts.append(f"{file_name}\0{hashlib.blake2b(path.read_bytes(), digest_size=16).hexdigest()}")
+            continue
+        if file_name not in modules:
+            modules[file_name] = _module_names(path)
+        tree, definitions, module_imports = modules[file_name]
+        if name is not None and name not in definitions and name in module_imports:
+            # data_load.read_table is table_store's
+            queue.append(module_imports[name])
+            continue
+        nodes = [tree] if name is None else definitions.get(name, [])
+        for node in nodes:
+            parts.append(f"{file_name}:{name}\0{ast.dump(node)}")
+            local = _local_names(node)
+            # imports inside a function
+            imports = {**module_imports, **_imports(ast.walk(node))} if name is not None else module_imports
+            for child in ast.walk(node):
+                if isinstance(child, ast.Name) and child.id not in local:
+                    # a whole module already has its definitions
+                    if child.id in definitions and name is not None:
+                        queue.append((file_name, child.id))
+                    elif child.id in imports and imports[child.id][1] is not None:
+                        queue.append(imports[child.id])
+                elif isinstance(child, ast.Attribute) and isinstance(child.value, ast.Name):
+                    # module.name, also for modules bound to other names (data_load = pipeline())
+                    module = imports.get(child.value.id, (f"{child.value.id}.py", None))
+                    if module[1] is None:
+                        queue.append((module[0], child.attr))
+    digest = hashlib.blake2b(digest_size=16)
+    for part in sorted(parts):
+        digest.update(part.encode())
+    return digest.hexdigest()
+
+
+# graph and runs
+
+
+def stage_graph(stages):
+    """ {stage: the stages writing its inputs} """
+    writers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in writers:
+                raise ValueError(f"{output} is written by both {writers[output].name} and {stage.name}")
+            writers[output] = stage
+    graph = {}
+    for stage in stages:
+        graph[stage.name] = {writer.name for spec in stage.inputs for output, writer in writers.items()
+                             if writer is not stage and (output == spec or (_is_glob(spec)
+                                                                            and fnmatch.fnmatch(output, spec)))}
+    TopologicalSorter(graph).prepare()
+    return graph
+
+
+def upstream(graph, targets):
+    """ The targets and every stage they depend on """
+    needed, queue = set(), list(targets)
+    while queue:
+        name = queue.pop()
+        if name not in graph:
+            raise ValueError(f"unknown stage {name!r}")
+        if name not in needed:
+            needed.add(name)
+            queue.extend(graph[name])
+    return needed
+
+
+def load_state(path=STATE_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("version") == STATE_VERSION:
+            return state
+    except FileNotFoundError:
+        pass
+    return {"version": STATE_VERSION, "stages": {}, "files": {}}
+
+
+def save_state(state, path=STATE_PATH):
+    temp_path = Path(f"{path}.tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1)
+    os.replace(temp_path, path)
+
+
+def staleness(stage, record, code, inputs, outputs):
+    """ Why a stage has to run, None if it's up to date """
+    if record is None:
+        return "never ran"
+    if record["code"] != code:
+        return "code changed"
+    if record["version"] != stage.version or record["command"] != stage.command:
+        return "stage changed"
+    changed = [spec for spec in stage.inputs if record["inputs"].get(spec) != inputs[spec]]
+    if changed:
+        return f"input changed: {', '.join(changed)}"
+    changed = [spec for spec in stage.outputs if outputs[spec] is None or record["outputs"].get(spec) != outputs[spec]]
+    if changed:
+        return f"output missing or changed: {', '.join(changed)}"
+    return None
+
+
+def run_command(command, log_path):
+    """ Runs a stage's command, returns its exit code and its wall time, CPU time and peak memory """
+    start = time.time()
+    wall = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        try:
+            process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            # Rscript not installed, ...
+            log.write(f"{e}\n")
+            return 127, {"wall_s": time.perf_counter() - wall, "cpu_s": None, "peak_rss_mb": None,
+                         "start": start, "pid": None}
+        if hasattr(os, "wait4"):
+            # the usage of the process and the workers it waited for
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            cpu = usage.ru_utime + usage.ru_stime
+            # kilobytes on linux, bytes on mac
+            peak = usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+        else:
+            process.wait()
+            cpu = peak = None
+    return process.returncode, {"wall_s": time.perf_counter() - wall, "cpu_s": cpu, "peak_rss_mb": peak,
+                                "start": start, "pid": process.pid}
+
+
+def _append_timing(record, path):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def _log_tail(log_path, n_lines=20):
+    with open(log_path, encoding="utf-8", errors="replace") as f:
+        return "".join(f.readlines()[-n_lines:])
+
+
+def run_stages(stages, targets=None, jobs=JOBS, force=(), dry_run=False, state_path=STATE_PATH,
+               timings_path=TIMINGS_PATH, log_dir=LOG_DIR):
+    """
+    Brings the targets (all stages by default) up to date, running stale
+    stages as soon as the stages before them are done. Returns
+    {stage: (status, reason)}, the status being "up to date", "ran",
+    "would run", "failed" or "skipped" (a stage before it failed)
+    """
+    by_name = {stage.name: stage for stage in stages}
+    graph = stage_graph(stages)
+    needed = upstream(graph, by_name if targets is None else targets)
+    sorter = TopologicalSorter({name: graph[name] for name in needed})
+    sorter.prepare()
+    state = load_state(state_path)
+    files = state["files"]
+    results = {}
+    running = {}
+    Path(log_dir).mkdir(parents=True, exist_ok=True)
+
+    def start(name):
+        """ Submits the stage if it has to run, otherwise says why not """
+        stage = by_name[name]
+        if any(results[before][0] in ("failed", "skipped") for before in graph[name]):
+            return "skipped", "a stage before it failed"
+        if dry_run and any(results[before][0] == "would run" for before in graph[name]):
+            return "would run", "a stage before it runs"
+        code = code_fingerprint(stage.code)
+        inputs = {spec: fingerprint(spec, files) for spec in stage.inputs}
+        outputs = {spec: fingerprint(spec, files) for spec in stage.outputs}
+        reason = "forced" if name in force else staleness(stage, state["stages"].get(name), code, inputs, outputs)
+        missing = [spec for spec, digest in inputs.items() if digest is None]
+        if reason is None:
+            return "up to date", None
+        if dry_run:
+            return "would run", reason
+        if missing:
+            return "failed", f"missing input: {', '.join(missing)}"
+        print(f"{name}: running ({reason})", flush=True)
+        future = pool.submit(run_command, stage.command, Path(log_dir) / f"{name}.log")
+        running[future] = (name, code, inputs)
+        return None
+
+    def finish(future):
+        name, code, inputs = running.pop(future)
+        stage = by_name[name]
+        log_path = Path(log_dir) / f"{name}.log"
+        returncode, timing = future.result()
+        outputs = {spec: fingerprint(spec, files) for spec in stage.outputs}
+        missing = [spec for spec, digest in outputs.items() if digest is None]
+        if returncode != 0:
+            status, reason = "failed", f"exit code {returncode}, see {log_path}:\n{_log_tail(log_path)}"
+        elif missing:
+            status, reason = "failed", f"didn't write {', '.join(missing)}"
+        else:
+            status, reason = "ran", None
+            state["stages"][name] = {"code": code, "version": stage.version,
+                                     "command": stage.command, "inputs": inputs, "outputs": outputs, **timing}
+        results[name] = (status, reason)
+        _append_timing({"stage": name, "status": status, **timing}, timings_path)
+        save_state(state, state_path)
+        print(f"{name}: {status} in {timing['wall_s']:.1f}s" + (f" ({reason})" if status == "failed" else ""),
+              flush=True)
+        sorter.done(name)
+
+    with ThreadPoolExecutor(max(jobs or 1, 1)) as pool:
+        while sorter.is_active():
+            for name in sorter.get_ready():
+                result = start(name)
+                if result is not None:
+                    results[name] = result
+                    sorter.done(name)
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(future)
+    if not dry_run:
+        # the file hashes of this run
+        save_state(state, state_path)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the stale stages of the analysis chain")
+    parser.add_argument("targets", nargs="*", help="stages to bring up to date (all of them by default)")
+    parser.add_argument("--jobs", type=int, default=JOBS, help="stages running at the same time")
+    parser.add_argument("--force", nargs="+", default=[], help="stages to run even if they are up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only show what would run and why")
+    parser.add_argument("--step", choices=list(STEPS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.step:
+        STEPS[args.step]()
+        sys.exit()
+    results = run_stages(chain(), args.targets or None, args.jobs, args.force, args.dry_run)
+    for name, (status, reason) in results.items():
+        print(f"{name:<16}{status:<12}{reason if reason and status != 'failed' else ''}")
+    if any(status in ("failed", "skipped") for status, _ in results.values()):
+        sys.exit(1)
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Facebook exports, for benchmarking and testing without real data.
+
+A cohort of people (the ones who hand in their data) chat with each other
+and with outsiders in direct chats and group chats. Every conversation is
+made once and written to the export of each cohort member taking part, like
+the real exports overlap. Exports are laid out like Facebook's
+(messages/inbox/<thread>/message_1.json, newest messages first, names
+mojibaked the way Facebook writes them) with Generic, Call, Share,
+Subscribe and Unsubscribe messages and reactions.
+
+The exports can then be run through anonymize_messages.py, giving the
+all_the_data_*.zip files (with dropout.json) that data_load.py reads.
+
+    python synthetic_data.py ../synthetic --people 10 --outsiders 40 --groups 6 --messages 300 --anonymize
+"""
+import argparse
+import json
+import os
+import pickle
+from pathlib import Path
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+
+from identity import hash_name
+
+FIRST_NAMES = ["Anne", "Mads", "Sofie", "Jonas", "Ida", "Emil", "Freja", "Oliver", "Laura", "Magnus",
+               "Cecilie", "Frederik", "Astrid", "Søren", "Line", "Rasmus", "Maja", "Tobias", "Clara", "Viktor",
+               "Pernille", "Lasse", "Signe", "Mikkel", "Julie", "Anders", "Karoline", "Jakob", "Emma", "Nikolaj"]
+LAST_NAMES = ["Hansen", "Jensen", "Nielsen", "Pedersen", "Andersen", "Christensen", "Larsen", "Sørensen",
+              "Rasmussen", "Jørgensen", "Petersen", "Madsen", "Kristensen", "Olsen", "Thomsen", "Møller",
+              "Poulsen", "Johansen", "Knudsen", "Mortensen", "Højlund", "Grønhøi", "Brams", "Kjær", "Lund"]
+WORDS = ["hej", "ja", "nej", "okay", "haha", "tak", "i", "morgen", "exam", "paper", "lecture", "coffee",
+         "the", "data", "model", "what", "did", "you", "think", "about", "it", "see", "later", "?", "!"]
+REACTIONS = ["😆", "😍", "😮", "😢", "😠", "👍", "❤"]
+
+# 2019-09-01 to 2021-01-01 UTC, the period of the study
+START_MS = 1567296000000
+END_MS = 1609459200000
+# Facebook splits conversations into message_1.json, message_2.json, ... of this many messages
+FILE_MESSAGES = 10_000
+
+DEFAULTS = {"n_people": 10,
+            "n_outsiders": 40,
+            "n_groups": 6,
+            "messages": 300,
+            "group_factor": 3.0,
+            "max_group_size": 12,
+            "direct_rate": 0.5,
+            "outsider_contacts": 8,
+            "reaction_rate": 0.15,
+            "call_rate": 0.01,
+            "share_rate": 0.03,
+            "leave_rate": 0.3,
+            "dropout_rate": 0.05,
+            "seed": 0}
+
+
+def fb_text(text):
+    """ Facebook writes utf-8 text as if it were latin-1 (mojibake), json escaped """
+    return text.encode("utf-8").decode("latin-1")
+
+
+def make_names(n, rng, taken=()):
+    """ n distinct names (not in taken), with a middle name if first + last is used up """
+    taken = set(taken)
+    names = []
+    while len(names) < n:
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        name = f"{first} {last}"
+        if name in taken:
+            name = f"{first} {rng.choice(LAST_NAMES)} {last}"
+        if name not in taken:
+            taken.add(name)
+            names.append(name)
+    return names
+
+
+def n_thread_messages(rng, mean):
+    """ Heavy tailed (lognormal) number of messages in a thread """
+    return max(1, int(rng.lognormal(np.log(mean) - 0.5, 1.0)))
+
+
+def message_times(rng, n):
+    """ n timestamps (ms, increasing) in bursts: sessions spread over the period, minutes apart within """
+    n_sessions = max(1, n // 20)
+    session = np.sort(rng.integers(0, n_sessions, n))
+    starts = np.sort(rng.integers(START_MS, END_MS, n_sessions))
+    gaps = rng.exponential(180_000, n).astype(np.int64)
+    first = np.flatnonzero(np.r_[True, session[1:] != session[:-1]])
+    offsets = np.cumsum(gaps) - np.repeat(np.cumsum(gaps)[first] - gaps[first], np.diff(np.r_[first, n]))
+    return np.minimum(starts[session] + offsets, END_MS - 1)
+
+
+def make_messages(rng, members, n, params, leavers=()):
+    """
+    Raw messages of a thread (oldest first). Group chats (more than two members)
+    start with members being added and end with the leavers leaving
+    """
+    times = message_times(rng, n)
+    is_group = len(members) > 2
+    messages = []
+    sender = rng.choice(members)
+    if is_group:
+        founder = members[0]
+        for user in members[1:]:
+            messages.append({"sender_name": founder, "timestamp_ms": int(times[0]),
+                             "content": f"{founder} added {user} to the group.",
+                             "type": "Subscribe", "users": [{"name": user}]})
+    for timestamp in times:
+        # people write a few messages in a row before the other answers
+        if rng.random() < 0.4:
+            sender = rng.choice(members)
+        draw = rng.random()
+        if draw < params["call_rate"]:
+            msg = {"sender_name": sender, "timestamp_ms": int(timestamp), "content": f"{sender} called you.",
+                   "type": "Call", "call_duration": int(rng.exponential(600))}
+        elif draw < params["call_rate"] + params["share_rate"]:
+            msg = {"sender_name": sender, "timestamp_ms": int(timestamp),
+                   "content": "https://www.youtube.com/watch?v=" + "".join(rng.choice(list("abcdefXYZ0123"), 11)),
+                   "share": {"link": "https://www.youtube.com/"}, "type": "Share"}
+        else:
+            msg = {"sender_name": sender, "timestamp_ms": int(timestamp),
+                   "content": " ".join(rng.choice(WORDS, rng.integers(1, 12))), "type": "Generic"}
+        if rng.random() < params["reaction_rate"]:
+            others = [member for member in members if member != sender]
+            actors = rng.choice(others, min(len(others), rng.integers(1, 3)), replace=False)
+            msg["reactions"] = [{"reaction": rng.choice(REACTIONS), "actor": actor} for actor in actors]
+        messages.append(msg)
+    for leaver in leavers:
+        messages.append({"sender_name": leaver, "timestamp_ms": int(times[-1]) + 1000,
+                         "content": f"{leaver} left the group.",
+                         "type": "Unsubscribe", "users": [{"name": leaver}]})
+    return messages
+
+
+def make_threads(cohort, outsiders, rng, params):
+    """
+    Thread specs (members, leavers, title, number of messages): direct chats within
+    the cohort and with outsiders, and group chats with at least one cohort member
+    """
+    threads = []
+    for i, person in enumerate(cohort):
+        for other in cohort[i + 1:]:
+            if rng.random() < params["direct_rate"]:
+                threads.append({"members": [person, other], "leavers": []})
+        n_contacts = min(len(outsiders), params["outsider_contacts"])
+        for other in rng.choice(outsiders, n_contacts, replace=False) if n_contacts else []:
+            threads.append({"members": [person, str(other)], "leavers": []})
+    people = cohort + outsiders
+    for g in range(params["n_groups"]):
+        size = int(rng.integers(3, max(3, min(params["max_group_size"], len(people))) + 1))
+        n_cohort = max(1, int(rng.binomial(size, 0.7)))
+        members = list(rng.choice(cohort, min(n_cohort, len(cohort)), replace=False))
+        members += list(rng.choice(outsiders, min(size - len(members), len(outsiders)), replace=False))
+        members = [str(member) for member in members]
+        leavers = [members.pop()] if rng.random() < params["leave_rate"] and len(members) > 3 else []
+        threads.append({"members": members, "leavers": leavers, "title": f"Study group {g + 1}"})
+    for k, thread in enumerate(threads):
+        factor = params["group_factor"] if "title" in thread else 1.0
+        thread["n_messages"] = n_thread_messages(rng, params["messages"] * factor)
+        thread["seed"] = int(rng.integers(2**63))
+        thread["id"] = k
+    return threads
+
+
+def thread_files(thread, messages, owner):
+    """ (member name, json text) of the thread as it is in owner's export """
+    is_group = len(thread["members"]) + len(thread["leavers"]) > 2
+    title = thread["title"] if is_group else next(m for m in thread["members"] if m != owner)
+    folder = "".join(c for c in title.lower() if c.isascii() and c.isalnum()) + f"_{thread['id']:08x}"
+    newest_first = messages[::-1]
+    for part, start in enumerate(range(0, len(newest_first), FILE_MESSAGES), start=1):
+        convo = {"participants": [{"name": fb_text(m)} for m in thread["members"]],
+                 "messages": [fb_message(msg) for msg in newest_first[start:start + FILE_MESSAGES]],
+                 "title": fb_text(title),
+                 "is_still_participant": owner not in thread["leavers"],
+                 "thread_type": "RegularGroup" if is_group else "Regular",
+                 "thread_path": f"inbox/{folder}"}
+        yield f"messages/inbox/{folder}/message_{part}.json", json.dumps(convo, indent=2)
+
+
+def fb_message(msg):
+    """ A raw message with its names and text the way they are in the export """
+    msg = {**msg, "sender_name": fb_text(msg["sender_name"])}
+    if "content" in msg:
+        msg["content"] = fb_text(msg["content"])
+    if "users" in msg:
+        msg["users"] = [{"name": fb_text(user["name"])} for user in msg["users"]]
+    if "reactions" in msg:
+        msg["reactions"] = [{"reaction": fb_text(r["reaction"]), "actor": fb_text(r["actor"])}
+                            for r in msg["reactions"]]
+    return msg
+
+
+def export_path(out_dir, i):
+    return Path(out_dir) / "raw" / f"facebook-person{i:03d}.zip"
+
+
+def write_exports(out_dir, **params):
+    """
+    Writes a raw export per cohort member to out_dir/raw (facebook-personNNN.zip)
+    and the cohort's hashes to out_dir/cogsci19.pkl. Returns a summary (names,
+    dropout answers, messages per export) that is also saved as out_dir/synthetic.json
+    """
+    params = {**DEFAULTS, **params}
+    rng = np.random.default_rng(params["seed"])
+    out_dir = Path(out_dir)
+    (out_dir / "raw").mkdir(parents=True, exist_ok=True)
+    cohort = make_names(params["n_people"], rng)
+    outsiders = make_names(params["n_outsiders"], rng, taken=cohort)
+    threads = make_threads(cohort, outsiders, rng, params)
+
+    raw_messages = [0] * len(cohort)
+    zips = [ZipFile(export_path(out_dir, i), "w", ZIP_DEFLATED) for i in range(len(cohort))]
+    try:
+        for i, (person, zip_obj) in enumerate(zip(cohort, zips)):
+            zip_obj.writestr("profile_information/profile_information.json",
+                             json.dumps({"profile": {"name": {"full_name": fb_text(person)}}}))
+        for thread in threads:
+            messages = make_messages(np.random.default_rng(thread["seed"]), thread["members"] + thread["leavers"],
+                                     thread["n_messages"], params, thread["leavers"])
+            for i, person in enumerate(cohort):
+                if person in thread["members"] or person in thread["leavers"]:
+                    raw_messages[i] += len(messages)
+                    for name, text in thread_files(thread, messages, person):
+                        zips[i].writestr(name, text)
+    finally:
+        for zip_obj in zips:
+            zip_obj.close()
+
+    with open(out_dir / "cogsci19.pkl", "wb") as f:
+        pickle.dump({fb_hash(person) for person in cohort}, f)
+    dropout = ["0" if rng.random() < params["dropout_rate"] else "1" for _ in cohort]
+    summary = {"params": params, "cohort": cohort, "is_dropout": dropout,
+               "n_threads": len(threads), "raw_messages": raw_messages}
+    with open(out_dir / "synthetic.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+def fb_hash(name):
+    """ Names are hashed as they come out of the export (mojibake) """
+    return hash_name(fb_text(name))
+
+
+def anonymize_exports(out_dir, n_workers=1, double_encode=False, zip_dir=None):
+    """
+    Runs every raw export in out_dir/raw through anonymize_messages.py, writing
+    all_the_data_*.zip with the dropout answer from synthetic.json to zip_dir
+    (out_dir/data by default). double_encode writes conversations the way the
+    old anonymizer did (JSON in a JSON string). Returns the output paths
+    """
+    import anonymize_messages
+
+    out_dir = Path(out_dir)
+    with open(out_dir / "synthetic.json", encoding="utf-8") as f:
+        summary = json.load(f)
+    with open(out_dir / "cogsci19.pkl", "rb") as f:
+        anonymize_messages.COG_HASHES = pickle.load(f)
+    zip_dir = out_dir / "data" if zip_dir is None else Path(zip_dir)
+    zip_dir.mkdir(parents=True, exist_ok=True)
+    out_paths = []
+    for i, is_dropout in enumerate(summary["is_dropout"]):
+        messages = anonymize_messages.iter_zip_messages([export_path(out_dir, i)])
+        out_path = zip_dir / f"all_the_data_{anonymize_messages.random_long_id(N=8)}.zip"
+        with ZipFile(out_path, "w", ZIP_DEFLATED) as out_zip:
+            out_zip.writestr("dropout.json", json.dumps({"is_dropout": is_dropout}))
+            anonymize_messages.anonymize_all(messages, out_zip, n_workers)
+        if double_encode:
+            double_encode_zip(out_path)
+        out_paths.append(out_path)
+    return out_paths
+
+
+def double_encode_zip(zip_path):
+    """ Rewrites the anonymized conversations of a zip as JSON strings holding the JSON (the old anonymizer's output) """
+    zip_path = Path(zip_path)
+    temp_path = zip_path.with_name(f"{zip_path.name}.tmp")
+    with ZipFile(zip_path) as in_zip, ZipFile(temp_path, "w", ZIP_DEFLATED) as out_zip:
+        for info in in_zip.infolist():
+            data = in_zip.read(info)
+            if info.filename != "dropout.json":
+                data = json.dumps(data.decode("utf-8")).encode()
+            out_zip.writestr(info.filename, data)
+    os.replace(temp_path, zip_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes synthetic Facebook exports (and their anonymized zips)")
+    parser.add_argument("out_dir")
+    parser.add_argument("--people", type=int, default=DEFAULTS["n_people"], help="cohort members (one export each)")
+    parser.add_argument("--outsiders", type=int, default=DEFAULTS["n_outsiders"], help="people outside the cohort")
+    parser.add_argument("--groups", type=int, default=DEFAULTS["n_groups"], help="group chats")
+    parser.add_argument("--messages", type=float, default=DEFAULTS["messages"], help="mean messages per direct chat")
+    parser.add_argument("--seed", type=int, default=DEFAULTS["seed"])
+    parser.add_argument("--anonymize", action="store_true", help="also write the anonymized zips to out_dir/data")
+    parser.add_argument("--double-encode", action="store_true", help="anonymized conversations as the old anonymizer wrote them")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    summary = write_exports(args.out_dir, n_people=args.people, n_outsiders=args.outsiders,
+                            n_groups=args.groups, messages=args.messages, seed=args.seed)
+    print(f"wrote {len(summary['cohort'])} exports, {sum(summary['raw_messages'])} messages")
+    if args.anonymize:
+        paths = anonymize_exports(args.out_dir, args.workers, args.double_encode)
+        print(f"wrote {len(paths)} anonymized zips to {Path(args.out_dir) / 'data'}")
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Typed columnar storage for the pipeline's intermediate tables.
+
+A table is a directory (e.g. raw_consensual.cols/) with one .npy file per
+column and a schema.json. Columns are read memory-mapped, so loading only
+the columns you need (columns=[...]) is close to free. Strings are stored as
+categoricals (int codes + categories), timestamps as int64 epoch ms with a
+null mask where they can be missing (group membership rows).
+
+    write_table(typed_edges(df), "raw_consensual.cols")
+    df = read_table("raw_consensual.cols", columns=["from", "to", "timestamp"])
+    export_csv("raw_consensual.cols", "raw_consensual.csv")
+"""
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REL_TYPES = ["msg", "reaction", "group"]
+SCHEMA_FILE = "schema.json"
+
+
+def _column_file(path, column, suffix=""):
+    return Path(path) / f"{column}{suffix}.npy"
+
+
+def _json_values(values):
+    """ Categories as plain python values for schema.json """
+    return [v.item() if isinstance(v, np.generic) else v for v in values]
+
+
+def write_table(df, path):
+    """
+    Writes a dataframe as a directory of .npy columns. Numeric columns are kept
+    as they are, nullable integers (Int64) get a mask and everything else is
+    stored as a categorical
+    """
+    path = Path(path)
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(temp_path, ignore_errors=True)
+    temp_path.mkdir(parents=True)
+    schema = {"n_rows": len(df), "columns": []}
+    for column in df.columns:
+        series = df[column]
+        entry = {"name": column}
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            entry.update(kind="categorical", categories=_json_values(series.cat.categories))
+            np.save(_column_file(temp_path, column), series.cat.codes.to_numpy())
+        elif pd.api.types.is_extension_array_dtype(series.dtype) and pd.api.types.is_integer_dtype(series.dtype):
+            entry.update(kind="nullable", dtype=series.dtype.numpy_dtype.str)
+            np.save(_column_file(temp_path, column), series.to_numpy(series.dtype.numpy_dtype, na_value=0))
+            np.save(_column_file(temp_path, column, ".mask"), series.isna().to_numpy())
+        elif pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+            entry.update(kind="numpy", dtype=series.to_numpy().dtype.str)
+            np.save(_column_file(temp_path, column), series.to_numpy())
+        else:
+            categorical = pd.Categorical(series)
+            entry.update(kind="categorical", categories=_json_values(categorical.categories))
+            np.save(_column_file(temp_path, column), categorical.codes)
+        schema["columns"].append(entry)
+    with open(temp_path / SCHEMA_FILE, "w", encoding="utf-8") as f:
+        json.dump(schema, f, ensure_ascii=False)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp_path, path)
+
+
+def read_schema(path):
+    with open(Path(path) / SCHEMA_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_table(path, columns=None, mmap=True, categorical=True):
+    """
+    Reads a table written by write_table. Only the given columns are loaded and
+    numeric columns are memory-mapped (read-only) unless mmap=False.
+    With categorical=False, categoricals come back as plain values
+    """
+    schema = read_schema(path)
+    entries = {entry["name"]: entry for entry in schema["columns"]}
+    columns = list(entries) if columns is None else columns
+    mmap_mode = "r" if mmap else None
+    data = {}
+    for column in columns:
+        entry = entries[column]
+        values = np.load(_column_file(path, column), mmap_mode=mmap_mode)
+        if entry["kind"] == "categorical":
+            values = pd.Categorical.from_codes(values, categories=entry["categories"])
+            if not categorical:
+                values = np.asarray(values, dtype=object)
+        elif entry["kind"] == "nullable":
+            mask = np.load(_column_file(path, column, ".mask"), mmap_mode=mmap_mode)
+            values = pd.arrays.IntegerArray(np.asarray(values), np.asarray(mask))
+        data[column] = values
+    return pd.DataFrame(data, columns=columns, copy=False)
+
+
+def export_csv(path, csv_path, columns=None):
+    """ Writes a stored table as csv (for the R scripts) """
+    read_table(path, columns, categorical=False).to_csv(csv_path, index=False)
+
+
+def typed_timestamps(timestamps):
+    """ Epoch ms as int64, nullable (Int64) if some are missing """
+    timestamps = pd.to_numeric(timestamps)
+    if timestamps.isna().any():
+        return timestamps.round().astype("Int64")
+    return timestamps.round().astype(np.int64)
+
+
+def typed_ids(df, id_columns=("from", "to")):
+    """
+    Integer ids become int32, anything else (hashes) a categorical with
+    the same categories across the id columns so they can be compared and joined
+    """
+    id_columns = [column for column in id_columns if column in df.columns]
+    dtypes = [df[column].dtype for column in id_columns]
+    if dtypes and isinstance(dtypes[0], pd.CategoricalDtype) and all(dtype == dtypes[0] for dtype in dtypes):
+        # already typed (read back from a table)
+        return {column: df[column] for column in id_columns}
+    values = pd.concat([df[column] for column in id_columns])
+    numeric = pd.to_numeric(values, errors="coerce")
+    if len(values) and numeric.notna().all() and (numeric % 1 == 0).all():
+        return {column: pd.to_numeric(df[column]).astype(np.int32) for column in id_columns}
+    categories = pd.unique(values.dropna())
+    return {column: pd.Categorical(df[column], categories=categories) for column in id_columns}
+
+
+def typed_edges(df):
+    """ Edge table with typed columns: int64 timestamps, int32/categorical ids, categorical rel_type """
+    typed = typed_ids(df)
+    if "timestamp" in df.columns:
+        typed["timestamp"] = typed_timestamps(df["timestamp"])
+    if "rel_type" in df.columns:
+        typed["rel_type"] = pd.Categorical(df["rel_type"], categories=REL_TYPES)
+    if "weight" in df.columns:
+        typed["weight"] = df["weight"].astype(np.float64)
+    return df.assign(**typed)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Time-respecting paths: who could have passed something on to whom.
+
+A time-respecting path is a chain of messages a -> b -> c ... whose times
+strictly increase, with at most delta between one message and the next (no
+limit if delta is None), like pathpy's paths. For every window of the
+tidy edges, sweep() goes through the window's messages once, in time order,
+and keeps for every person the set of sources that have reached them as a
+bitset (a python int, a bit per source) and, with a delta, the recent
+arrivals (time, sources) that can still be continued. That gives every
+source's earliest arrival at everyone and who it came from, for all sources
+at once. Sources are split across processes.
+
+The first arrivals form a tree per source (the foremost paths), from which
+the path lengths (hops) and a temporal betweenness (the number of source,
+target pairs whose foremost path goes through a person) are read. With a
+delta, the path to a person's first arrival is not always one its
+successors can continue, the tree then joins first arrivals.
+
+    python temporal_paths.py tidy_data.cols temporal_reach.csv temporal_path_lengths.csv --delta 1D --window 7D
+"""
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from node_metrics import TIDY_COLUMNS, read_tidy, window_starts
+from replies import MESSAGE_TYPES, message_stream
+
+# every worker gets a copy of a window's edges, a few are enough
+N_WORKERS = min(4, os.cpu_count() or 1)
+# sources per task, the bitsets stay a few words long
+CHUNK_SOURCES = 256
+REACH_COLUMNS = ["name", "start", "end", "reachable", "reached_by", "mean_hops", "mean_arrival_ms",
+                 "betweenness"]
+LENGTH_COLUMNS = ["start", "end", "hops", "paths"]
+
+
+def _ms(duration):
+    return None if duration is None else pd.Timedelta(duration) // pd.Timedelta(milliseconds=1)
+
+
+def sweep(src, dst, timestamps, n_nodes, sources, delta=None):
+    """
+    One pass over time sorted messages src -> dst. Returns the earliest
+    arrival (epoch ms, -1 if never) of each source (rows) at each node and
+    the node it came from (-1 if never)
+    """
+    bit_of = {source: 1 << i for i, source in enumerate(sources)}
+    seen = [0] * n_nodes
+    fronts = [deque() for _ in range(n_nodes)]
+    earliest = np.full((len(sources), n_nodes), -1, dtype=np.int64)
+    pred = np.full((len(sources), n_nodes), -1, dtype=np.int64)
+    src, dst, timestamps = src.tolist(), dst.tolist(), timestamps.tolist()
+    # messages at the same time can't follow each other: arrivals are applied per time
+    bounds = np.flatnonzero(np.diff(timestamps)) + 1 if len(timestamps) else []
+    for low, high in zip([0, *bounds], [*bounds, len(timestamps)]):
+        t = timestamps[low]
+        arrivals = []
+        for u, v in zip(src[low:high], dst[low:high]):
+            bits = bit_of.get(u, 0)
+            if delta is None:
+                bits |= seen[u]
+            else:
+                front = fronts[u]
+                while front and t - front[0][0] > delta:
+                    front.popleft()
+                for _, arrived in front:
+                    bits |= arrived
+            if bits:
+                arrivals.append((u, v, bits))
+        for u, v, bits in arrivals:
+            new = bits & ~seen[v] & ~bit_of.get(v, 0)
+            while new:
+                low_bit = new & -new
+                row = low_bit.bit_length() - 1
+                earliest[row, v] = t
+                pred[row, v] = u
+                new ^= low_bit
+            seen[v] |= bits
+            if delta is not None:
+                front = fronts[v]
+                if front and front[-1][0] == t:
+                    front[-1] = (t, front[-1][1] | bits)
+                else:
+                    front.append((t, bits))
+    return earliest, pred
+
+
+def foremost_trees(earliest, pred, sources):
+    """
+    Hops of every source's foremost path to each node (0 if not reached) and
+    the number of its targets whose path goes through each node
+    """
+    rows = np.arange(len(sources))
+    reached = earliest >= 0
+    # predecessors arrive strictly earlier, so arrival order is a topological order
+    order = np.argsort(np.where(reached, earliest, np.iinfo(np.int64).max), axis=1, kind="stable")
+    hops = np.zeros(earliest.shape, dtype=np.int64)
+    for v in order.T:
+        p = pred[rows, v]
+        hops[rows, v] = np.where(reached[rows, v], np.where(p == sources, 1, hops[rows, np.maximum(p, 0)] + 1), 0)
+    below = reached.astype(np.int64)
+    for v in order.T[::-1]:
+        p = pred[rows, v]
+        through = reached[rows, v] & (p != sources)
+        np.add.at(below, (rows[through], p[through]), below[rows[through], v[through]])
+    return hops, below - reached
+
+
+def _run_sources(args):
+    """ Sweep and foremost trees of a chunk of sources, summed per node """
+    src, dst, timestamps, n_nodes, sources, delta = args
+    earliest, pred = sweep(src, dst, timestamps, n_nodes, sources, delta)
+    hops, through = foremost_trees(earliest, pred, sources)
+    reached = earliest >= 0
+    return {"reachable": reached.sum(axis=1),
+            "hops": hops.sum(axis=1),
+            "arrival": np.where(reached, earliest, 0).sum(axis=1),
+            "reached_by": reached.sum(axis=0),
+            "betweenness": through.sum(axis=0),
+            "lengths": np.bincount(hops[reached], minlength=1)}
+
+
+def window_paths(src, dst, timestamps, delta=None, executor=None, chunk_sources=CHUNK_SOURCES):
+    """
+    Per node reach, hops, arrivals and betweenness of one window (for the
+    window's active nodes, returned as their global codes), and its path length counts
+    """
+    # the sweep and the trees only span the window's own people, not everyone's
+    active, local = np.unique(np.concatenate([src, dst]), return_inverse=True)
+    local = local.ravel()
+    src, dst = local[:len(src)], local[len(src):]
+    n_nodes = len(active)
+    # only people who send can be sources of a path
+    senders = np.unique(src)
+    jobs = [(src, dst, timestamps, n_nodes, senders[i:i + chunk_sources], delta)
+            for i in range(0, len(senders), chunk_sources)]
+    results = map(_run_sources, jobs) if executor is None else executor.map(_run_sources, jobs)
+    totals = {key: np.zeros(n_nodes, dtype=np.int64) for key in ["reachable", "hops", "arrival"]}
+    reached_by = np.zeros(n_nodes, dtype=np.int64)
+    betweenness = np.zeros(n_nodes, dtype=np.int64)
+    lengths = np.zeros(1, dtype=np.int64)
+    for job, result in zip(jobs, results):
+        for key in totals:
+            totals[key][job[4]] = result[key]
+        reached_by += result["reached_by"]
+        betweenness += result["betweenness"]
+        lengths = np.pad(lengths, (0, max(0, len(result["lengths"]) - len(lengths))))
+        lengths[:len(result["lengths"])] += result["lengths"]
+    reachable = totals["reachable"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        nodes = {"node": active,
+                 "reachable": reachable,
+                 "reached_by": reached_by,
+                 "mean_hops": totals["hops"] / reachable,
+                 "mean_arrival": totals["arrival"] / reachable,
+                 "betweenness": betweenness}
+    return nodes, lengths
+
+
+def temporal_paths(df, delta=None, window="7D", stride=None, n_workers=N_WORKERS,
+                   chunk_sources=CHUNK_SOURCES, message_types=MESSAGE_TYPES):
+    """
+    Reach (people a node's messages could get to within the window), the
+    mean hops and arrival (ms after the window's start) of those paths, how
+    many reach the node and its betweenness, per window [start, start + window)
+    every stride (window by default), and the number of foremost paths per
+    length and window
+    """
+    src, dst, timestamps, _, names = message_stream(df, message_types)
+    if not len(src):
+        return pd.DataFrame(columns=REACH_COLUMNS), pd.DataFrame(columns=LENGTH_COLUMNS)
+    delta, window_ms = _ms(delta), _ms(window)
+    stride_ms = window_ms if stride is None else _ms(stride)
+    starts = window_starts(timestamps, window_ms, stride_ms)
+    lows = np.searchsorted(timestamps, starts)
+    highs = np.searchsorted(timestamps, starts + window_ms)
+    executor = ProcessPoolExecutor(n_workers) if n_workers is not None and n_workers > 1 else None
+    reach_frames, length_frames = [], []
+    try:
+        for start, low, high in zip(starts, lows, highs):
+            if low == high:
+                continue
+            nodes, lengths = window_paths(src[low:high], dst[low:high], timestamps[low:high], delta, executor,
+                                          chunk_sources)
+            reach_frames.append(pd.DataFrame({"name": names[nodes["node"]],
+                                              "start": start,
+                                              "end": start + window_ms,
+                                              "reachable": nodes["reachable"],
+                                              "reached_by": nodes["reached_by"],
+                                              "mean_hops": nodes["mean_hops"],
+                                              "mean_arrival_ms": nodes["mean_arrival"] - start,
+                                              "betweenness": nodes["betweenness"]},
+                                             columns=REACH_COLUMNS))
+            hops = np.flatnonzero(lengths)
+            length_frames.append(pd.DataFrame({"start": start, "end": start + window_ms,
+                                               "hops": hops, "paths": lengths[hops]},
+                                              columns=LENGTH_COLUMNS))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    reach = pd.concat(reach_frames, ignore_index=True)
+    path_lengths = pd.concat(length_frames, ignore_index=True)
+    for table in [reach, path_lengths]:
+        for column in ["start", "end"]:
+            table[column] = pd.to_datetime(table[column], unit="ms").dt.strftime("%Y-%m-%d")
+    return reach, path_lengths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time-respecting paths per window")
+    parser.add_argument("tidy_path", nargs="?", default="tidy_data.cols")
+    parser.add_argument("reach_path", nargs="?", default="temporal_reach.csv")
+    parser.add_argument("lengths_path", nargs="?", default="temporal_path_lengths.csv")
+    parser.add_argument("--delta", help="longest wait between two messages of a path (e.g. 1D), none by default")
+    parser.add_argument("--window", default="7D")
+    parser.add_argument("--stride", help="step between windows (the window by default)")
+    parser.add_argument("--workers", type=int, default=N_WORKERS)
+    args = parser.parse_args()
+    reach, path_lengths = temporal_paths(read_tidy(args.tidy_path, TIDY_COLUMNS + ["rel_type"]),
+                                         args.delta, args.window, args.stride, args.workers)
+    reach.to_csv(args.reach_path, index=False)
+    path_lengths.to_csv(args.lengths_path, index=False)
@@ -0,0 +1,19 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# the modules are at the top of the repo
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture(scope="session")
+def synthetic_dir(tmp_path_factory):
+    """ Synthetic raw exports and their anonymized zips (data/*.zip), benchmark.py's small scale """
+    import benchmark
+    import synthetic_data
+
+    out_dir = tmp_path_factory.mktemp("synthetic")
+    synthetic_data.write_exports(out_dir, **{**synthetic_data.DEFAULTS, **benchmark.SCALES["small"], "seed": 0})
+    synthetic_data.anonymize_exports(out_dir)
+    return out_dir
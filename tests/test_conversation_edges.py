@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+The column-wise edge frames of data_load.py against the per-cell version
+they replaced (kept here as the reference)
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import load_pipeline
+
+
+@pytest.fixture(scope="module")
+def data_load():
+    return load_pipeline()
+
+
+def add_reactions(msg, rel_list):
+    """ Appends reaction to a reaction list (preprocessing step) """
+    if "reactions" in msg.keys():
+        for reaction in msg["reactions"]:
+            reaction_dict = {"from": reaction,
+                             "to": msg["sender_name"],
+                             "timestamp": msg["timestamp_ms"],
+                             "rel_type": "reaction"}
+            rel_list.append(reaction_dict)
+
+
+def old_create_member_edges(group_convo, group_id):
+    return pd.DataFrame({"from": group_convo["participants"],
+                         "to": group_id,
+                         "timestamp": np.nan,
+                         "rel_type": "group"})
+
+
+def old_process_group_messages(group_convo, group_id):
+    group_msgs = pd.DataFrame(index=range(len(group_convo["messages"])),
+                              columns=["from", "to", "timestamp", "rel_type"])
+    group_msgs = group_msgs.assign(to=group_id, rel_type="msg")
+    rel_list = []
+    for i, msg in enumerate(group_convo["messages"]):
+        group_msgs.loc[i, "from"] = msg["sender_name"]
+        group_msgs.loc[i, "timestamp"] = msg["timestamp_ms"]
+        add_reactions(msg, rel_list)
+    return pd.concat([group_msgs, pd.DataFrame(rel_list)])
+
+
+def old_process_group_edges(group_convo, group_id):
+    group_msgs = old_process_group_messages(group_convo, group_id)
+    group_members = old_create_member_edges(group_convo, group_id)
+    return pd.concat([group_msgs, group_members]).reset_index(drop=True)
+
+
+def old_process_msgs(convo):
+    if len(convo["participants"]) == 1:
+        return None
+    msgs = pd.DataFrame(index=range(len(convo["messages"])),
+                        columns=["from", "to", "timestamp", "rel_type"])
+    msgs = msgs.assign(rel_type="msg")
+    rel_list = []
+    for i, msg in enumerate(convo["messages"]):
+        if "call_duration" in msg.keys():
+            continue
+        msgs.loc[i, "from"] = msg["sender_name"]
+        msgs.loc[i, "to"] = msg["receiver_name"]
+        msgs.loc[i, "timestamp"] = msg["timestamp_ms"]
+        add_reactions(msg, rel_list)
+    return pd.concat([msgs.dropna(subset=["from"]), pd.DataFrame(rel_list)])
+
+
+def assert_same_edges(new, old):
+    """ Same rows in the same order (the old frames had object columns and a messy index) """
+    old = old.reset_index(drop=True).astype(object).where(old.notna().to_numpy(), None)
+    new = new.reset_index(drop=True).astype(object).where(new.notna().to_numpy(), None)
+    assert list(new.columns) == list(old.columns)
+    assert new.to_dict("records") == old.to_dict("records")
+
+
+DIRECT = {"participants": ["anna", "bo"],
+          "thread_type": "Regular",
+          "messages": [{"sender_name": "anna", "receiver_name": "bo", "timestamp_ms": 1000,
+                        "reactions": ["bo"]},
+                       {"sender_name": "bo", "receiver_name": "anna", "timestamp_ms": 2000},
+                       {"sender_name": "anna", "receiver_name": "bo", "timestamp_ms": 3000,
+                        "call_duration": 60, "reactions": ["bo"]},
+                       {"sender_name": None, "receiver_name": "anna", "timestamp_ms": 4000},
+                       {"sender_name": "bo", "receiver_name": "anna", "timestamp_ms": 5000,
+                        "reactions": ["anna", "bo"]}]}
+
+GROUP = {"participants": ["anna", "bo", "cai"],
+         "thread_type": "RegularGroup",
+         "messages": [{"sender_name": "cai", "timestamp_ms": 1000, "reactions": ["anna", "bo"]},
+                      {"sender_name": "anna", "timestamp_ms": 2000, "call_duration": 300,
+                       "reactions": ["cai"]},
+                      {"sender_name": None, "timestamp_ms": 3000},
+                      {"sender_name": "bo", "timestamp_ms": 4000}]}
+
+
+def test_direct_chat(data_load):
+    assert_same_edges(data_load.process_msgs(DIRECT), old_process_msgs(DIRECT))
+
+
+def test_direct_chat_streamed_columns(data_load):
+    columns = data_load.collect_columns(iter(DIRECT["messages"]))
+    assert_same_edges(data_load.process_msgs(DIRECT, columns), old_process_msgs(DIRECT))
+
+
+def test_group_chat(data_load):
+    group_id = data_load.create_group_id(GROUP)
+    assert_same_edges(data_load.process_group_edges(GROUP), old_process_group_edges(GROUP, group_id))
+
+
+def test_group_messages(data_load):
+    group_id = data_load.create_group_id(GROUP)
+    assert_same_edges(data_load.process_group_messages(GROUP, group_id), old_process_group_messages(GROUP, group_id))
+
+
+def test_single_participant(data_load):
+    convo = {**DIRECT, "participants": ["anna"]}
+    assert data_load.process_msgs(convo) is None and old_process_msgs(convo) is None
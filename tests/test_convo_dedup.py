@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+The conversation plan of data_load.py (convo_dedup.py): every conversation
+extracted once, and the same edges as extracting all the copies
+"""
+import shutil
+from collections import defaultdict
+
+import pandas as pd
+import pytest
+
+from benchmark import load_pipeline
+from convo_dedup import thread_key
+from convo_reader import get_manifest, load_manifest, manifest_path
+
+
+@pytest.fixture
+def data_paths(synthetic_dir, tmp_path, monkeypatch):
+    """ A copy of the synthetic zips with their manifests, the edge cache under tmp_path """
+    data_dir = tmp_path / "data"
+    shutil.copytree(synthetic_dir / "data", data_dir, ignore=shutil.ignore_patterns("*manifest*"))
+    paths = sorted(data_dir.glob("*.zip"))
+    for path in paths:
+        get_manifest(path)
+    work_dir = tmp_path / "run"
+    work_dir.mkdir()
+    monkeypatch.chdir(work_dir)
+    return paths
+
+
+@pytest.fixture(scope="module")
+def data_load():
+    return load_pipeline()
+
+
+def unique_edges(data_load, data_paths, plan=None):
+    """ The deduplicated edges, in a fixed order """
+    data_list = data_load.process_people(data_paths, [None] * len(data_paths), n_workers=1, plan=plan)
+    edges = pd.concat(data_list).drop_duplicates().astype({"timestamp": float})
+    return edges.sort_values(list(edges.columns), na_position="first").reset_index(drop=True)
+
+
+def test_one_copy_per_thread(data_load, data_paths):
+    plan = data_load.conversation_plan(data_paths)
+    copies = defaultdict(dict)
+    for path in data_paths:
+        for member in load_manifest(path)["members"]:
+            copies[thread_key(member)].setdefault(str(path), []).append(member)
+    assert any(len(zips) > 1 for zips in copies.values())
+    for zips in copies.values():
+        extracted = defaultdict(list)
+        whole = 0
+        for path, members in zips.items():
+            kept = [plan[path][member["name"]] for member in members]
+            whole += all(days is None for days in kept)
+            for member, days in zip(members, kept):
+                for day in member["days"] if days is None else days:
+                    extracted[day].append(tuple(member["days"][day]))
+        assert whole == 1
+        # a day's messages are extracted from one copy, unless the copies have different ones
+        for day_copies in extracted.values():
+            assert len(day_copies) == len(set(day_copies))
+
+
+def test_same_edges_as_all_copies(data_load, data_paths):
+    expected = unique_edges(data_load, data_paths)
+    plan = data_load.conversation_plan(data_paths)
+    assert any(days == [] for zip_plan in plan.values() for days in zip_plan.values())
+    pd.testing.assert_frame_equal(unique_edges(data_load, data_paths, plan), expected)
+
+
+def test_missing_manifests(data_load, data_paths):
+    expected = unique_edges(data_load, data_paths)
+    for path in data_paths[:2]:
+        manifest_path(path).unlink()
+    plan = data_load.conversation_plan(data_paths)
+    # zips without a manifest aren't planned, they are extracted whole
+    assert set(plan) == {str(path) for path in data_paths[2:]}
+    pd.testing.assert_frame_equal(unique_edges(data_load, data_paths, plan), expected)
+    # and get their manifests on the way
+    assert all(manifest_path(path).exists() for path in data_paths[:2])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+The edge cache: entries round-trip, a new extractor version misses, eviction
+goes by last use
+"""
+import os
+import time
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import edge_cache
+from benchmark import load_pipeline
+from convo_reader import convo_members
+
+
+@pytest.fixture(scope="module")
+def data_load():
+    return load_pipeline()
+
+
+def edges_frame():
+    return pd.DataFrame({"from": ["a", "b", None, "a"],
+                         "to": ["b", "a", "a", "c"],
+                         "timestamp": [1.0, 2.0, 3.0, np.nan],
+                         "rel_type": ["msg", "reaction", "msg", "group"]},
+                        columns=edge_cache.EDGE_COLUMNS)
+
+
+def test_round_trip(tmp_path):
+    df = edges_frame()
+    edge_cache.save_entry(tmp_path, "ab12", {"thread_type": "Regular", "n_messages": 3}, df)
+    edge_cache.save_entry(tmp_path, "cd34", {"thread_type": "Regular", "n_messages": 0}, None)
+
+    meta, cached = edge_cache.load_entry(tmp_path, "ab12")
+    assert meta == {"thread_type": "Regular", "n_messages": 3, "has_edges": True}
+    pd.testing.assert_frame_equal(cached, df, check_dtype=False)
+    meta, cached = edge_cache.load_entry(tmp_path, "cd34")
+    assert meta["has_edges"] is False and cached is None
+    assert edge_cache.load_entry(tmp_path, "ef56") is None
+    # no temp files left behind
+    assert sorted(path.name for path in tmp_path.glob("*/*")) == ["ab12.npz", "cd34.npz"]
+
+
+def test_version_bump_misses(data_load, synthetic_dir, tmp_path, monkeypatch):
+    zip_path = sorted((synthetic_dir / "data").glob("*.zip"))[0]
+    cache = tmp_path / "edge_cache"
+    with ZipFile(zip_path) as zip_obj:
+        info = zip_obj.getinfo(convo_members(zip_obj)[0])
+        entry, edges = data_load.process_member(zip_obj, info, cache=cache)
+        assert edge_cache.cache_report(cache)["entries"] == 1
+
+        # a hit gives back the same entry and edges without extracting
+        def no_extract(*args, **kwargs):
+            raise AssertionError("extracted a cached conversation")
+        with monkeypatch.context() as patch:
+            patch.setattr(data_load, "read_member_columns", no_extract)
+            cached_entry, cached_edges = data_load.process_member(zip_obj, info, cache=cache)
+        assert cached_entry == entry
+        pd.testing.assert_frame_equal(cached_edges.reset_index(drop=True), edges.reset_index(drop=True),
+                                      check_dtype=False)
+
+        monkeypatch.setattr(data_load, "EXTRACTOR_VERSION", data_load.EXTRACTOR_VERSION + 1)
+        data_load.process_member(zip_obj, info, cache=cache)
+        assert edge_cache.cache_report(cache)["entries"] == 2
+
+
+def test_eviction_order(tmp_path):
+    df = edges_frame()
+    now = time.time()
+    # last used 40, 30, 20 and 10 days ago
+    for age, key in zip([40, 30, 20, 10], ["aa01", "bb02", "cc03", "dd04"]):
+        edge_cache.save_entry(tmp_path, key, {}, df)
+        used = now - age * 86400
+        os.utime(edge_cache.entry_path(tmp_path, key), (used, used))
+    # loading marks an entry as used
+    assert edge_cache.load_entry(tmp_path, "aa01") is not None
+    entry_bytes = edge_cache.entry_path(tmp_path, "aa01").stat().st_size
+
+    assert edge_cache.evict(tmp_path, older_than_days=25) == 1
+    assert not edge_cache.entry_path(tmp_path, "bb02").exists()
+    # room for two entries: the least recently used goes
+    assert edge_cache.evict(tmp_path, max_bytes=2 * entry_bytes + entry_bytes // 2) == 1
+    assert not edge_cache.entry_path(tmp_path, "cc03").exists()
+    assert edge_cache.entry_path(tmp_path, "aa01").exists() and edge_cache.entry_path(tmp_path, "dd04").exists()
+    # emptied subdirectories are removed
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["aa", "dd"]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Time slices of edge_index.py against filtering the table
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from edge_index import build_index, epoch_ms, open_index
+
+DAY_MS = 86_400_000
+# 2020-08-14 13:39:35.331 UTC
+T = 1597412375331
+
+
+def test_epoch_ms():
+    assert epoch_ms(T) == T
+    assert epoch_ms(np.int64(T)) == T
+    # as the csvs have them
+    assert epoch_ms(float(T)) == T
+    assert epoch_ms(np.float64(T) + 0.4) == T
+    assert epoch_ms("2020-08-14 13:39:35.331") == T
+    assert epoch_ms(pd.Timestamp("2020-08-14 15:39:35.331", tz="Europe/Copenhagen")) == T
+    assert epoch_ms(None) is None
+
+
+@pytest.fixture
+def index(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 500
+    df = pd.DataFrame({"from": rng.choice(list("abcde"), n), "to": rng.choice(list("abcde"), n),
+                       "timestamp": (T + rng.integers(-30 * DAY_MS, 30 * DAY_MS, n)).astype(np.float64),
+                       "weight": rng.random(n)})
+    build_index(df, tmp_path / "tidy_index.cols")
+    return df, open_index(tmp_path / "tidy_index.cols")
+
+
+def test_float_bounds(index):
+    df, index = index
+    t0, t1 = float(T - 7 * DAY_MS), float(T)
+    expected = df[(df["timestamp"] >= t0) & (df["timestamp"] < t1)]
+    window = index.window(t0, t1, categorical=False)
+    assert len(window) == len(expected) > 0
+    assert sorted(window["timestamp"]) == sorted(expected["timestamp"].astype(np.int64))
+    assert len(index.window(np.float64(t0), t1)) == len(index.window(int(t0), int(t1)))
+    weeks = list(index.periods("week", t0, t1))
+    assert weeks and all(t0 <= epoch_ms(start) < t1 for start, _ in weeks)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+What the null models of null_models.py keep, their seeds and the p-values
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from null_models import METRICS, NULL_MODELS, null_distributions, permutation_tests, permuted
+from node_metrics import message_edges, round_date
+
+
+@pytest.fixture(scope="module")
+def tidy_df():
+    """ Messages among 12 people over 2020, lockdown weeks included """
+    rng = np.random.default_rng(0)
+    n = 3000
+    start, end = pd.Timestamp("2020-01-01").value // 10**6, pd.Timestamp("2021-01-01").value // 10**6
+    return pd.DataFrame({"from": rng.integers(0, 12, n), "to": rng.integers(0, 12, n),
+                         "timestamp": rng.integers(start, end, n).astype(np.float64), "weight": 1.0})
+
+
+@pytest.fixture(scope="module")
+def edges(tidy_df):
+    """ The edge arrays null_distributions permutes and the number of weeks """
+    src, dst, timestamps, _, names = message_edges(tidy_df)
+    weeks, win = np.unique(round_date(timestamps, "week"), return_inverse=True)
+    win = win.ravel()
+    _, pair = np.unique(np.minimum(src, dst) * len(names) + np.maximum(src, dst), return_inverse=True)
+    return {"win": win, "src": src, "dst": dst, "pair": pair.ravel(),
+            "by_win": np.argsort(win, kind="stable"), "n_names": len(names)}, len(weeks)
+
+
+def counts(*keys):
+    """ Messages per combination of the keys """
+    return pd.Series(1, index=pd.MultiIndex.from_arrays(keys)).groupby(level=list(range(len(keys)))).sum()
+
+
+def test_timestamps_keep_weekly_volume(edges):
+    edges, n_windows = edges
+    rng = np.random.default_rng(1)
+    for _ in range(5):
+        win, src, dst = permuted("timestamps", edges, n_windows, rng)
+        assert not np.array_equal(win, edges["win"])
+        np.testing.assert_array_equal(np.bincount(win, minlength=n_windows),
+                                      np.bincount(edges["win"], minlength=n_windows))
+        assert src is edges["src"] and dst is edges["dst"]
+
+
+def test_pair_times_keep_pairs(edges):
+    edges, n_windows = edges
+    rng = np.random.default_rng(2)
+    for _ in range(5):
+        win, src, dst = permuted("pair_times", edges, n_windows, rng)
+        assert src is edges["src"] and dst is edges["dst"]
+        # every pair keeps its messages, all shifted by the same number of weeks
+        pd.testing.assert_series_equal(counts(np.minimum(src, dst), np.maximum(src, dst)),
+                                       counts(np.minimum(edges["src"], edges["dst"]),
+                                              np.maximum(edges["src"], edges["dst"])))
+        shifts = pd.Series((win - edges["win"]) % n_windows).groupby(edges["pair"]).nunique()
+        assert (shifts == 1).all()
+        assert not np.array_equal(np.bincount(win, minlength=n_windows),
+                                  np.bincount(edges["win"], minlength=n_windows))
+
+
+def test_rewire_keeps_weekly_degrees(edges):
+    edges, n_windows = edges
+    rng = np.random.default_rng(3)
+    for _ in range(5):
+        win, src, dst = permuted("rewire", edges, n_windows, rng)
+        assert win is edges["win"] and src is edges["src"]
+        assert not np.array_equal(dst, edges["dst"])
+        pd.testing.assert_series_equal(counts(win, dst), counts(edges["win"], edges["dst"]))
+
+
+def test_seed_reproducible_across_workers(tidy_df):
+    # 5 replicates a batch, so 3 batches for every null model
+    batch_edges = 5 * len(tidy_df)
+    serial = null_distributions(tidy_df, n_replicates=15, seed=4, n_workers=1, batch_edges=batch_edges)
+    pooled = null_distributions(tidy_df, n_replicates=15, seed=4, n_workers=2, batch_edges=batch_edges)
+    assert serial[0] == pooled[0]
+    pd.testing.assert_frame_equal(serial[1], pooled[1])
+    assert len(serial[1]) == 15 * len(NULL_MODELS) * len(METRICS)
+    other = null_distributions(tidy_df, n_replicates=15, seed=5, n_workers=1, batch_edges=batch_edges)
+    assert not serial[1]["effect"].equals(other[1]["effect"])
+
+
+def test_p_value_bounds(tidy_df):
+    observed, nulls = null_distributions(tidy_df, n_replicates=30, n_workers=1)
+    tests = permutation_tests(observed, nulls)
+    assert len(tests) == len(NULL_MODELS) * len(METRICS)
+    n = tests["replicates"].to_numpy()
+    for column in ["p_greater", "p_less", "p_two_sided"]:
+        assert ((tests[column] >= 1 / (n + 1)) & (tests[column] <= 1)).all()
+    # every replicate is on one side or the other (on both when it ties)
+    assert (tests["p_greater"] + tests["p_less"] >= 1).all()
+
+    # an effect beyond every null replicate gets the smallest p-value there is
+    nulls = pd.DataFrame({"null_model": "timestamps", "metric": "density", "replicate": np.arange(99),
+                          "effect": np.linspace(-1, 1, 99)})
+    extreme = permutation_tests({"density": 2.0}, nulls).iloc[0]
+    assert extreme["p_greater"] == extreme["p_two_sided"] == 1 / 100
+    assert extreme["p_less"] == 1
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+The bounded-memory steps of out_of_core.py against the in-memory ones of
+data_load.py, on the synthetic exports with a max_memory small enough for
+several partitions and chunks
+"""
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import out_of_core
+from benchmark import load_pipeline
+from convo_reader import get_manifest
+from interning import id_values
+
+# 40 rows a chunk, a few dozen partitions
+MAX_MEMORY = 40 * out_of_core.ROW_BYTES
+
+
+@pytest.fixture(scope="module")
+def pipeline(synthetic_dir, tmp_path_factory):
+    """ The people processed in memory and spilled as parts, and what the consent step needs """
+    data_load = load_pipeline()
+    # the edge cache is ../edge_cache
+    work_dir = tmp_path_factory.mktemp("out_of_core") / "run"
+    work_dir.mkdir()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(work_dir)
+        paths = sorted((synthetic_dir / "data").glob("*.zip"))
+        # with their manifests both runs read the conversations in the same order
+        for path in paths:
+            get_manifest(path)
+        data_list = data_load.process_people(paths, [None] * len(paths), n_workers=1)
+        data_load.process_people(paths, [None] * len(paths), n_workers=1, spill_dir=work_dir / "spill")
+        dropout_df = data_load.create_dropout_df(paths, n_workers=1)
+    with open(synthetic_dir / "cogsci19.pkl", "rb") as f:
+        cogs = data_load.as_hash_set(pickle.load(f))
+    return {"data_load": data_load, "work_dir": work_dir, "master_df": pd.concat(data_list),
+            "consent_names": dropout_df["name"], "cogs": cogs}
+
+
+@pytest.fixture(scope="module")
+def in_memory(pipeline):
+    """ The else branch of data_load.py's driver: consensual edges (codes into ids) and ids """
+    data_load = pipeline["data_load"]
+    unique_master = pipeline["master_df"].drop_duplicates()
+    data_load.write_table(data_load.typed_edges(unique_master), pipeline["work_dir"] / "full_mess.cols")
+    unique_master, ids = data_load.intern_ids(data_load.read_table(pipeline["work_dir"] / "full_mess.cols"))
+    ids, resolved_codes = data_load.resolve_codes(ids, data_load.id_replacements())
+    unique_master = data_load.relabel(unique_master, resolved_codes)
+    ids = data_load.add_ids(ids, pipeline["consent_names"])
+    cog_df = data_load.remove_non_cogs(unique_master, ids, pipeline["cogs"])
+    consent_df = data_load.filter_consent(cog_df, pipeline["consent_names"], ids)
+    return unique_master, consent_df.reset_index(drop=True), ids
+
+
+@pytest.fixture(scope="module")
+def deduplicated(pipeline):
+    out_dir = pipeline["work_dir"] / "full_mess.parts"
+    n_kept = out_of_core.dedup_parts(pipeline["work_dir"] / "spill", out_dir, MAX_MEMORY)
+    return out_dir, n_kept
+
+
+def named(df, ids):
+    """ The edges with the ids of their codes """
+    return df.assign(**{column: id_values(df[column].to_numpy(), ids) for column in ["from", "to"]})
+
+
+def plain(df):
+    """ Object ids, float timestamps (nan for missing), default index """
+    df = df.reset_index(drop=True)
+    return df.assign(**{column: np.asarray(df[column], dtype=object) for column in ["from", "to", "rel_type"]
+                        if column in df.columns},
+                     timestamp=pd.to_numeric(df["timestamp"]).astype(np.float64))
+
+
+def assert_same_rows(parts, expected):
+    pd.testing.assert_frame_equal(plain(parts), plain(expected), check_dtype=False)
+
+
+def test_dedup_parts(pipeline, deduplicated):
+    out_dir, n_kept = deduplicated
+    expected = pipeline["data_load"].typed_edges(pipeline["master_df"].drop_duplicates())
+    assert len(out_of_core.part_paths(out_dir)) > 1
+    assert n_kept == len(expected)
+    assert_same_rows(out_of_core.read_parts(out_dir, categorical=False), expected)
+
+
+def test_dedup_parts_with_few_open_files(pipeline, tmp_path):
+    resource = pytest.importorskip("resource")
+    n_rows = out_of_core.count_rows(out_of_core.part_paths(pipeline["work_dir"] / "spill"))
+    max_memory = 16 * out_of_core.ROW_BYTES
+    n_partitions = min(out_of_core.MAX_PARTITIONS, -(-n_rows * out_of_core.RECORD.itemsize * 4 // max_memory))
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = 64
+    assert n_partitions > 2 * limit
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    try:
+        n_kept = out_of_core.dedup_parts(pipeline["work_dir"] / "spill", tmp_path / "full_mess.parts", max_memory)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    assert n_kept == len(pipeline["master_df"].drop_duplicates())
+
+
+@pytest.mark.parametrize("random_ids", [False, True])
+def test_consent_and_tidy_parts(pipeline, in_memory, deduplicated, random_ids, tmp_path):
+    data_load = pipeline["data_load"]
+    _, consent_df, ids = in_memory
+    consent_dir, tidy_dir = tmp_path / "raw_consensual.parts", tmp_path / "tidy_data.parts"
+    replacements = out_of_core.consent_parts(deduplicated[0], consent_dir, pipeline["consent_names"],
+                                             pipeline["cogs"], MAX_MEMORY, random_ids=random_ids)
+    n_tidy = out_of_core.tidy_parts(consent_dir, tidy_dir, MAX_MEMORY)
+    assert len(out_of_core.part_paths(consent_dir)) > 1
+    assert len(out_of_core.part_paths(tidy_dir)) > 1
+
+    consent_parts = out_of_core.read_parts(consent_dir, categorical=False)
+    tidy_parts = out_of_core.read_parts(tidy_dir, categorical=False)
+    assert n_tidy == len(tidy_parts)
+    if random_ids:
+        assert replacements is not None
+        # every id got its own random id, they are compared by the ids they stand for
+        assert len(set(replacements.values())) == len(replacements)
+        original = {random_id: name for name, random_id in replacements.items()}
+        for frame in [consent_parts, tidy_parts]:
+            for column in ["from", "to"]:
+                frame[column] = frame[column].map(original)
+    else:
+        assert replacements is None
+    assert_same_rows(consent_parts, named(consent_df, ids))
+    tidy_df = data_load.tidy_pipeline(data_load.typed_edges(named(consent_df, ids)))
+    assert_same_rows(tidy_parts, tidy_df)
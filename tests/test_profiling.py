@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Stage records: thrown away when profiling is off, nested stages keep the
+peak memory of the stages around them
+"""
+import json
+
+import numpy as np
+import pytest
+
+import profiling
+
+
+@pytest.fixture
+def profile_path(tmp_path):
+    path = tmp_path / "profile.jsonl"
+    profiling.enable(path)
+    yield path
+    profiling.disable()
+
+
+def test_disabled_records_are_not_shared():
+    assert not profiling.enabled()
+    with profiling.stage("a") as record:
+        record["rows_out"] = np.zeros(10)
+    with profiling.stage("b") as record:
+        assert record == {}
+
+
+def test_nested_stage_keeps_outer_peak(profile_path):
+    if not profiling._clear_peak():
+        pytest.skip("the peak memory can't be reset here")
+    with profiling.stage("outer"):
+        # ~200 MB touched and freed before the nested stage clears the high-water mark
+        block = np.ones(25 * 2**20)
+        del block
+        with profiling.stage("inner") as record:
+            record["rows_out"] = 1
+    with open(profile_path, encoding="utf-8") as f:
+        records = {record["stage"]: record for record in map(json.loads, f)}
+    assert records["inner"]["rows_out"] == 1
+    assert records["outer"]["peak_rss_mb"] >= records["inner"]["peak_rss_mb"] + 150
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+What makes stages.py rerun a stage: the code it depends on, its inputs and
+outputs, and the stages before it
+"""
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+import stages
+from stages import Stage, code_fingerprint, run_stages
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture
+def code_dir(tmp_path):
+    """ A scratch copy of the repo's code """
+    code_dir = tmp_path / "code"
+    code_dir.mkdir()
+    for path in REPO_DIR.iterdir():
+        if path.is_file():
+            shutil.copy(path, code_dir)
+    return code_dir
+
+
+def chain_fingerprints(code_dir):
+    return {stage.name: code_fingerprint(stage.code, code_dir) for stage in stages.chain()}
+
+
+def edit(path, old, new):
+    source = path.read_text(encoding="utf-8")
+    assert source.count(old) == 1
+    path.write_text(source.replace(old, new), encoding="utf-8")
+
+
+def changed(before, after):
+    return {name for name in before if before[name] != after[name]}
+
+
+@pytest.mark.parametrize("file_name, old, new", [
+    ("data_load.py", "    with profiling.stage(\"tidy_pipeline\"",
+     "    aggregate = bool(aggregate)\n    with profiling.stage(\"tidy_pipeline\""),
+    ("group_edges.py", "    repeats = np.where(is_group, sizes[key], 1)",
+     "    repeats = np.where(is_group, sizes[key], 1).astype(np.int64)"),
+])
+def test_code_change_reruns_tidy_data_only(code_dir, tmp_path, monkeypatch, file_name, old, new):
+    # no raw exports here, so no anonymize stage
+    monkeypatch.chdir(tmp_path)
+    before = chain_fingerprints(code_dir)
+    edit(code_dir / file_name, old, new)
+    assert changed(before, chain_fingerprints(code_dir)) == {"tidy_data"}
+
+
+def test_comments_dont_count(code_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    before = chain_fingerprints(code_dir)
+    edit(code_dir / "group_edges.py", "    repeats = np.where(", "    # one row per member\n    repeats = np.where(")
+    edit(code_dir / "convo_dedup.py", "from collections import defaultdict\n", "from collections import defaultdict\n\n")
+    assert changed(before, chain_fingerprints(code_dir)) == set()
+
+
+def python_stage(name, inputs, outputs, code):
+    return Stage(name, [sys.executable, "-c", code], inputs, outputs)
+
+
+@pytest.fixture
+def toy_chain(tmp_path, monkeypatch):
+    """ upper <- in.txt, count <- upper.txt, other <- other.txt """
+    monkeypatch.chdir(tmp_path)
+    Path("in.txt").write_text("abc\nfirst\n", encoding="utf-8")
+    Path("other.txt").write_text("x", encoding="utf-8")
+    chain = [
+        python_stage("upper", ["in.txt"], ["upper.txt"],
+                     "open('upper.txt', 'w').write(open('in.txt').read().splitlines()[0].upper())"),
+        python_stage("count", ["upper.txt"], ["count.txt"],
+                     "open('count.txt', 'w').write(str(len(open('upper.txt').read())))"),
+        python_stage("other", ["other.txt"], ["other_out.txt"],
+                     "open('other_out.txt', 'w').write(open('other.txt').read())"),
+    ]
+
+    def run(targets=None, dry_run=False, force=()):
+        results = run_stages(chain, targets, jobs=2, force=force, dry_run=dry_run, state_path=tmp_path / "state.json",
+                             timings_path=tmp_path / "timings.jsonl", log_dir=tmp_path / "logs")
+        return {name: status for name, (status, _) in results.items()}
+    return run
+
+
+def test_run_stages(toy_chain):
+    run = toy_chain
+    assert run(dry_run=True) == {"upper": "would run", "count": "would run", "other": "would run"}
+    assert not Path("upper.txt").exists()
+    assert run(["count"]) == {"upper": "ran", "count": "ran"}
+    assert Path("count.txt").read_text() == "3"
+    assert run(dry_run=True) == {"upper": "up to date", "count": "up to date", "other": "would run"}
+    assert run() == {"upper": "up to date", "count": "up to date", "other": "ran"}
+
+    # a changed input reruns the stages after it too (in a dry run without running anything)
+    Path("in.txt").write_text("abcd\n", encoding="utf-8")
+    assert run(dry_run=True) == {"upper": "would run", "count": "would run", "other": "up to date"}
+    assert run() == {"upper": "ran", "count": "ran", "other": "up to date"}
+    # a rerun writing the same output stops there
+    Path("in.txt").write_text("abcd\nsecond\n", encoding="utf-8")
+    assert run() == {"upper": "ran", "count": "up to date", "other": "up to date"}
+    # a missing output, --force
+    Path("count.txt").unlink()
+    assert run(dry_run=True)["count"] == "would run"
+    assert run(force=["other"]) == {"upper": "up to date", "count": "ran", "other": "ran"}
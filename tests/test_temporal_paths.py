@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+The sweep of temporal_paths.py against a brute-force search of the
+time-respecting paths, and a small case worked out by hand
+"""
+import numpy as np
+import pytest
+
+from temporal_paths import foremost_trees, sweep, window_paths
+
+
+def reachable_states(src, dst, timestamps, source, delta=None):
+    """ Every (node, time) a path from source can arrive at: strictly later messages, at most delta apart """
+    states = set()
+    todo = [(v, t) for u, v, t in zip(src, dst, timestamps) if u == source]
+    while todo:
+        state = todo.pop()
+        if state in states:
+            continue
+        states.add(state)
+        node, arrival = state
+        todo.extend((v, t) for u, v, t in zip(src, dst, timestamps)
+                    if u == node and t > arrival and (delta is None or t - arrival <= delta))
+    return states
+
+
+def random_graph(rng):
+    n_nodes = int(rng.integers(2, 8))
+    n_messages = int(rng.integers(1, 25))
+    src = rng.integers(0, n_nodes, n_messages)
+    dst = (src + rng.integers(1, n_nodes, n_messages)) % n_nodes
+    # few distinct times, so some messages are at the same time
+    timestamps = np.sort(rng.integers(0, 12, n_messages))
+    return src, dst, timestamps, n_nodes
+
+
+@pytest.mark.parametrize("delta", [None, 0, 2])
+def test_sweep_against_brute_force(delta):
+    rng = np.random.default_rng(0 if delta is None else delta + 1)
+    for _ in range(300):
+        src, dst, timestamps, n_nodes = random_graph(rng)
+        sources = np.unique(src)
+        earliest, pred = sweep(src, dst, timestamps, n_nodes, sources, delta)
+        for row, source in enumerate(sources):
+            states = reachable_states(src.tolist(), dst.tolist(), timestamps.tolist(), source, delta)
+            expected = np.full(n_nodes, -1)
+            for node, t in states:
+                if node != source and (expected[node] < 0 or t < expected[node]):
+                    expected[node] = t
+            np.testing.assert_array_equal(earliest[row], expected)
+            # the predecessor's message arrives then, and a path reached the predecessor in time for it
+            for v in np.flatnonzero(expected >= 0):
+                u, t = pred[row, v], expected[v]
+                assert any(a == u and b == v and time == t for a, b, time in zip(src, dst, timestamps))
+                assert u == source or any(node == u and arrival < t and (delta is None or t - arrival <= delta)
+                                          for node, arrival in states)
+
+
+def test_hand_worked_chain():
+    # a -> b -> c -> d one ms apart, a -> c too late to be a first arrival, d -> e much later
+    a, b, c, d, e = 3, 7, 8, 12, 20
+    src = np.array([a, b, c, a, d])
+    dst = np.array([b, c, d, c, e])
+    timestamps = np.array([1, 2, 3, 5, 10])
+
+    local = {node: i for i, node in enumerate([a, b, c, d, e])}
+    sources = np.array([local[a], local[b], local[c], local[d]])
+    earliest, pred = sweep(np.array([local[u] for u in src]), np.array([local[v] for v in dst]),
+                           timestamps, 5, sources)
+    hops, through = foremost_trees(earliest, pred, sources)
+    np.testing.assert_array_equal(hops, [[0, 1, 2, 3, 4],
+                                         [0, 0, 1, 2, 3],
+                                         [0, 0, 0, 1, 2],
+                                         [0, 0, 0, 0, 1]])
+    # b is on a's paths to c, d and e, c on a's and b's paths to d and e, d on everyone's path to e
+    np.testing.assert_array_equal(through.sum(axis=0), [0, 3, 4, 3, 0])
+
+    nodes, lengths = window_paths(src, dst, timestamps)
+    np.testing.assert_array_equal(nodes["node"], [a, b, c, d, e])
+    np.testing.assert_array_equal(nodes["reachable"], [4, 3, 2, 1, 0])
+    np.testing.assert_array_equal(nodes["reached_by"], [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(nodes["betweenness"], [0, 3, 4, 3, 0])
+    np.testing.assert_allclose(nodes["mean_hops"][:4], [2.5, 2, 1.5, 1])
+    np.testing.assert_array_equal(lengths, [0, 4, 3, 2, 1])
+
+    # with at most 1 ms between messages only d's own message reaches e
+    nodes, lengths = window_paths(src, dst, timestamps, delta=1)
+    np.testing.assert_array_equal(nodes["reachable"], [3, 2, 1, 1, 0])
+    np.testing.assert_array_equal(nodes["reached_by"], [0, 1, 2, 3, 1])
+    np.testing.assert_array_equal(nodes["betweenness"], [0, 2, 2, 0, 0])
+    np.testing.assert_array_equal(lengths, [0, 4, 2, 1])
+
+    # split into one source per task, summed the same
+    chunked, chunked_lengths = window_paths(src, dst, timestamps, delta=1, chunk_sources=1)
+    for key in nodes:
+        np.testing.assert_array_equal(chunked[key], nodes[key])
+    np.testing.assert_array_equal(chunked_lengths, lengths)